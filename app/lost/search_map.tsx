@@ -66,12 +66,24 @@ export default function SearchMapScreen() {
 
     if (!lost_item_id) return;
 
-    const timeout = setTimeout(() => {
+    // 新しいマッチはWebSocketで届く（最初に現在の一覧、その後は追加分だけ）
+    const socket = new WebSocket(`wss://fc59-2400-4150-9180-b500-8891-8d59-e8f4-33ed.ngrok-free.app/api/matched-found-items/ws?lost_item_id=${lost_item_id}`);
+    socket.onmessage = (event) => {
+      const message = JSON.parse(event.data);
+      if (message.type === 'snapshot') {
+        setMarkers(message.items);
+      } else if (message.type === 'match') {
+        const ids = new Set(message.items.map((item: MarkerData) => item.id));
+        setMarkers((prev) => [...prev.filter((marker) => !ids.has(marker.id)), ...message.items]);
+      }
+    };
+    // 接続できない場合は一度だけ取得する
+    socket.onerror = () => {
+      console.error('❌ WebSocketエラー、HTTPで取得します');
       fetchMarkers();
-      console.log("Markers:", markers);
-    }, 300);
+    };
 
-    return () => clearTimeout(timeout);
+    return () => socket.close();
 }, [lost_item_id]);
 
 
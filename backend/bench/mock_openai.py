@@ -0,0 +1,145 @@
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+# 模擬 OpenAI サーバ: a local stand-in for POST /v1/chat/completions with configurable
+# latency and failure rates, so the matching pipeline can be measured without the real API
+BATCH_LABELS = re.compile(r"each of these labels: ([^.]+)\.")
+
+
+def _message_texts(request: dict):
+    for message in request.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            yield content
+        elif isinstance(content, list):
+            yield from (part.get("text", "") for part in content if part.get("type") == "text")
+
+
+class MockOpenAI:
+    # latency_ms +- jitter_ms per call; error_rate of calls answer 500, rate_limit_rate answer 429
+
+    def __init__(self, latency_ms: float = 300, jitter_ms: float = 100, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self.counts = {"calls": 0, "ok": 0, "errors": 0, "rate_limited": 0, "batch": 0, "prompt_tokens": 0}
+
+    def _bump(self, key: str, amount: int = 1):
+        with self._lock:
+            self.counts[key] += amount
+
+    def _roll(self) -> tuple:
+        with self._lock:
+            delay = max(0.0, self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            outcome = self._random.random()
+            score = self._random.randint(1, 5)
+        if outcome < self.error_rate:
+            return delay, "error", score
+        if outcome < self.error_rate + self.rate_limit_rate:
+            return delay, "rate_limited", score
+        return delay, "ok", score
+
+    def answer(self, request: dict) -> tuple:
+        # (status, headers, body) for one chat completion request
+        self._bump("calls")
+        delay, outcome, score = self._roll()
+        time.sleep(delay)
+        if outcome == "error":
+            self._bump("errors")
+            return 500, {}, {"error": {"message": "mock upstream error", "type": "server_error"}}
+        if outcome == "rate_limited":
+            self._bump("rate_limited")
+            return 429, {"retry-after": "0.1"}, {"error": {"message": "mock rate limit", "type": "rate_limit_error"}}
+
+        text = "\n".join(_message_texts(request))
+        labels = BATCH_LABELS.search(text)
+        if request.get("response_format") and labels:
+            # match_batch: one score per candidate label
+            self._bump("batch")
+            content = json.dumps({"scores": [
+                {"id": label.strip(), "score": self._random.randint(1, 5)} for label in labels.group(1).split(",")
+            ]})
+        elif "Candidate questions:" in text:
+            # generate-questions: keep every candidate
+            content = "\n".join(line for line in text.split("Candidate questions:", 1)[1].splitlines() if line.startswith("- "))
+        else:
+            content = str(score)
+
+        # roughly what the real API bills: ~4 characters per token, images counted by their base64 size
+        prompt_tokens = len(json.dumps(request)) // 4
+        self._bump("ok")
+        self._bump("prompt_tokens", prompt_tokens)
+        return 200, {}, {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4o"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 1, "total_tokens": prompt_tokens + 1},
+        }
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["content-length"])) or b"{}")
+                status, headers, body = mock.answer(request)
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}/v1"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.counts)
+
+
+# Optional direct run: serve the mock for a manually started API or worker
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve a mock OpenAI chat completions endpoint")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    mock = MockOpenAI(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate)
+    print(f"OPENAI_BASE_URL={mock.start(port=args.port)}")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        mock.stop()
@@ -0,0 +1,369 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+from bench.mock_openai import MockOpenAI
+
+# マッチング処理のベンチマーク
+#   cd backend && python -m bench.run --found 2000 --lost 200 --latency-ms 300 --error-rate 0.02
+# seeds a scratch database with synthetic items, then times match_lost_item / match_found_item,
+# the upload endpoints (plus the match jobs they enqueue) and the list endpoints against a local
+# mock OpenAI server. Results go to bench/results/ as JSON; --compare flags regressions against an
+# earlier run.
+RESULTS_DIR = os.path.join(BACKEND_DIR, "bench", "results")
+# metrics compared by --compare; larger is worse for latency, smaller is worse for throughput
+COMPARED = (("latency_ms", "p95", 1), ("throughput_per_s", None, -1), ("openai_calls_per_op", None, 1))
+
+
+def percentile(samples: List[float], p: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 1)
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class Phase:
+    # latencies, errors and mock OpenAI calls for one measured operation
+
+    def __init__(self, name: str, mock: MockOpenAI):
+        self.name = name
+        self.mock = mock
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.extra: Dict[str, object] = {}
+
+    def __enter__(self):
+        self._calls = self.mock.snapshot()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self._started
+        self.calls = {key: value - self._calls[key] for key, value in self.mock.snapshot().items()}
+        self.traced_peak_mb = (
+            round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1) if tracemalloc.is_tracing() else None
+        )
+        return False
+
+    @contextmanager
+    def op(self):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.errors += 1
+            print(f"  {self.name}: {type(e).__name__}: {e}")
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+
+    def result(self) -> dict:
+        count = len(self.latencies)
+        return {
+            "ops": count,
+            "errors": self.errors,
+            "seconds": round(self.seconds, 3),
+            "throughput_per_s": round(count / self.seconds, 2) if self.seconds else None,
+            "latency_ms": {
+                "p50": percentile(self.latencies, 0.50),
+                "p95": percentile(self.latencies, 0.95),
+                "p99": percentile(self.latencies, 0.99),
+                "max": percentile(self.latencies, 1.0),
+            },
+            "openai_calls": self.calls["calls"],
+            "openai_calls_per_op": round(self.calls["calls"] / count, 2) if count else None,
+            "openai": self.calls,
+            "peak_rss_mb": peak_rss_mb(),
+            "traced_peak_mb": self.traced_peak_mb,
+            **self.extra,
+        }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_environment(workdir: str, base_url: str):
+    # every app module reads its settings at import time, so this has to run before they are imported
+    os.chdir(workdir)
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    # the mock has no quota; export OPENAI_RPM / OPENAI_TPM to measure the throttling too
+    os.environ.setdefault("OPENAI_RPM", "1000000")
+    os.environ.setdefault("OPENAI_TPM", "1000000000")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+
+def reset_match_state():
+    from database import SessionLocal
+    from models import MatchJob, MatchScore, MatchWatermark, ScoreCacheEntry
+
+    # each matching phase starts cold: no earlier scores, watermarks or cached answers
+    db = SessionLocal()
+    try:
+        for model in (MatchScore, MatchWatermark, ScoreCacheEntry, MatchJob):
+            db.query(model).delete()
+        db.commit()
+    finally:
+        db.close()
+
+
+def bench_match(phase: Phase, item_type: str, samples: int, rng: random.Random):
+    from database import SessionLocal
+    from matching import match_found_item, match_lost_item
+    from models import FoundItem, LostItem
+
+    model, match = (LostItem, match_lost_item) if item_type == "lost" else (FoundItem, match_found_item)
+    db = SessionLocal()
+    try:
+        item_ids = [item_id for (item_id,) in db.query(model.id)]
+    finally:
+        db.close()
+    for item_id in rng.sample(item_ids, min(samples, len(item_ids))):
+        db = SessionLocal()
+        try:
+            with phase.op():
+                match(db.get(model, item_id), db, full=True)
+        finally:
+            db.close()
+
+
+def bench_inserts(phase: Phase, client, count: int, image_pool: List[str], rng: random.Random):
+    from bench.synthetic import found_item_form, lost_item_form
+
+    now = datetime.utcnow()
+    for i in range(count):
+        if i % 2 == 0:
+            url, form, paths = "/api/lost-items", lost_item_form(rng, now), [rng.choice(image_pool)]
+        else:
+            url, form, paths = "/api/found-items", found_item_form(rng, now), rng.sample(image_pool, 2)
+        files = []
+        for path in paths:
+            with open(path, "rb") as f:
+                files.append(("images", (os.path.basename(path), f.read(), "image/jpeg")))
+        with phase.op():
+            response = client.post(url, data=form, files=files)
+            response.raise_for_status()
+
+
+def bench_worker(phase: Phase):
+    import worker
+
+    # one job per claim so every job gets its own latency sample
+    while True:
+        with phase.op():
+            processed = worker.run_once("bench", batch_size=1)
+        if not processed:
+            phase.latencies.pop()
+            break
+
+
+def bench_lists(phases: Dict[str, Phase], client, requests: int, rng: random.Random):
+    from bench.synthetic import random_point
+    from database import SessionLocal
+    from models import LostItem
+
+    db = SessionLocal()
+    try:
+        lost_ids = [item_id for (item_id,) in db.query(LostItem.id)]
+    finally:
+        db.close()
+
+    def near():
+        lat, lon = random_point(rng)
+        return {"near": f"{lat},{lon}", "radius": 2}
+
+    cases = {
+        "list_lost_items": ("/api/lost-items", lambda: {}),
+        "list_found_items": ("/api/found-items", lambda: {"cursor": "0", "limit": 20}),
+        "list_found_items_near": ("/api/found-items", near),
+        "matched_found_items": ("/api/matched-found-items", lambda: {"lost_item_id": rng.choice(lost_ids)}),
+    }
+    for name, (url, params) in cases.items():
+        with phases[name] as phase:
+            for _ in range(requests):
+                with phase.op():
+                    client.get(url, params=params()).raise_for_status()
+
+
+def compare(current: dict, baseline_path: str, tolerance: float) -> List[str]:
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = []
+    print(f"\ncompared with {baseline_path} ({baseline.get('revision')}):")
+    changed = sorted(key for key, value in current["config"].items() if baseline.get("config", {}).get(key) != value)
+    if changed:
+        print(f"  note: the runs differ in {', '.join(changed)}")
+    for name, result in current["phases"].items():
+        before = baseline.get("phases", {}).get(name)
+        if before is None:
+            continue
+        for metric, key, direction in COMPARED:
+            new, old = result.get(metric), before.get(metric)
+            if key is not None:
+                new, old = (new or {}).get(key), (old or {}).get(key)
+            if not new or not old:
+                continue
+            change = (new - old) / old
+            flag = ""
+            if change * direction > tolerance:
+                flag = "  <-- regression"
+                regressions.append(f"{name}.{metric}{'.' + key if key else ''}")
+            print(f"  {name:24s} {metric + ('.' + key if key else ''):24s} {old:>10} -> {new:>10} ({change:+.0%}){flag}")
+    return regressions
+
+
+def run(args) -> dict:
+    rng = random.Random(args.seed)
+    mock = MockOpenAI(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate, seed=args.seed)
+    workdir = tempfile.mkdtemp(prefix="kyojo-bench-")
+    prepare_environment(workdir, mock.start())
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    from bench.synthetic import make_image_pool, seed_items
+    from database import SessionLocal
+    from fastapi.testclient import TestClient
+    from main import app
+    from openai_client import breaker
+
+    phases: Dict[str, Phase] = {}
+
+    def phase(name: str) -> Phase:
+        phases[name] = Phase(name, mock)
+        return phases[name]
+
+    print(f"seeding {args.found} found / {args.lost} lost items in {workdir}")
+    with phase("seed") as seed:
+        image_pool = make_image_pool(args.images, rng)
+        db = SessionLocal()
+        try:
+            with seed.op():
+                seed_items(db, args.found, args.lost, image_pool, rng)
+        finally:
+            db.close()
+
+    print(f"match_lost_item x{args.samples}")
+    reset_match_state()
+    with phase("match_lost_item") as p:
+        bench_match(p, "lost", args.samples, rng)
+
+    print(f"match_found_item x{args.samples}")
+    reset_match_state()
+    with phase("match_found_item") as p:
+        bench_match(p, "found", args.samples, rng)
+
+    # the scores from match_found_item stay, so matched_found_items below has rows to page through
+    with TestClient(app) as client:
+        print(f"uploads x{args.inserts}")
+        with phase("insert_endpoints") as p:
+            bench_inserts(p, client, args.inserts, image_pool, rng)
+        print("match jobs for the uploads")
+        with phase("match_jobs") as p:
+            bench_worker(p)
+        p.extra["openai_calls_per_insert"] = round(p.calls["calls"] / args.inserts, 2) if args.inserts else None
+
+        print(f"list endpoints x{args.requests}")
+        for name in ("list_lost_items", "list_found_items", "list_found_items_near", "matched_found_items"):
+            phase(name)
+        bench_lists(phases, client, args.requests, rng)
+
+    mock.stop()
+    return {
+        "revision": git_revision(),
+        "created_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            **{key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+            **{key: os.environ.get(key) for key in (
+                "MATCH_STRATEGY", "MATCH_BATCH_SIZE", "MATCH_CONCURRENCY", "MATCH_TOP_K",
+                "MATCH_MAX_DISTANCE_KM", "EMBEDDING_BACKEND", "OPENAI_RPM", "OPENAI_TPM",
+            )},
+        },
+        "phases": {name: p.result() for name, p in phases.items()},
+        "openai": mock.snapshot(),
+        "circuit_breaker": breaker.stats(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark matching and the list/upload endpoints on synthetic data")
+    parser.add_argument("--found", type=int, default=2000, help="seeded found items")
+    parser.add_argument("--lost", type=int, default=200, help="seeded lost items")
+    parser.add_argument("--images", type=int, default=50, help="distinct synthetic photos shared by the items")
+    parser.add_argument("--samples", type=int, default=20, help="items matched per match_*_item phase")
+    parser.add_argument("--inserts", type=int, default=20, help="uploads through the endpoints")
+    parser.add_argument("--requests", type=int, default=100, help="requests per list endpoint")
+    parser.add_argument("--latency-ms", type=float, default=300, help="mock OpenAI latency")
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of mock calls answering 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of mock calls answering 429")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tracemalloc", action="store_true", help="also trace Python allocations (slower)")
+    parser.add_argument("--output", help="result file (default bench/results/<time>-<revision>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change reported as a regression")
+    args = parser.parse_args()
+    # run() moves into a scratch directory
+    args.output = os.path.abspath(args.output) if args.output else None
+    args.compare = os.path.abspath(args.compare) if args.compare else None
+
+    results = run(args)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{results['revision'] or 'local'}.json")
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+
+    for name, result in results["phases"].items():
+        latency = result["latency_ms"]
+        print(f"{name:24s} ops={result['ops']:<5d} {result['throughput_per_s'] or 0:>8.2f}/s "
+              f"p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms "
+              f"calls/op={result['openai_calls_per_op']} errors={result['errors']} rss={result['peak_rss_mb']}MB")
+    print(f"results written to {output}")
+
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+# Optional direct run
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import hashlib
+import io
+import os
+import random
+from datetime import datetime, timedelta
+from typing import List
+
+from embeddings import item_embedding
+from images import describe_images
+from item_images import item_image_rows
+from models import FoundItem, LostItem, LostItemLocation
+from PIL import Image, ImageDraw
+from sqlalchemy.orm import Session
+
+# 合成データ: items scattered around a few centres in Kyoto, so the distance and date
+# filters keep a realistic share of pairs instead of all or none
+CENTRES = [(35.0116, 135.7681), (34.9858, 135.7588), (35.0394, 135.7292), (34.9671, 135.7727)]
+SPREAD_DEG = 0.03  # ≒ 3km around each centre
+KINDS = ["📱 Phone", "👛 Wallet", "🔑 Keys", "☂️ Umbrella", "🎒 Bag", "不明"]
+COLOURS = ["black", "red", "blue", "white", "brown", "green", "silver", "pink"]
+NOUNS = {"📱 Phone": "iPhone 13", "👛 Wallet": "leather wallet", "🔑 Keys": "key ring",
+         "☂️ Umbrella": "folding umbrella", "🎒 Bag": "backpack", "不明": "pouch"}
+DAYS = 30
+
+
+def _jpeg(rng: random.Random) -> bytes:
+    img = Image.new("RGB", (640, 480), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(6):
+        x, y = rng.randrange(600), rng.randrange(440)
+        draw.rectangle((x, y, x + rng.randrange(40, 200), y + rng.randrange(40, 200)),
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=85)
+    return out.getvalue()
+
+
+# a pool of distinct photos, stored the way save_uploads stores them (uploads/<sha256>.jpg)
+def make_image_pool(count: int, rng: random.Random, upload_dir: str = "uploads") -> List[str]:
+    os.makedirs(upload_dir, exist_ok=True)
+    paths = []
+    for _ in range(count):
+        data = _jpeg(rng)
+        path = f"{upload_dir}/{hashlib.sha256(data).hexdigest()}.jpg"
+        with open(path, "wb") as f:
+            f.write(data)
+        paths.append(path)
+    return paths
+
+
+def random_point(rng: random.Random):
+    lat, lon = rng.choice(CENTRES)
+    return lat + rng.uniform(-SPREAD_DEG, SPREAD_DEG), lon + rng.uniform(-SPREAD_DEG, SPREAD_DEG)
+
+
+def random_details(rng: random.Random, kind: str) -> str:
+    return f"{rng.choice(COLOURS)} {NOUNS[kind]}, lost near the station #{rng.randrange(10000)}"
+
+
+def _day(rng: random.Random, now: datetime) -> datetime:
+    return now - timedelta(days=rng.uniform(0, DAYS))
+
+
+# form fields for POST /api/lost-items and /api/found-items
+def lost_item_form(rng: random.Random, now: datetime) -> dict:
+    kind = rng.choice(KINDS)
+    start = _day(rng, now)
+    lat, lon = random_point(rng)
+    return {
+        "details": random_details(rng, kind), "kind": kind,
+        "date_from": start.isoformat(), "date_to": (start + timedelta(days=rng.uniform(0.5, 3))).isoformat(),
+        "locations[0][latitude]": str(lat), "locations[0][longitude]": str(lon),
+    }
+
+
+def found_item_form(rng: random.Random, now: datetime) -> dict:
+    lat, lon = random_point(rng)
+    return {
+        "kind": rng.choice(KINDS), "date_found": _day(rng, now).isoformat(),
+        "latitude": str(lat), "longitude": str(lon), "location_notes": f"bench {rng.randrange(10000)}",
+    }
+
+
+def _add_images(db: Session, item_type: str, item, paths: List[str]):
+    db.add_all(item_image_rows(item_type, item.id, describe_images(paths)))
+    embedding = item_embedding(item_type, item)
+    if embedding is not None:
+        db.add(embedding)
+
+
+# straight into the database, skipping the endpoints and the match jobs
+def seed_items(db: Session, found_count: int, lost_count: int, image_pool: List[str], rng: random.Random,
+               batch_size: int = 500):
+    now = datetime.utcnow()
+    for start in range(0, found_count, batch_size):
+        items = []
+        for _ in range(min(batch_size, found_count - start)):
+            form = found_item_form(rng, now)
+            paths = rng.sample(image_pool, 2)  # found items always carry two photos
+            items.append((FoundItem(
+                kind=form["kind"], date_found=datetime.fromisoformat(form["date_found"]),
+                latitude=float(form["latitude"]), longitude=float(form["longitude"]),
+                location_notes=form["location_notes"], image_urls=",".join(paths),
+            ), paths))
+        db.add_all(item for item, _ in items)
+        db.flush()
+        for item, paths in items:
+            _add_images(db, "found", item, paths)
+        db.commit()
+
+    for start in range(0, lost_count, batch_size):
+        items = []
+        for _ in range(min(batch_size, lost_count - start)):
+            form = lost_item_form(rng, now)
+            paths = [rng.choice(image_pool)]
+            items.append((LostItem(
+                details=form["details"], kind=form["kind"],
+                date_from=datetime.fromisoformat(form["date_from"]), date_to=datetime.fromisoformat(form["date_to"]),
+                location_notes="", image_urls=",".join(paths), security_info="",
+            ), paths, form))
+        db.add_all(item for item, _, _ in items)
+        db.flush()
+        for item, paths, form in items:
+            db.add(LostItemLocation(item_id=item.id, latitude=float(form["locations[0][latitude]"]),
+                                    longitude=float(form["locations[0][longitude]"])))
+            _add_images(db, "lost", item, paths)
+        db.commit()
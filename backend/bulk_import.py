@@ -0,0 +1,204 @@
+import csv
+import io
+import json
+import os
+import posixpath
+import tarfile
+import zipfile
+from datetime import datetime
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from database import writer_session
+from embeddings import item_embedding
+from images import describe_images
+from item_images import item_image_rows
+from jobs import queue_match_job
+from logs import get_logger
+from metrics import timed
+from models import FoundItem, ImportBatch
+from storage import store_file
+
+logger = get_logger(__name__)
+
+# 拾得物の一括登録（駅・施設の遺失物センター向け）
+BATCH_SIZE = int(os.getenv("BULK_IMPORT_BATCH_SIZE", "200"))  # found items per write transaction
+IMAGE_SEPARATOR = ";"  # between image names in a CSV cell
+IMAGES_PER_ITEM = 2  # matching compares exactly two photos of each found item (match.build_match_messages)
+
+
+class ManifestError(ValueError):
+    pass
+
+
+class ImportResult(NamedTuple):
+    batch_id: Optional[int]
+    imported: int
+    errors: List[dict]  # {"row": manifest row number (None for the whole import), "error": message}
+    job_id: Optional[int]
+
+
+def _archive_name(name: str) -> str:
+    return posixpath.normpath(name.replace("\\", "/")).lstrip("/")
+
+
+# one dict per item from CSV (header row) or JSON Lines, chosen by the file name
+def read_manifest(f: BinaryIO, name: str) -> List[dict]:
+    text = io.TextIOWrapper(f, encoding="utf-8-sig", newline="")
+    try:
+        if name.lower().endswith((".jsonl", ".ndjson", ".json")):
+            rows = []
+            for number, line in enumerate(text, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    rows.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    raise ManifestError(f"manifest line {number} is not JSON: {e}")
+            return rows
+        return list(csv.DictReader(text))
+    except UnicodeDecodeError:
+        raise ManifestError("manifest must be UTF-8")
+    finally:
+        text.detach()
+
+
+# the FoundItem columns and image names of one manifest row
+def parse_row(row: dict) -> Tuple[dict, List[str]]:
+    if not isinstance(row, dict):
+        raise ValueError("row must be an object")
+    images = row.get("images") or []
+    if isinstance(images, str):
+        images = [name.strip() for name in images.split(IMAGE_SEPARATOR) if name.strip()]
+    if not images:
+        raise ValueError("images is required")
+    if not isinstance(images, list) or len(images) != IMAGES_PER_ITEM:
+        raise ValueError(f"images must name exactly {IMAGES_PER_ITEM} photos")
+    try:
+        date_found = datetime.fromisoformat(str(row.get("date_found") or ""))
+    except ValueError:
+        raise ValueError("date_found must be an ISO date, e.g. 2025-06-03T10:00:00")
+    try:
+        latitude, longitude = float(row["latitude"]), float(row["longitude"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("latitude and longitude are required numbers")
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("latitude/longitude out of range")
+    fields = dict(
+        kind=row.get("kind") or "不明",
+        date_found=date_found,
+        latitude=latitude,
+        longitude=longitude,
+        location_notes=row.get("location_notes") or "",
+    )
+    return fields, [str(name) for name in images]
+
+
+def _archive_members(archive: BinaryIO) -> Iterator[Tuple[str, BinaryIO]]:
+    if zipfile.is_zipfile(archive):
+        archive.seek(0)
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    with zf.open(info) as member:
+                        yield info.filename, member
+        return
+    archive.seek(0)
+    try:
+        # "r|*": read the tar (optionally compressed) front to back without seeking
+        with tarfile.open(fileobj=archive, mode="r|*") as tf:
+            for info in tf:
+                if info.isfile():
+                    yield info.name, tf.extractfile(info)
+    except tarfile.ReadError:
+        raise ManifestError("images must be a zip or tar archive")
+
+
+# streams the archive once and stores only the members the manifest names, by archive path
+def store_archive_images(archive: BinaryIO, wanted: Set[str]) -> Tuple[Dict[str, str], List[str]]:
+    wanted_basenames = {posixpath.basename(name) for name in wanted}
+    stored: Dict[str, str] = {}
+    problems = []
+    for member_name, member in _archive_members(archive):
+        name = _archive_name(member_name)
+        base = posixpath.basename(name)
+        if name not in wanted and base not in wanted_basenames:
+            continue
+        try:
+            path = store_file(member, base)
+        except ValueError as e:
+            problems.append(str(e))
+            continue
+        stored[name] = path
+        stored.setdefault(base, path)
+    return stored, problems
+
+
+def _lookup(stored: Dict[str, str], name: str) -> Optional[str]:
+    name = _archive_name(name)
+    # a bare file name in the manifest may sit in any folder of the archive
+    return stored.get(name) or (stored.get(posixpath.basename(name)) if "/" not in name else None)
+
+
+# the slow part (resizing, variants, embeddings) runs before the write transaction opens
+def _prepare(fields: dict, paths: List[str], batch_id: int):
+    item = FoundItem(**fields, image_urls=",".join(paths), import_batch_id=batch_id)
+    return item, describe_images(paths), item_embedding("found", item)
+
+
+def _insert(prepared: list):
+    with timed("bulk_import_batch"), writer_session() as writer:
+        writer.add_all(item for item, _, _ in prepared)
+        writer.flush()  # assigns the ids
+        for item, described, embedding in prepared:
+            writer.add_all(item_image_rows("found", item.id, described))
+            if embedding is not None:
+                embedding.item_id = item.id
+                writer.add(embedding)
+
+
+def import_found_items(manifest: BinaryIO, manifest_name: str, archive: BinaryIO,
+                       source: Optional[str] = None) -> ImportResult:
+    errors = []
+    parsed = []
+    for number, row in enumerate(read_manifest(manifest, manifest_name), start=1):
+        try:
+            parsed.append((number, *parse_row(row)))
+        except ValueError as e:
+            errors.append(dict(row=number, error=str(e)))
+
+    stored, problems = store_archive_images(archive, {_archive_name(name) for _, _, names in parsed for name in names})
+    errors.extend(dict(row=None, error=problem) for problem in problems)
+    items = []
+    for number, fields, names in parsed:
+        paths = [_lookup(stored, name) for name in names]
+        missing = [name for name, path in zip(names, paths) if path is None]
+        if missing:
+            errors.append(dict(row=number, error=f"not in the archive: {', '.join(missing)}"))
+        else:
+            items.append((fields, paths))
+    if not items:
+        return ImportResult(None, 0, errors, None)
+
+    with writer_session() as writer:
+        batch = ImportBatch(source=source or manifest_name)
+        writer.add(batch)
+        writer.flush()
+        batch_id = batch.id
+
+    imported = 0
+    try:
+        for start in range(0, len(items), BATCH_SIZE):
+            chunk = items[start:start + BATCH_SIZE]
+            _insert([_prepare(fields, paths, batch_id) for fields, paths in chunk])
+            imported += len(chunk)
+            logger.info("Import batch %d: %d/%d found items", batch_id, imported, len(items))
+    finally:
+        # whatever was committed gets its one matching run, even if a later chunk failed
+        with writer_session() as writer:
+            batch = writer.get(ImportBatch, batch_id)
+            batch.imported = imported
+            batch.failed = len(items) - imported + len(errors)
+            job = queue_match_job(writer, "import", batch_id) if imported else None
+            writer.flush()
+            job_id = job.id if job is not None else None
+    return ImportResult(batch_id, imported, errors, job_id)
@@ -0,0 +1,160 @@
+import os
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Tuple
+
+from geo import haversine_km
+from metrics import MATCH_CANDIDATES
+from models import FoundItem, LostItem
+from spatial import found_items_near_any, lost_items_near
+from sqlalchemy.orm import Query, Session
+
+# 候補絞り込みの設定（環境変数で調整可能）
+DATE_SLACK_DAYS = float(os.getenv("MATCH_DATE_SLACK_DAYS", "2"))
+MAX_DISTANCE_KM = float(os.getenv("MATCH_MAX_DISTANCE_KM", "5"))
+TOP_K = int(os.getenv("MATCH_TOP_K", "20"))
+
+# kinds that say nothing about the item, so they never prune a pair
+WILDCARD_KINDS = {"", "不明", "others", "unknown"}
+
+
+@dataclass
+class PruneStats:
+    considered: int = 0
+    pruned_kind: int = 0
+    pruned_date: int = 0
+    pruned_distance: int = 0
+    pruned_top_k: int = 0
+    selected: int = 0
+
+    def record(self):
+        MATCH_CANDIDATES.labels("kind").inc(self.pruned_kind)
+        MATCH_CANDIDATES.labels("date").inc(self.pruned_date)
+        MATCH_CANDIDATES.labels("distance").inc(self.pruned_distance)
+        MATCH_CANDIDATES.labels("top_k").inc(self.pruned_top_k)
+        MATCH_CANDIDATES.labels("selected").inc(self.selected)
+
+
+def normalize_kind(kind: Optional[str]) -> str:
+    # the app sends either "phone" or the menu label "📱 Phone"
+    if not kind:
+        return ""
+    return "".join(c for c in kind if c.isascii() or c.isalpha()).strip().lower()
+
+
+def kinds_compatible(lost_kind: Optional[str], found_kind: Optional[str]) -> bool:
+    a, b = normalize_kind(lost_kind), normalize_kind(found_kind)
+    return a in WILDCARD_KINDS or b in WILDCARD_KINDS or a == b
+
+
+def _naive(value: Optional[datetime]) -> Optional[datetime]:
+    if value is None:
+        return None
+    return value.replace(tzinfo=None)
+
+
+def date_in_window(lost: LostItem, found: FoundItem, slack_days: float = DATE_SLACK_DAYS) -> bool:
+    date_found = _naive(found.date_found)
+    if date_found is None:
+        return True
+    slack = timedelta(days=slack_days)
+    date_from, date_to = _naive(lost.date_from), _naive(lost.date_to)
+    if date_from is not None and date_found < date_from - slack:
+        return False
+    if date_to is not None and date_found > date_to + slack:
+        return False
+    return True
+
+
+def min_distance_km(lost: LostItem, found: FoundItem) -> Optional[float]:
+    # None when either side has no coordinates, i.e. distance is unknown
+    if found.latitude is None or found.longitude is None:
+        return None
+    distances = [
+        haversine_km(loc.latitude, loc.longitude, found.latitude, found.longitude)
+        for loc in lost.locations
+        if loc.latitude is not None and loc.longitude is not None
+    ]
+    return min(distances) if distances else None
+
+
+# query narrows the pool further, e.g. to items not yet compared
+def found_candidate_pool(db: Session, lost_item: LostItem, query: Optional[Query] = None) -> List[FoundItem]:
+    if query is None:
+        query = db.query(FoundItem)
+    points = [
+        (loc.latitude, loc.longitude)
+        for loc in lost_item.locations
+        if loc.latitude is not None and loc.longitude is not None
+    ]
+    if not points:
+        return query.all()
+    return found_items_near_any(db, points, MAX_DISTANCE_KM, query)
+
+
+def lost_candidate_pool(db: Session, found_item: FoundItem, query: Optional[Query] = None) -> List[LostItem]:
+    if query is None:
+        query = db.query(LostItem)
+    if found_item.latitude is None or found_item.longitude is None:
+        return query.all()
+    nearby = lost_items_near(db, found_item.latitude, found_item.longitude, MAX_DISTANCE_KM, query)
+    # lost items without any location can't be ruled out by distance
+    unlocated = query.filter(~LostItem.locations.any()).all()
+    return nearby + unlocated
+
+
+# reorders the survivors, best first, before the top-K cut
+Ranker = Callable[[list], list]
+
+
+def _select(pairs, top_k: int, max_distance_km: float, slack_days: float, rank: Optional[Ranker]):
+    stats = PruneStats()
+    survivors = []
+    for lost, found, candidate in pairs:
+        stats.considered += 1
+        if not kinds_compatible(lost.kind, found.kind):
+            stats.pruned_kind += 1
+            continue
+        if not date_in_window(lost, found, slack_days):
+            stats.pruned_date += 1
+            continue
+        distance = min_distance_km(lost, found)
+        if distance is not None and distance > max_distance_km:
+            stats.pruned_distance += 1
+            continue
+        survivors.append((distance, candidate))
+
+    # nearest first; unknown distance goes last
+    survivors.sort(key=lambda s: (s[0] is None, s[0] or 0.0, -s[1].id))
+    ordered = [candidate for _, candidate in survivors]
+    if rank is not None:
+        ordered = rank(ordered)
+    selected = ordered[:top_k]
+    stats.pruned_top_k = len(survivors) - len(selected)
+    stats.selected = len(selected)
+    stats.record()
+    return selected, stats
+
+
+def select_found_candidates(
+    lost_item: LostItem,
+    found_items: List[FoundItem],
+    top_k: int = TOP_K,
+    max_distance_km: float = MAX_DISTANCE_KM,
+    slack_days: float = DATE_SLACK_DAYS,
+    rank: Optional[Ranker] = None,
+) -> Tuple[List[FoundItem], PruneStats]:
+    pairs = ((lost_item, found, found) for found in found_items)
+    return _select(pairs, top_k, max_distance_km, slack_days, rank)
+
+
+def select_lost_candidates(
+    found_item: FoundItem,
+    lost_items: List[LostItem],
+    top_k: int = TOP_K,
+    max_distance_km: float = MAX_DISTANCE_KM,
+    slack_days: float = DATE_SLACK_DAYS,
+    rank: Optional[Ranker] = None,
+) -> Tuple[List[LostItem], PruneStats]:
+    pairs = ((lost, found_item, lost) for lost in lost_items)
+    return _select(pairs, top_k, max_distance_km, slack_days, rank)
@@ -0,0 +1,272 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from logs import get_logger, log_sampled
+from models import FoundItem, ItemEmbedding, LostItem
+from sqlalchemy.orm import Session
+
+logger = get_logger(__name__)
+
+# 埋め込みによる一次マッチングの設定
+# "none" disables it, "hashing" is the deterministic CPU stub, "clip" uses sentence-transformers
+BACKEND = os.getenv("EMBEDDING_BACKEND", "none")
+CLIP_MODEL = os.getenv("EMBEDDING_CLIP_MODEL", "clip-ViT-B-32")
+HASHING_DIM = 256
+
+
+class HashingEmbedder:
+    # deterministic stand-in: hashed word/trigram counts for text and a colour
+    # histogram for images, kept in separate halves of the vector
+
+    name = "hashing"
+    dim = HASHING_DIM
+
+    def _normalize(self, vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def embed_texts(self, texts: Sequence[str]) -> np.ndarray:
+        half = self.dim // 2
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = re.findall(r"\w+", (text or "").lower())
+            features = words + [w[i:i + 3] for w in words for i in range(max(len(w) - 2, 0))]
+            for feature in features:
+                digest = hashlib.md5(feature.encode("utf-8")).digest()
+                vectors[row, int.from_bytes(digest[:4], "little") % half] += 1.0
+        return self._normalize(vectors)
+
+    def embed_images(self, paths: Sequence[str]) -> np.ndarray:
+        from PIL import Image
+
+        half = self.dim // 2
+        bins = round(half ** (1 / 3))  # per-channel bins so bins**3 fits the image half
+        vectors = np.zeros((len(paths), self.dim), dtype=np.float32)
+        for row, path in enumerate(paths):
+            with Image.open(path) as img:
+                pixels = np.asarray(img.convert("RGB").resize((64, 64)), dtype=np.int64)
+            quantized = pixels * bins // 256
+            cells = (quantized[..., 0] * bins + quantized[..., 1]) * bins + quantized[..., 2]
+            vectors[row, half:half + bins ** 3] = np.bincount(cells.ravel(), minlength=bins ** 3)
+        return self._normalize(vectors)
+
+
+class ClipEmbedder:
+    # text and images in one CLIP space, so a lost description can be compared with found photos
+
+    name = "clip"
+
+    def __init__(self, model_name: str = CLIP_MODEL):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed_texts(self, texts: Sequence[str]) -> np.ndarray:
+        return self.model.encode(list(texts), normalize_embeddings=True).astype(np.float32)
+
+    def embed_images(self, paths: Sequence[str]) -> np.ndarray:
+        from PIL import Image
+
+        images = []
+        for path in paths:
+            with Image.open(path) as img:
+                images.append(img.convert("RGB"))
+        return self.model.encode(images, normalize_embeddings=True).astype(np.float32)
+
+
+_embedder = None
+_embedder_failed = False
+_embedder_lock = threading.Lock()
+
+
+def get_embedder():
+    global _embedder, _embedder_failed
+    if BACKEND == "none" or _embedder_failed:
+        return None
+    with _embedder_lock:
+        if _embedder is None and not _embedder_failed:
+            try:
+                _embedder = ClipEmbedder() if BACKEND == "clip" else HashingEmbedder()
+            except ImportError as e:
+                # hashing vectors would rank nothing like the configured backend, so run without any
+                logger.error("EMBEDDING_BACKEND=%s can't be loaded, embeddings are off: %s", BACKEND, e)
+                _embedder_failed = True
+        return _embedder
+
+
+def _mean_vector(vectors: List[np.ndarray]) -> Optional[np.ndarray]:
+    if not vectors:
+        return None
+    mean = np.mean(np.vstack(vectors), axis=0)
+    norm = np.linalg.norm(mean)
+    return (mean / norm).astype(np.float32) if norm else None
+
+
+def _image_vectors(embedder, paths: List[str]) -> List[np.ndarray]:
+    vectors = []
+    for path in paths:
+        try:
+            vectors.append(embedder.embed_images([path])[0])
+        except Exception as e:
+            log_sampled(logger, logging.WARNING, "Failed to embed image '%s': %s", path, e)
+    return vectors
+
+
+def lost_item_vector(embedder, item: LostItem) -> Optional[np.ndarray]:
+    text = (item.details or "") + "\n" + (item.security_info or "")
+    paths = item.image_urls.split(',')[:1] if item.image_urls else []
+    return _mean_vector(list(embedder.embed_texts([text])) + _image_vectors(embedder, paths))
+
+
+def found_item_vector(embedder, item: FoundItem) -> Optional[np.ndarray]:
+    paths = item.image_urls.split(',') if item.image_urls else []
+    return _mean_vector(_image_vectors(embedder, paths))
+
+
+class VectorIndex:
+    # in-memory matrix of unit vectors for one item type; grows by doubling
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.matrix = np.zeros((0, dim), dtype=np.float32)
+        self.size = 0
+        self.positions: Dict[int, int] = {}
+        self.loaded_up_to = 0  # highest item_embeddings.id read from the DB
+
+    def add(self, item_id: int, vector: np.ndarray):
+        if item_id in self.positions:
+            self.matrix[self.positions[item_id]] = vector
+            return
+        if self.size == len(self.ids):
+            capacity = max(16, 2 * len(self.ids))
+            self.ids = np.resize(self.ids, capacity)
+            matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+            matrix[:self.size] = self.matrix[:self.size]
+            self.matrix = matrix
+        self.ids[self.size] = item_id
+        self.matrix[self.size] = vector
+        self.positions[item_id] = self.size
+        self.size += 1
+
+    def get(self, item_id: int) -> Optional[np.ndarray]:
+        position = self.positions.get(item_id)
+        return None if position is None else self.matrix[position]
+
+    # top k (item_id, cosine similarity), optionally restricted to allowed_ids
+    def search(self, query: np.ndarray, k: int, allowed_ids: Optional[Sequence[int]] = None) -> List[Tuple[int, float]]:
+        if allowed_ids is not None:
+            positions = np.array([self.positions[i] for i in allowed_ids if i in self.positions], dtype=np.int64)
+        else:
+            positions = np.arange(self.size)
+        if len(positions) == 0:
+            return []
+        similarities = self.matrix[positions] @ query
+        # stable: ties keep the order of allowed_ids (the caller's distance order), so the same
+        # candidates reach the matcher on every run
+        top = np.argsort(-similarities, kind="stable")[:k]
+        return [(int(self.ids[positions[i]]), float(similarities[i])) for i in top]
+
+
+_indexes: Dict[str, VectorIndex] = {}
+_index_lock = threading.Lock()
+
+
+# the index for "lost" or "found" items, topped up with rows written by other processes
+def get_index(db: Session, item_type: str) -> Optional[VectorIndex]:
+    embedder = get_embedder()
+    if embedder is None:
+        return None
+    with _index_lock:
+        index = _indexes.get(item_type)
+        if index is None:
+            index = _indexes[item_type] = VectorIndex(embedder.dim)
+        rows = (
+            db.query(ItemEmbedding)
+            .filter(
+                ItemEmbedding.item_type == item_type,
+                ItemEmbedding.backend == embedder.name,
+                ItemEmbedding.id > index.loaded_up_to,
+            )
+            .order_by(ItemEmbedding.id)
+            .all()
+        )
+        for row in rows:
+            index.add(row.item_id, np.frombuffer(row.vector, dtype=np.float32))
+            index.loaded_up_to = row.id
+        return index
+
+
+# the unsaved embedding row for one item (CPU only, no DB access), or None
+def item_embedding(item_type: str, item) -> Optional[ItemEmbedding]:
+    embedder = get_embedder()
+    if embedder is None:
+        return None
+    vector = lost_item_vector(embedder, item) if item_type == "lost" else found_item_vector(embedder, item)
+    if vector is None:
+        return None
+    return ItemEmbedding(
+        item_type=item_type,
+        item_id=item.id,
+        backend=embedder.name,
+        dim=embedder.dim,
+        vector=vector.tobytes(),
+    )
+
+
+# compute and store the vector for one item, replacing any earlier one
+def embed_item(db: Session, item_type: str, item) -> Optional[np.ndarray]:
+    row = item_embedding(item_type, item)
+    if row is None:
+        return None
+    existing = (
+        db.query(ItemEmbedding)
+        .filter_by(item_type=item_type, item_id=item.id, backend=row.backend)
+        .first()
+    )
+    if existing is not None:
+        db.delete(existing)
+        db.flush()
+    db.add(row)
+    db.commit()
+    return np.frombuffer(row.vector, dtype=np.float32)
+
+
+def _rank(db: Session, query_type: str, query_item, candidate_type: str, candidates: list) -> list:
+    if not candidates:
+        return candidates
+    query_index = get_index(db, query_type)
+    if query_index is None:
+        return candidates
+    query = query_index.get(query_item.id)
+    if query is None:
+        query = embed_item(db, query_type, query_item)
+    if query is None:
+        return candidates
+
+    if not np.any(query):
+        return candidates  # nothing to compare, e.g. a text-only item against the image half
+
+    index = get_index(db, candidate_type)
+    by_id = {c.id: c for c in candidates}
+    results = index.search(query, len(candidates), list(by_id))
+    if len({similarity for _, similarity in results}) <= 1:
+        return candidates  # no signal, so the distance order stands
+    ranked = [by_id[item_id] for item_id, _ in results]
+    ranked_ids = {c.id for c in ranked}
+    # candidates without a vector keep their original (distance) order after the ranked ones
+    return ranked + [c for c in candidates if c.id not in ranked_ids]
+
+
+def rank_found_candidates(db: Session, lost_item: LostItem, found_items: List[FoundItem]) -> List[FoundItem]:
+    return _rank(db, "lost", lost_item, "found", found_items)
+
+
+def rank_lost_candidates(db: Session, found_item: FoundItem, lost_items: List[LostItem]) -> List[LostItem]:
+    return _rank(db, "found", found_item, "lost", lost_items)
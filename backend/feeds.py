@@ -0,0 +1,212 @@
+import os
+import random
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException
+from models import FoundItem, ItemImage, LostItem, LostItemLocation, MatchScore
+from sqlalchemy import and_, exists, func, or_, select
+from sqlalchemy.orm import Query, Session
+
+MAX_LIMIT = 100
+MAX_RADIUS_KM = 50.0  # for ?near= searches
+# matches strictly above this score are shown to the owner
+MATCH_SCORE_THRESHOLD = float(os.getenv("MATCH_SCORE_THRESHOLD", "3"))
+
+
+def clamp_limit(limit: Optional[int], default: int) -> int:
+    if limit is None:
+        return default
+    return max(1, min(limit, MAX_LIMIT))
+
+
+# "min_lon,min_lat,max_lon,max_lat" (GeoJSON order)
+def parse_bbox(bbox: Optional[str]) -> Optional[Tuple[float, float, float, float]]:
+    if not bbox:
+        return None
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(v) for v in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be 'min_lon,min_lat,max_lon,max_lat'")
+    return min_lon, min_lat, max_lon, max_lat
+
+
+# an empty cursor means "first page"; anything else must be an item id
+def parse_cursor(cursor: str) -> Optional[int]:
+    if cursor == "":
+        return None
+    try:
+        return int(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="cursor must be an item id")
+
+
+def _first_location(column):
+    return (
+        select(column)
+        .where(LostItemLocation.item_id == LostItem.id)
+        .order_by(LostItemLocation.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+
+
+# thumbnail of the primary image (the original when it has none), an index seek on item_images
+def primary_image(item_type: str, id_column):
+    return (
+        select(func.coalesce(ItemImage.thumbnail_path, ItemImage.path))
+        .where(ItemImage.item_type == item_type, ItemImage.item_id == id_column, ItemImage.ordinal == 0)
+        .scalar_subquery()
+        .label("image_url")
+    )
+
+
+# claimed and expired items are neither listed nor matched
+def is_open(model):
+    return model.status == "open"
+
+
+# only the columns the list endpoints return, with the first location as two subqueries
+def lost_item_feed(db: Session, bbox=None) -> Query:
+    query = db.query(
+        LostItem.id,
+        _first_location(LostItemLocation.latitude).label("latitude"),
+        _first_location(LostItemLocation.longitude).label("longitude"),
+        LostItem.details,
+        LostItem.security_info,
+        primary_image("lost", LostItem.id),
+    ).filter(is_open(LostItem))
+    if bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        query = query.filter(exists().where(and_(
+            LostItemLocation.item_id == LostItem.id,
+            LostItemLocation.latitude.between(min_lat, max_lat),
+            LostItemLocation.longitude.between(min_lon, max_lon),
+        )))
+    return query
+
+
+def found_item_feed(db: Session, bbox=None) -> Query:
+    query = db.query(
+        FoundItem.id,
+        FoundItem.latitude,
+        FoundItem.longitude,
+        FoundItem.location_notes,
+        primary_image("found", FoundItem.id),
+    ).filter(is_open(FoundItem))
+    if bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        query = query.filter(
+            FoundItem.latitude.between(min_lat, max_lat),
+            FoundItem.longitude.between(min_lon, max_lon),
+        )
+    return query
+
+
+def keyset_page(query: Query, id_column, cursor: Optional[int], limit: int) -> Tuple[list, Optional[int]]:
+    # newest first; the next cursor is the last id returned, or None on the last page
+    if cursor is not None:
+        query = query.filter(id_column < cursor)
+    rows = query.order_by(id_column.desc()).limit(limit + 1).all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def random_sample(db: Session, query: Query, id_column, limit: int) -> list:
+    # probe random points in the id range with index seeks instead of loading the table
+    low, high = db.query(func.min(id_column), func.max(id_column)).one()
+    if low is None:
+        return []
+    rows = {}
+    for _ in range(limit * 3):
+        if len(rows) >= limit:
+            break
+        probe = random.randint(low, high)
+        row = query.filter(id_column >= probe).order_by(id_column).limit(1).first()
+        if row is None:
+            row = query.filter(id_column < probe).order_by(id_column.desc()).limit(1).first()
+        if row is None:
+            break  # nothing matches the filters at all
+        rows[row.id] = row
+    return list(rows.values())
+
+
+# "score:item_id" of the last row of the previous page
+def parse_match_cursor(cursor: Optional[str]) -> Optional[Tuple[float, int]]:
+    if not cursor:
+        return None
+    try:
+        score, found_item_id = cursor.split(":")
+        return float(score), int(found_item_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="cursor must be 'score:item_id'")
+
+
+# what the matched-item endpoints show of the other side
+def found_match_columns() -> list:
+    return [
+        FoundItem.id,
+        FoundItem.latitude,
+        FoundItem.longitude,
+        FoundItem.location_notes,
+        primary_image("found", FoundItem.id),
+    ]
+
+
+# no security_info: these rows are shown to finders
+def lost_match_columns() -> list:
+    return [
+        LostItem.id,
+        _first_location(LostItemLocation.latitude).label("latitude"),
+        _first_location(LostItemLocation.longitude).label("longitude"),
+        LostItem.details,
+        primary_image("lost", LostItem.id),
+    ]
+
+
+# best score first, newest other item first within a score
+def score_page(query: Query, score_column, other_id_column, cursor: Optional[Tuple[float, int]],
+               limit: int) -> Tuple[list, Optional[str]]:
+    if cursor is not None:
+        score, other_id = cursor
+        query = query.filter(or_(
+            score_column < score,
+            and_(score_column == score, other_id_column < other_id),
+        ))
+    rows = query.order_by(score_column.desc(), other_id_column.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = f"{last.score:g}:{last.id}"
+    return rows[:limit], next_cursor
+
+
+def matched_found_page(
+    db: Session,
+    lost_item_id: int,
+    threshold: float,
+    cursor: Optional[Tuple[float, int]],
+    limit: int,
+) -> Tuple[list, Optional[str]]:
+    query = (
+        db.query(*found_match_columns(), MatchScore.score)
+        .select_from(MatchScore)
+        .join(FoundItem, FoundItem.id == MatchScore.found_item_id)
+        .filter(MatchScore.lost_item_id == lost_item_id, MatchScore.score > threshold, is_open(FoundItem))
+    )
+    return score_page(query, MatchScore.score, MatchScore.found_item_id, cursor, limit)
+
+
+def matched_lost_page(
+    db: Session,
+    found_item_id: int,
+    threshold: float,
+    cursor: Optional[Tuple[float, int]],
+    limit: int,
+) -> Tuple[list, Optional[str]]:
+    query = (
+        db.query(*lost_match_columns(), MatchScore.score)
+        .select_from(MatchScore)
+        .join(LostItem, LostItem.id == MatchScore.lost_item_id)
+        .filter(MatchScore.found_item_id == found_item_id, MatchScore.score > threshold, is_open(LostItem))
+    )
+    return score_page(query, MatchScore.score, MatchScore.lost_item_id, cursor, limit)
@@ -0,0 +1,52 @@
+import math
+import os
+from typing import List, Optional
+
+EARTH_RADIUS_KM = 6371.0
+
+# グリッドセルの大きさ（度）。0.01度 ≒ 1.1km
+CELL_DEG = float(os.getenv("GEO_CELL_DEG", "0.01"))
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return EARTH_RADIUS_KM * 2 * math.asin(math.sqrt(a))
+
+
+def _cell_index(value: float) -> int:
+    return math.floor(value / CELL_DEG)
+
+
+def geocell(latitude: Optional[float], longitude: Optional[float]) -> Optional[str]:
+    if latitude is None or longitude is None:
+        return None
+    return f"{_cell_index(latitude)}:{_cell_index(longitude)}"
+
+
+def bounding_box(latitude: float, longitude: float, radius_km: float):
+    # (min_lat, max_lat, min_lon, max_lon) enclosing the radius
+    d_lat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    cos_lat = max(math.cos(math.radians(latitude)), 1e-6)
+    d_lon = min(math.degrees(radius_km / (EARTH_RADIUS_KM * cos_lat)), 180.0)
+    return latitude - d_lat, latitude + d_lat, longitude - d_lon, longitude + d_lon
+
+
+# how many cells cells_within would return, without building the list
+def cell_count(latitude: float, longitude: float, radius_km: float) -> int:
+    min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_km)
+    rows = _cell_index(max_lat) - _cell_index(min_lat) + 1
+    columns = _cell_index(max_lon) - _cell_index(min_lon) + 1
+    return rows * columns
+
+
+def cells_within(latitude: float, longitude: float, radius_km: float) -> List[str]:
+    min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_km)
+    return [
+        f"{i}:{j}"
+        for i in range(_cell_index(min_lat), _cell_index(max_lat) + 1)
+        for j in range(_cell_index(min_lon), _cell_index(max_lon) + 1)
+    ]
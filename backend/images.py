@@ -0,0 +1,210 @@
+import base64
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+from logs import get_logger, log_sampled
+from metrics import timed
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow がない場合は元画像をそのまま使う
+    Image = None
+
+logger = get_logger(__name__)
+
+# 画像前処理の設定
+# gpt-4o scales images to fit 768px on the short side, so anything larger only costs upload time
+MAX_SIDE = int(os.getenv("VISION_IMAGE_MAX_SIDE", "768"))
+JPEG_QUALITY = int(os.getenv("VISION_IMAGE_QUALITY", "80"))
+DERIVED_DIR = os.getenv("VISION_IMAGE_DIR", "uploads/derived")
+CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# 表示用サムネイル: served from uploads/v/<sha256>-<variant><side>.jpg, so a URL never changes content
+VARIANT_DIR = "uploads/v"
+VARIANTS = {
+    "thumb": int(os.getenv("IMAGE_THUMB_SIDE", "320")),
+    "medium": int(os.getenv("IMAGE_MEDIUM_SIDE", "1024")),
+}
+VARIANT_NAME = re.compile(r"([0-9a-f]{64})-([a-z]+)(\d+)\.jpg")
+
+
+def derived_path(image_path: str) -> str:
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(DERIVED_DIR, f"{stem}.jpg")
+
+
+def _is_fresh(derived: str, original: str) -> bool:
+    return os.path.exists(derived) and os.path.getmtime(derived) >= os.path.getmtime(original)
+
+
+def _write_downscaled(image_path: str, dest: str, max_side: int):
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with Image.open(image_path) as img:
+        img = ImageOps.exif_transpose(img)  # bake in the rotation before EXIF is dropped
+        img = img.convert("RGB")
+        img.thumbnail((max_side, max_side))
+        tmp_path = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"  # concurrent callers may race on one image
+        img.save(tmp_path, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    os.replace(tmp_path, dest)
+
+
+# write a downscaled, EXIF-free JPEG next to the upload and return its path
+def prepare_image(image_path: str) -> str:
+    if Image is None:
+        return image_path
+    derived = derived_path(image_path)
+    if _is_fresh(derived, image_path):
+        return derived
+    _write_downscaled(image_path, derived, MAX_SIDE)
+    return derived
+
+
+def variant_path(content_hash: str, variant: str) -> str:
+    return f"{VARIANT_DIR}/{content_hash}-{variant}{VARIANTS[variant]}.jpg"
+
+
+# (content_hash, variant) for a current variant file name, None for anything else
+def parse_variant_name(name: str) -> Optional[tuple]:
+    match = VARIANT_NAME.fullmatch(name)
+    if match is None:
+        return None
+    content_hash, variant, side = match.groups()
+    if VARIANTS.get(variant) != int(side):
+        return None  # a size we no longer (or never did) produce
+    return content_hash, variant
+
+
+# the display-size JPEG for one original; content never changes for a given name, so existing files are reused
+def make_variant(image_path: str, content_hash: str, variant: str) -> Optional[str]:
+    if Image is None:
+        return None
+    dest = variant_path(content_hash, variant)
+    if not os.path.exists(dest):
+        _write_downscaled(image_path, dest, VARIANTS[variant])
+    return dest
+
+
+def prepare_images(image_paths: List[str]):
+    for path in image_paths:
+        try:
+            prepare_image(path)
+        except Exception as e:
+            log_sampled(logger, logging.WARNING, "Failed to preprocess image '%s': %s", path, e)
+
+
+# uploads (and their derivatives) are named by the sha256 of the original
+def hash_from_path(image_path: str) -> Optional[str]:
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    return stem if re.fullmatch(r"[0-9a-f]{64}", stem) else None
+
+
+# strong ETag for files whose name is derived from their content (originals and variants), else None
+def content_etag(image_path: str) -> Optional[str]:
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    if hash_from_path(image_path) is not None or parse_variant_name(os.path.basename(image_path)) is not None:
+        return f'"{stem}"'
+    return None
+
+
+def file_hash(image_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(image_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# metadata for an item_images row; prepares the vision derivative on the way
+def describe_image(image_path: str) -> dict:
+    info = {"path": image_path, "content_hash": None, "byte_size": None, "width": None, "height": None,
+            "derived_path": None, "thumbnail_path": None, "medium_path": None}
+    if not os.path.exists(image_path):
+        log_sampled(logger, logging.WARNING, "Image '%s' is missing; recording the path only", image_path)
+        return info
+    info["byte_size"] = os.path.getsize(image_path)
+    info["content_hash"] = hash_from_path(image_path) or file_hash(image_path)
+    if Image is None:
+        return info
+    try:
+        with Image.open(image_path) as img:
+            img = ImageOps.exif_transpose(img)
+            info["width"], info["height"] = img.size
+        info["derived_path"] = prepare_image(image_path)
+        info["thumbnail_path"] = make_variant(image_path, info["content_hash"], "thumb")
+        info["medium_path"] = make_variant(image_path, info["content_hash"], "medium")
+    except Exception as e:
+        log_sampled(logger, logging.WARNING, "Failed to preprocess image '%s': %s", image_path, e)
+    return info
+
+
+def describe_images(image_paths: List[str]) -> List[dict]:
+    return [describe_image(path) for path in image_paths]
+
+
+class PayloadCache:
+    # LRU of base64 payloads, bounded by total encoded size
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[tuple, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[str]:
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def put(self, key: tuple, payload: str):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = payload
+            self.size += len(payload)
+            while self.size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+payload_cache = PayloadCache()
+
+
+# base64 of the vision-sized derivative, created on first use for images uploaded before preprocessing existed
+@timed("encode_image")
+def encode_image(image_path: str) -> str:
+    # content-addressed images are keyed by hash, so a hit skips the filesystem entirely
+    content_hash = hash_from_path(image_path)
+    if content_hash is not None:
+        key = ("sha256", content_hash)
+        payload = payload_cache.get(key)
+        if payload is not None:
+            return payload
+
+    try:
+        path = prepare_image(image_path)
+    except Exception as e:
+        log_sampled(logger, logging.WARNING, "Failed to preprocess image '%s', sending original: %s", image_path, e)
+        path = image_path
+
+    if content_hash is None:
+        key = (path, os.path.getmtime(path))
+        payload = payload_cache.get(key)
+        if payload is not None:
+            return payload
+
+    with open(path, "rb") as image_file:
+        payload = base64.b64encode(image_file.read()).decode("utf-8")
+    payload_cache.put(key, payload)
+    return payload
@@ -0,0 +1,74 @@
+from typing import Dict, List, Optional, Sequence
+
+from images import describe_images, variant_path
+from logs import get_logger
+from models import FoundItem, ItemImage, LostItem
+from sqlalchemy import exists, func
+from sqlalchemy.orm import Session
+
+logger = get_logger(__name__)
+
+
+def item_image_rows(item_type: str, item_id: int, described: List[dict]) -> List[ItemImage]:
+    return [
+        ItemImage(item_type=item_type, item_id=item_id, ordinal=ordinal, **info)
+        for ordinal, info in enumerate(described)
+    ]
+
+
+# image paths per item in upload order, for many items in one query
+def image_paths_by_item(db: Session, item_type: str, item_ids: Sequence[int]) -> Dict[int, List[str]]:
+    paths: Dict[int, List[str]] = {item_id: [] for item_id in item_ids}
+    if not paths:
+        return paths
+    rows = (
+        db.query(ItemImage.item_id, ItemImage.path)
+        .filter(ItemImage.item_type == item_type, ItemImage.item_id.in_(list(paths)))
+        .order_by(ItemImage.item_id, ItemImage.ordinal)
+    )
+    for item_id, path in rows:
+        paths[item_id].append(path)
+    return paths
+
+
+# thumbnail (or the original when there is none) of each item's first image
+def primary_image_paths(db: Session, item_type: str, item_ids: Sequence[int]) -> Dict[int, str]:
+    if not item_ids:
+        return {}
+    rows = db.query(ItemImage.item_id, func.coalesce(ItemImage.thumbnail_path, ItemImage.path)).filter(
+        ItemImage.item_type == item_type,
+        ItemImage.item_id.in_(list(item_ids)),
+        ItemImage.ordinal == 0,
+    )
+    return {item_id: path for item_id, path in rows}
+
+
+def original_path_for_hash(db: Session, content_hash: str) -> Optional[str]:
+    row = db.query(ItemImage.path).filter(ItemImage.content_hash == content_hash).first()
+    return row.path if row else None
+
+
+# one-off migration from the comma-joined image_urls columns
+def backfill_item_images(db: Session):
+    for item_type, model in (("lost", LostItem), ("found", FoundItem)):
+        items = db.query(model.id, model.image_urls).filter(
+            model.image_urls.isnot(None),
+            model.image_urls != "",
+            ~exists().where(ItemImage.item_type == item_type, ItemImage.item_id == model.id),
+        ).all()
+        for item_id, image_urls in items:
+            db.add_all(item_image_rows(item_type, item_id, describe_images(image_urls.split(','))))
+        if items:
+            logger.info("Backfilled item_images for %d %s rows", len(items), model.__tablename__)
+    db.commit()
+
+
+# point rows from before display variants at their URLs; the files are rendered on first request
+def backfill_variant_paths(db: Session):
+    rows = db.query(ItemImage).filter(ItemImage.content_hash.isnot(None), ItemImage.thumbnail_path.is_(None)).all()
+    for row in rows:
+        row.thumbnail_path = variant_path(row.content_hash, "thumb")
+        row.medium_path = variant_path(row.content_hash, "medium")
+    if rows:
+        logger.info("Backfilled variant paths for %d item_images rows", len(rows))
+    db.commit()
@@ -0,0 +1,157 @@
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from match_engine import JobProgress
+from models import MatchJob
+from sqlalchemy import and_, or_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+LEASE_SECONDS = int(os.getenv("MATCH_JOB_LEASE_SECONDS", "600"))
+MAX_ATTEMPTS = int(os.getenv("MATCH_JOB_MAX_ATTEMPTS", "3"))
+
+
+# the API side: enqueue and poll from the endpoints' async sessions
+async def enqueue_match_job(db: AsyncSession, item_type: str, item_id: int) -> MatchJob:
+    job = MatchJob(item_type=item_type, item_id=item_id, status="queued")
+    db.add(job)
+    await db.commit()
+    await db.refresh(job)
+    return job
+
+
+# the sync side (bulk import): the job joins the caller's transaction
+def queue_match_job(db: Session, item_type: str, item_id: int) -> MatchJob:
+    job = MatchJob(item_type=item_type, item_id=item_id, status="queued")
+    db.add(job)
+    return job
+
+
+async def get_match_job(db: AsyncSession, job_id: int) -> Optional[MatchJob]:
+    return await db.get(MatchJob, job_id)
+
+
+def job_status(job: MatchJob) -> dict:
+    return {
+        "id": job.id,
+        "item_type": job.item_type,
+        "item_id": job.item_id,
+        "status": job.status,
+        "attempts": job.attempts,
+        "total": job.total,
+        "done": job.done,
+        "failed": job.failed,
+        "error": job.error,
+        "created_at": job.created_at,
+        "updated_at": job.updated_at,
+    }
+
+
+def _lease_expired(now: datetime):
+    return and_(MatchJob.status == "running", MatchJob.lease_expires_at < now)
+
+
+def _claimable(now: datetime):
+    # queued jobs, plus running jobs whose worker let the lease expire (crashed or hung), until
+    # MAX_ATTEMPTS: a job that takes its worker down every time must not be retried forever
+    return or_(
+        MatchJob.status == "queued",
+        and_(_lease_expired(now), MatchJob.attempts < MAX_ATTEMPTS),
+    )
+
+
+def _claim(db: Session, job_id: int, worker_id: str, now: datetime) -> bool:
+    # compare-and-set so two workers never claim the same job
+    result = db.execute(
+        update(MatchJob)
+        .where(MatchJob.id == job_id, _claimable(now))
+        .values(
+            status="running",
+            lease_owner=worker_id,
+            lease_expires_at=now + timedelta(seconds=LEASE_SECONDS),
+            attempts=MatchJob.attempts + 1,
+            updated_at=now,
+        )
+    )
+    return result.rowcount == 1
+
+
+def claim_jobs(db: Session, worker_id: str, batch_size: int) -> List[MatchJob]:
+    now = datetime.utcnow()
+    db.execute(
+        update(MatchJob)
+        .where(_lease_expired(now), MatchJob.attempts >= MAX_ATTEMPTS)
+        .values(status="failed", lease_owner=None, lease_expires_at=None,
+                error="lease expired on every attempt", updated_at=now)
+    )
+    candidate_ids = [
+        job_id
+        for (job_id,) in db.query(MatchJob.id)
+        .filter(_claimable(now))
+        .order_by(MatchJob.id)
+        .limit(batch_size)
+    ]
+
+    claimed = [job_id for job_id in candidate_ids if _claim(db, job_id, worker_id, now)]
+    db.commit()
+
+    if not claimed:
+        return []
+    return db.query(MatchJob).filter(MatchJob.id.in_(claimed)).order_by(MatchJob.id).all()
+
+
+# one particular job, e.g. for a CLI that runs it itself; None if a worker already has it
+def claim_job(db: Session, job_id: int, worker_id: str) -> Optional[MatchJob]:
+    claimed = _claim(db, job_id, worker_id, datetime.utcnow())
+    db.commit()
+    return db.get(MatchJob, job_id) if claimed else None
+
+
+# right before a claimed job starts: the rest of a batch waits while earlier jobs run, and its
+# leases may have expired and gone to another worker meanwhile. False if this worker lost it
+def renew_lease(db: Session, job_id: int, worker_id: str) -> bool:
+    now = datetime.utcnow()
+    result = db.execute(
+        update(MatchJob)
+        .where(MatchJob.id == job_id, MatchJob.status == "running", MatchJob.lease_owner == worker_id)
+        .values(lease_expires_at=now + timedelta(seconds=LEASE_SECONDS), updated_at=now)
+    )
+    db.commit()
+    return result.rowcount == 1
+
+
+def record_progress(db: Session, job: MatchJob, progress: JobProgress):
+    # also renews the lease, since a job that reports progress is still alive
+    job.total = progress.total
+    job.done = progress.done
+    job.failed = progress.failed
+    job.lease_expires_at = datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)
+    db.commit()
+
+
+def complete_job(db: Session, job: MatchJob):
+    job.status = "done"
+    job.lease_owner = None
+    job.lease_expires_at = None
+    job.error = None
+    db.commit()
+
+
+def release_job(db: Session, job: MatchJob, error: str):
+    # hand the job back without using up an attempt (the failure wasn't the job's fault)
+    job.status = "queued"
+    job.attempts = max(0, (job.attempts or 0) - 1)
+    job.lease_owner = None
+    job.lease_expires_at = None
+    job.error = error
+    db.commit()
+
+
+def fail_job(db: Session, job: MatchJob, error: str):
+    # requeue until MAX_ATTEMPTS, then give up
+    job.status = "queued" if job.attempts < MAX_ATTEMPTS else "failed"
+    job.lease_owner = None
+    job.lease_expires_at = None
+    job.error = error
+    db.commit()
@@ -0,0 +1,23 @@
+import logging
+import os
+import random
+
+# ログ設定: LOG_LEVEL=DEBUG shows every per-pair line, otherwise they are sampled at LOG_SAMPLE_RATE
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+# httpx logs every OpenAI request at INFO; those are counted in metrics instead
+logging.getLogger("httpx").setLevel(max(logging.WARNING, logging.getLogger().level))
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(name)
+
+
+# for lines logged once per pair or per call: every one when DEBUG is on, otherwise a sample
+def log_sampled(logger: logging.Logger, level: int, msg: str, *args, rate: float = LOG_SAMPLE_RATE):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.log(level, msg, *args)
+    elif logger.isEnabledFor(level) and random.random() < rate:
+        logger.log(level, msg + " (sampled)", *args)
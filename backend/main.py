@@ -1,31 +1,44 @@
-# import logging
+import json
 import os
-import random
-import shutil
-import sys
 from datetime import datetime
 from typing import List, Optional
 
-import openai
 from dotenv import load_dotenv
 from pydantic import BaseModel
-from security_questions import SECURITY_QUESTIONS
 
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
 
-from database import Base, SessionLocal, engine
-from fastapi import (BackgroundTasks, Depends, FastAPI, File, Form, Request,
-                     UploadFile)
+from bulk_import import ManifestError, import_found_items
+from database import AsyncSessionLocal, Base, SessionLocal, engine
+from embeddings import item_embedding
+from fastapi import (Depends, FastAPI, File, Form, HTTPException, Query,
+                     Request, Response, UploadFile, WebSocket,
+                     WebSocketDisconnect)
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from match import get_match_score
+from fastapi.responses import StreamingResponse
+from feeds import (MATCH_SCORE_THRESHOLD, MAX_RADIUS_KM, clamp_limit,
+                   found_item_feed, is_open, keyset_page, lost_item_feed,
+                   parse_bbox, parse_cursor, parse_match_cursor, random_sample)
+from images import describe_images
+from item_images import item_image_rows, primary_image_paths
+from jobs import enqueue_match_job, get_match_job, job_status
+from logs import get_logger
+from match_events import KEEPALIVE_SECONDS, broker as match_broker
+from metrics import render_metrics, timed
 from models import FoundItem, LostItem, LostItemLocation, MatchScore
+from questions import question_filter
+from retention import STATUSES, set_item_status
+from scripts.migrate_db import migrate_database
 from scripts.reset_db import reset_database
+from spatial import found_items_within
+from storage import (MAX_BULK_REQUEST_BYTES, UploadLimitMiddleware,
+                     UploadStaticFiles, save_uploads)
+from top_matches import matched_found_items, matched_lost_items
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-# logger = logging.getLogger(__name__)
-# logger.info("logging started!")
+logger = get_logger("api")
 
 app = FastAPI()
 
@@ -38,14 +51,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+app.add_middleware(UploadLimitMiddleware, path_limits={"/api/found-items/bulk": MAX_BULK_REQUEST_BYTES})
+
+os.makedirs("uploads", exist_ok=True)
+app.mount("/uploads", UploadStaticFiles(directory="uploads"), name="uploads")
 
 # DB初期化
 # reset_database() # delete all existing tables and create new ones
-Base.metadata.create_all(bind=engine)
+migrate_database() # create new tables and add new columns/indexes to existing ones
 
 # DBセッション依存性
-def get_db():
+# async endpoints await their queries on the async session
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# plain `def` endpoints run in the threadpool, so the sync session doesn't block the event loop
+def get_sync_db():
     db = SessionLocal()
     try:
         yield db
@@ -61,24 +83,18 @@ async def register_lost_item(
     date_from: str = Form(...),
     date_to: str = Form(...),
     location_notes: str = Form(""),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     
-    print("Lost item posted")
+    logger.info("Lost item posted")
 
     form_data = await request.form()
     # print("Received fields:", form_data.keys())
 
-    # 画像保存
-    os.makedirs("uploads", exist_ok=True)
-    saved_paths = []
-
-
-    for img in images:
-        file_path = f"uploads/{img.filename}"
-        with open(file_path, "wb") as f:
-            shutil.copyfileobj(img.file, f)
-        saved_paths.append(file_path)
+    # 画像保存（内容ハッシュ名で重複排除）
+    saved_paths = await save_uploads(images)
+    with timed("image_prepare"):
+        described = await run_in_threadpool(describe_images, saved_paths) # metadata + downscale for the vision model
 
     # 📌 Construct security info string
     security_lines = []
@@ -104,8 +120,8 @@ async def register_lost_item(
         security_info=security_info_text
     )
     db.add(lost_item)
-    db.commit()
-    db.refresh(lost_item)
+    await db.flush()  # assigns lost_item.id
+    db.add_all(item_image_rows("lost", lost_item.id, described))
 
     # Save locations
     index = 0
@@ -142,50 +158,73 @@ async def register_lost_item(
 
     # Append quiz to details
 
-    db.commit()
-
-    match_lost_item(lost_item, db) # run matching algorithm
-
-    return {"message": "登録完了", "item_id": lost_item.id}
-
-
+    with timed("db_commit"):
+        await db.commit()
+
+    with timed("embed"):
+        embedding = await run_in_threadpool(item_embedding, "lost", lost_item) # vector for the first-pass matcher
+    if embedding is not None:
+        db.add(embedding)
+    with timed("db_commit"):
+        job = await enqueue_match_job(db, "lost", lost_item.id) # matching runs in the worker process
+
+    return {"message": "登録完了", "item_id": lost_item.id, "job_id": job.id}
+
+
+def lost_item_row(item):
+    return {
+        "id": item.id,
+        "latitude": item.latitude,
+        "longitude": item.longitude,
+        "details": item.details,
+        "security_info": item.security_info,
+        "image_url": item.image_url,
+    }
+
+def found_item_row(item, image_url):
+    return {
+        "id": item.id,
+        "latitude": item.latitude,
+        "longitude": item.longitude,
+        "location_notes": item.location_notes,
+        "image_url": image_url,
+    }
+
+# without cursor: a random sample (3 by default) for the map
+# with cursor (empty for the first page): newest first, next page id in X-Next-Cursor
 @app.get("/api/lost-items")
-def get_lost_items(db: Session = Depends(get_db)):
-    items = db.query(LostItem).all()
-    random_items = random.sample(items, min(3, len(items)))
-    return [
-        {
-            "id": item.id,
-            "latitude": item.locations[0].latitude if item.locations else None,
-            "longitude": item.locations[0].longitude if item.locations else None,
-            "details": item.details,
-            "security_info": item.security_info,
-            "image_url": item.image_urls.split(',')[0] if item.image_urls else None,
-        }
-        for item in random_items
-    ]
+def get_lost_items(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    bbox: Optional[str] = None,  # "min_lon,min_lat,max_lon,max_lat"
+    db: Session = Depends(get_sync_db)
+):
+    query = lost_item_feed(db, parse_bbox(bbox))
+    if cursor is None:
+        items = random_sample(db, query, LostItem.id, clamp_limit(limit, 3))
+    else:
+        items, next_cursor = keyset_page(query, LostItem.id, parse_cursor(cursor), clamp_limit(limit, 20))
+        if next_cursor is not None:
+            response.headers["X-Next-Cursor"] = str(next_cursor)
+    return [lost_item_row(item) for item in items]
 
 @app.post("/api/found-items")
 async def register_found_item(
-    background_tasks: BackgroundTasks,
     images: List[UploadFile] = File(...),
     kind: str = Form(...),
     date_found: str = Form(...),
     latitude: float = Form(...),
     longitude: float = Form(...),
     location_notes: str = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     
-    print("Found item posted")
-    # 画像保存
-    os.makedirs("uploads", exist_ok=True)
-    saved_paths = []
-    for img in images:
-        file_path = f"uploads/{img.filename}"
-        with open(file_path, "wb") as f:
-            shutil.copyfileobj(img.file, f)
-        saved_paths.append(file_path)
+    logger.info("Found item posted")
+    # 画像保存（内容ハッシュ名で重複排除）
+    saved_paths = await save_uploads(images)
+    with timed("image_prepare"):
+        described = await run_in_threadpool(describe_images, saved_paths) # metadata + downscale for the vision model
 
     # データベース登録
     found_item = FoundItem(
@@ -197,127 +236,207 @@ async def register_found_item(
         image_urls=",".join(saved_paths)
     )
     db.add(found_item)
-    db.commit()
-    db.refresh(found_item)
-
-    background_tasks.add_task(match_found_item_safe, found_item.id) # run matching algorithm slowly
-
-    return {"message": "登録完了", "item_id": found_item.id}
+    await db.flush()  # assigns found_item.id
+    db.add_all(item_image_rows("found", found_item.id, described))
+    with timed("db_commit"):
+        await db.commit()
+
+    with timed("embed"):
+        embedding = await run_in_threadpool(item_embedding, "found", found_item) # vector for the first-pass matcher
+    if embedding is not None:
+        db.add(embedding)
+    with timed("db_commit"):
+        job = await enqueue_match_job(db, "found", found_item.id) # matching runs in the worker process
+
+    return {"message": "登録完了", "item_id": found_item.id, "job_id": job.id}
+
+# 一括登録: a manifest (CSV or JSON Lines, one found item per row: kind, date_found, latitude,
+# longitude, location_notes, images: two names) and a zip/tar of the images it names. Bad rows are reported
+# and skipped; the rest are matched in one job (poll /api/match-jobs/{job_id})
+@app.post("/api/found-items/bulk")
+async def import_found_items_bulk(
+    manifest: UploadFile = File(...),
+    archive: UploadFile = File(...),
+    source: str = Form(""),
+):
+    logger.info("Bulk import posted: %s", manifest.filename)
+    try:
+        result = await run_in_threadpool(
+            import_found_items, manifest.file, manifest.filename or "", archive.file, source or None
+        )
+    except ManifestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not result.imported:
+        raise HTTPException(status_code=400, detail={"message": "no found items imported", "errors": result.errors})
+    return {"message": "登録完了", **result._asdict()}
 
 @app.get("/api/found-items")
-def get_found_items(db: Session = Depends(get_db)):
-    items = db.query(FoundItem).all()
-    random_items = random.sample(items, min(3, len(items)))
+def get_found_items(
+    response: Response,
+    near: Optional[str] = None,  # "lat,lon"
+    radius: float = Query(1.0, gt=0, le=MAX_RADIUS_KM),  # km
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    bbox: Optional[str] = None,  # "min_lon,min_lat,max_lon,max_lat"
+    db: Session = Depends(get_sync_db)
+):
+    if near:
+        try:
+            lat, lon = (float(v) for v in near.split(","))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="near must be 'lat,lon'")
+        results = found_items_within(db, lat, lon, radius, db.query(FoundItem).filter(is_open(FoundItem)))
+        results = results[:clamp_limit(limit, 50)]
+        image_urls = primary_image_paths(db, "found", [item.id for item, _ in results])
+        return [
+            {**found_item_row(item, image_urls.get(item.id)), "distance_km": round(distance, 3)}
+            for item, distance in results
+        ]
+
+    query = found_item_feed(db, parse_bbox(bbox))
+    if cursor is None:
+        items = random_sample(db, query, FoundItem.id, clamp_limit(limit, 3))
+    else:
+        items, next_cursor = keyset_page(query, FoundItem.id, parse_cursor(cursor), clamp_limit(limit, 20))
+        if next_cursor is not None:
+            response.headers["X-Next-Cursor"] = str(next_cursor)
+    return [found_item_row(item, item.image_url) for item in items]
+
+# 返却済み・期限切れ: "claimed" once the item is back with its owner, "open" to reopen it. Closed
+# items drop out of the lists and matching, and are archived after a while (see retention.py)
+async def update_item_status(db: AsyncSession, item_type: str, item_id: int, status: str) -> dict:
+    if status not in STATUSES:
+        raise HTTPException(status_code=400, detail=f"status must be one of {', '.join(STATUSES)}")
+    previous = await set_item_status(db, item_type, item_id, status)
+    if previous is None:
+        raise HTTPException(status_code=404, detail=f"{item_type} item not found")
+    result = {"item_id": item_id, "status": status}
+    if status == "open" and previous != "open":
+        job = await enqueue_match_job(db, item_type, item_id)  # catch up on what arrived while it was closed
+        result["job_id"] = job.id
+    return result
+
+@app.post("/api/lost-items/{item_id}/status")
+async def update_lost_item_status(item_id: int, status: str = Form(...), db: AsyncSession = Depends(get_db)):
+    return await update_item_status(db, "lost", item_id, status)
+
+@app.post("/api/found-items/{item_id}/status")
+async def update_found_item_status(item_id: int, status: str = Form(...), db: AsyncSession = Depends(get_db)):
+    return await update_item_status(db, "found", item_id, status)
+
+@app.get("/api/matched-found-items")
+def get_matched_found_items(
+    lost_item_id: int,
+    response: Response,
+    threshold: float = MATCH_SCORE_THRESHOLD,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    db: Session = Depends(get_sync_db)
+):
+    rows, next_cursor = matched_found_items(
+        db, lost_item_id, threshold, parse_match_cursor(cursor), clamp_limit(limit, 50)
+    )
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return [{**found_item_row(row, row.image_url), "score": row.score} for row in rows]
+
+# the likeliest owners of a found item, for the finder or the office holding it
+@app.get("/api/matched-lost-items")
+def get_matched_lost_items(
+    found_item_id: int,
+    response: Response,
+    threshold: float = MATCH_SCORE_THRESHOLD,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    db: Session = Depends(get_sync_db)
+):
+    rows, next_cursor = matched_lost_items(
+        db, found_item_id, threshold, parse_match_cursor(cursor), clamp_limit(limit, 50)
+    )
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
     return [
         {
-            "id": item.id,
-            "latitude": item.latitude,
-            "longitude": item.longitude,
-            "location_notes": item.location_notes,
-            "image_url": item.image_urls.split(',')[0] if item.image_urls else None,
+            "id": row.id,
+            "latitude": row.latitude,
+            "longitude": row.longitude,
+            "details": row.details,
+            "image_url": row.image_url,
+            "score": row.score,
         }
-        for item in random_items
+        for row in rows
     ]
 
-# when a new lost item is registered, calculate match scores against all found items
-def match_lost_item(lost_item: LostItem, db: Session):
-    print("Matching lost item with found items...")
-    found_items = db.query(FoundItem).all()
-    lost_image_paths = lost_item.image_urls.split(',') if lost_item.image_urls else []
-
-    # combine details and security info 
-    full_description = (lost_item.details or "") + "\n" + (lost_item.security_info or "")
-
-
-    for found in found_items:
-        found_image_paths = found.image_urls.split(',') if found.image_urls else []
-
-        score = get_match_score(
-            lost_description=full_description,
-            lost_image_path=lost_image_paths[0] if lost_image_paths else None,
-            found_image_paths=found_image_paths
-        )
-
-        if isinstance(score, int):  # Adjust threshold if needed
-            match = MatchScore(
-                lost_item_id=lost_item.id,
-                found_item_id=found.id,
-                score=float(score)
-            )
-            db.add(match)
-    db.commit()
-
-# when a new found item is registered, calculate match scores against all lost items
-def match_found_item(found_item: FoundItem, db: Session):
-    print("Matching found item with lost items...")
-    # sys.stdout.flush()
-    lost_items = db.query(LostItem).all()
-    found_image_paths = found_item.image_urls.split(',') if found_item.image_urls else []
-
-    for lost in lost_items:
-        lost_image_paths = lost.image_urls.split(',') if lost.image_urls else []
-
-        full_description = (lost.details or "") + "\n" + (lost.security_info or "")
-
-        score = get_match_score(
-            lost_description=full_description,
-            lost_image_path=lost_image_paths[0] if lost_image_paths else None,
-            found_image_paths=found_image_paths
-        )
-
-        print(f"Match score for lost item {lost.id} and found item {found_item.id}: {score}")
-
-        if isinstance(score, int):  # Acceptable match threshold
-            match = MatchScore(
-                lost_item_id=lost.id,
-                found_item_id=found_item.id,
-                score=float(score)
-            )
-            db.add(match)
-
-    db.commit()
-
-def match_found_item_safe(found_item_id: int):
+# current matches (first page) and the found items of new match events, for the live endpoints below
+def matched_found_snapshot(lost_item_id: int) -> List[dict]:
     db = SessionLocal()
     try:
-        found_item = db.query(FoundItem).get(found_item_id)
-        match_found_item(found_item, db)
+        rows, _ = matched_found_items(db, lost_item_id, MATCH_SCORE_THRESHOLD, None, clamp_limit(None, 50))
+        return [{**found_item_row(row, row.image_url), "score": row.score} for row in rows]
     finally:
         db.close()
 
-@app.get("/api/matched-found-items")
-def get_matched_found_items(lost_item_id: int, db: Session = Depends(get_db)):
-    matches = (
-        db.query(MatchScore)
-        .filter(MatchScore.lost_item_id == lost_item_id, MatchScore.score > 3)
-        .all()
-    )
-
-    found_item_ids = [m.found_item_id for m in matches]
-
-    if not found_item_ids:
-        return []
-    
-    print(f"Found items for lost item {lost_item_id}: {found_item_ids}")
-    sys.stdout.flush()
-
+def matched_found_rows(events: List[dict]) -> List[dict]:
+    scores = {event["found_item_id"]: event["score"] for event in events}
+    db = SessionLocal()
+    try:
+        rows = found_item_feed(db).filter(FoundItem.id.in_(list(scores))).all()
+        return [{**found_item_row(row, row.image_url), "score": scores[row.id]} for row in rows]
+    finally:
+        db.close()
 
-    found_items = (
-        db.query(FoundItem)
-        .filter(FoundItem.id.in_(found_item_ids))
-        .all()
-    )
+# ("snapshot", rows) first and whenever events were dropped, then ("match", rows) as matches
+# are saved, with ("keepalive", []) when nothing happened for KEEPALIVE_SECONDS
+async def match_updates(lost_item_id: int):
+    subscription = await match_broker.subscribe(lost_item_id)  # before the snapshot, so nothing falls in between
+    try:
+        yield "snapshot", await run_in_threadpool(matched_found_snapshot, lost_item_id)
+        while True:
+            events = await subscription.next_events(KEEPALIVE_SECONDS)
+            if events is None:
+                yield "snapshot", await run_in_threadpool(matched_found_snapshot, lost_item_id)
+            elif not events:
+                yield "keepalive", []
+            else:
+                yield "match", await run_in_threadpool(matched_found_rows, events)
+    finally:
+        match_broker.unsubscribe(subscription)
+
+# new matches pushed as they are saved, instead of polling /api/matched-found-items
+# Server-Sent Events: "snapshot" replaces the list, "match" adds or updates items by id
+@app.get("/api/matched-found-items/stream")
+async def stream_matched_found_items(lost_item_id: int):
+    async def events():
+        async for kind, rows in match_updates(lost_item_id):
+            if kind == "keepalive":
+                yield ": keepalive\n\n"
+            else:
+                yield f"event: {kind}\ndata: {json.dumps(rows, default=str, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # nginx would otherwise hold the events back
+    })
+
+# the same over a WebSocket (React Native has one built in): {"type": "snapshot" | "match" | "keepalive", "items": [...]}
+@app.websocket("/api/matched-found-items/ws")
+async def matched_found_items_socket(websocket: WebSocket, lost_item_id: int):
+    await websocket.accept()
+    updates = match_updates(lost_item_id)
+    try:
+        async for kind, rows in updates:
+            await websocket.send_text(json.dumps({"type": kind, "items": rows}, default=str, ensure_ascii=False))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await updates.aclose()
 
-    return [
-        {
-            "id": item.id,
-            "latitude": item.latitude,
-            "longitude": item.longitude,
-            "location_notes": item.location_notes,
-            "image_url": item.image_urls.split(',')[0] if item.image_urls else None,
-        }
-        for item in found_items
-    ]
+@app.get("/api/match-jobs/{job_id}")
+async def get_match_job_status(job_id: int, db: AsyncSession = Depends(get_db)):
+    job = await get_match_job(db, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="match job not found")
+    return job_status(job)
 
 class QuestionRequest(BaseModel):
     category: str
@@ -325,35 +444,19 @@ class QuestionRequest(BaseModel):
 
 @app.post("/api/generate-questions")
 async def generate_questions(data: QuestionRequest):
-    print("Received data:", data.dict())
-    category = data.category
-    description = data.description
-    questions = SECURITY_QUESTIONS.get(category, SECURITY_QUESTIONS["others"])
-
-    prompt = f"""
-A user submitted this description of a lost item:
-\"{description}\"
-
-Below is a list of possible security questions related to the item category: '{category}'.
-Your task is to filter out any questions that are already answered or clearly implied by the description.
-Only return questions that are still relevant and unanswered.
-
-⚠ Do not create new questions. Only use the list provided.
-Return the remaining questions as a clean bullet list. No extra commentary.
-
-Candidate questions:
-{chr(10).join(['- ' + q for q in questions])}
-"""
-
-    try:
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.2
-        )
-        content = response.choices[0].message.content or ""
-        filtered = [line.strip("•- ").strip() for line in content.split("\n") if line.strip()]
-        return {"questions": filtered}
-    except Exception as e:
-        print("OpenAI error:", e)
-        return {"questions": questions}  # fallback
\ No newline at end of file
+    logger.debug("Received data: %s", data.dict())
+    return {"questions": await question_filter.filter(data.category, data.description)}
+
+# cache hit rate and response latency of /api/generate-questions
+@app.get("/api/generate-questions/stats")
+def get_generate_questions_stats():
+    return question_filter.stats()
+
+# Prometheus metrics of this API process (the worker serves its own, see MATCH_WORKER_METRICS_PORT)
+@app.get("/metrics")
+def get_metrics():
+    rendered = render_metrics()
+    if rendered is None:
+        raise HTTPException(status_code=501, detail="prometheus_client is not installed")
+    body, content_type = rendered
+    return Response(content=body, media_type=content_type)
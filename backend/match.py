@@ -1,28 +1,36 @@
-import base64
+import json
+import logging
 import os
-from typing import List, Optional
+from typing import Dict, Hashable, List, Optional, Tuple
 
-import openai
-from dotenv import load_dotenv
+from images import encode_image
+from logs import get_logger, log_sampled
+from openai_client import chat_completion
+from score_cache import cache_key, score_cache
 
-load_dotenv()
+logger = get_logger(__name__)
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+MODEL = "gpt-4o"
+MAX_TOKENS = 20
 
-def encode_image(image_path: str) -> str:
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+# "pair" scores one found item per call, "batch" ranks up to BATCH_SIZE found items per call
+STRATEGY = os.getenv("MATCH_STRATEGY", "pair")
+BATCH_SIZE = int(os.getenv("MATCH_BATCH_SIZE", "8"))
+BATCH_TOKENS_PER_CANDIDATE = 15
 
-def get_match_score(
-    lost_description: str,
-    lost_image_path: Optional[str] = None,
-    found_image_paths: Optional[List[str]] = None
-) -> int:
-    
-    if not found_image_paths or len(found_image_paths) != 2:
-        print("Error: Found item must have exactly two images.")
-        return -1
+# scores below 0 aren't scores: FAILED is a call that failed and may work next time, UNSCORABLE a pair
+# that no retry will fix (not exactly two found photos, a photo that won't encode, an answer that isn't a score)
+FAILED = -1
+UNSCORABLE = -2
 
+def _image_part(image_path: str) -> dict:
+    return {
+        "type": "image_url",
+        "image_url": {"url": f"data:image/jpeg;base64,{encode_image(image_path)}"}
+    }
+
+# system prompt plus the lost item's description and photo; comparisons append to messages[1]
+def _lost_item_messages(lost_description: str, lost_image_path: Optional[str]) -> list:
     messages = [
         {
             "role": "system",
@@ -44,15 +52,24 @@ def get_match_score(
 
     if lost_image_path:
         try:
-            lost_image_base64 = encode_image(lost_image_path)
-            messages[1]["content"].append(
-                {
-                    "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{lost_image_base64}"}
-                }
-            )
+            messages[1]["content"].append(_image_part(lost_image_path))
         except Exception as e:
-            print(f"Failed to encode lost image: {e}")
+            logger.warning("Failed to encode lost image: %s", e)
+
+    return messages
+
+# build the chat messages for one lost/found comparison, or None if the found item can't be scored
+def build_match_messages(
+    lost_description: str,
+    lost_image_path: Optional[str] = None,
+    found_image_paths: Optional[List[str]] = None
+) -> Optional[list]:
+
+    if not found_image_paths or len(found_image_paths) != 2:
+        log_sampled(logger, logging.WARNING, "Found item must have exactly two images, got %d", len(found_image_paths or []))
+        return None
+
+    messages = _lost_item_messages(lost_description, lost_image_path)
 
     messages[1]["content"].append(
         {"type": "text",
@@ -62,25 +79,164 @@ def get_match_score(
 
     for path in found_image_paths:
         try:
-            found_image_base64 = encode_image(path)
-            messages[1]["content"].append(
-                {
-                    "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{found_image_base64}"}
-                }
-            )
+            messages[1]["content"].append(_image_part(path))
         except Exception as e:
-            print(f"Failed to encode found image '{path}': {e}")
-            return -1
+            logger.warning("Failed to encode found image '%s': %s", path, e)
+            return None
+
+    return messages
+
+def parse_score(content: Optional[str]) -> int:
+    return int((content or "").strip())  # integer only
+
+def get_match_score(
+    lost_description: str,
+    lost_image_path: Optional[str] = None,
+    found_image_paths: Optional[List[str]] = None
+) -> int:
+
+    messages = build_match_messages(lost_description, lost_image_path, found_image_paths)
+    if messages is None:
+        return UNSCORABLE
+
+    key = cache_key(MODEL, messages, MAX_TOKENS)
+    cached = score_cache.get(key)
+    if cached is not None:
+        return cached
 
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4o",
+        response = chat_completion(
+            purpose="match",
+            model=MODEL,
             messages=messages,
-            max_tokens=20
+            max_tokens=MAX_TOKENS
         )
-        answer = response.choices[0].message.content.strip()
-        return int(answer)  # integer only
     except Exception as e:
-        print(f"OpenAI API call failed: {e}")
-        return -1 
\ No newline at end of file
+        logger.warning("OpenAI API call failed: %s", e)
+        return FAILED
+    try:
+        score = parse_score(response.choices[0].message.content)
+    except ValueError as e:
+        logger.warning("Unparseable match score: %s", e)
+        return UNSCORABLE
+    score_cache.put(key, score, MODEL)
+    return score
+
+# the pair-mode cache key for a comparison, so both strategies share one cache
+def pair_cache_key(
+    lost_description: str,
+    lost_image_path: Optional[str],
+    found_image_paths: List[str]
+) -> Optional[str]:
+    messages = build_match_messages(lost_description, lost_image_path, found_image_paths)
+    if messages is None:
+        return None
+    return cache_key(MODEL, messages, MAX_TOKENS)
+
+def batch_max_tokens(count: int) -> int:
+    return MAX_TOKENS + BATCH_TOKENS_PER_CANDIDATE * count
+
+# one message with the lost item once and each candidate's two photos under its label
+def build_batch_messages(
+    lost_description: str,
+    lost_image_path: Optional[str],
+    candidates: List[Tuple[str, List[str]]]
+) -> list:
+
+    messages = _lost_item_messages(lost_description, lost_image_path)
+    labels = [label for label, _ in candidates]
+
+    messages[1]["content"].append(
+        {"type": "text",
+         "text": f"Below are {len(candidates)} found items, each with two photos and a label. "
+                "For each one, do they seem to be the same item as the lost item? "
+                "Give a score from 1 (not similar) to 5 (very likely same). "
+                'Return only JSON of the form {"scores": [{"id": "<label>", "score": <integer>}]} '
+                f"with exactly one entry for each of these labels: {', '.join(labels)}."}
+    )
+
+    for label, found_image_paths in candidates:
+        messages[1]["content"].append({"type": "text", "text": f"Found item {label}:"})
+        for path in found_image_paths:
+            messages[1]["content"].append(_image_part(path))
+
+    return messages
+
+# raises ValueError unless every label has exactly one integer score in 1..5
+def parse_batch_scores(content: Optional[str], labels: List[str]) -> Dict[str, int]:
+    try:
+        entries = json.loads(content or "")["scores"]
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        raise ValueError(f"malformed batch response: {e}")
+
+    scores = {}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            raise ValueError(f"malformed batch entry: {entry!r}")
+        label, score = entry.get("id"), entry.get("score")
+        if label not in labels or label in scores:
+            raise ValueError(f"unexpected or duplicate label {label!r}")
+        if isinstance(score, bool) or not isinstance(score, int) or not 1 <= score <= 5:
+            raise ValueError(f"invalid score {score!r} for {label}")
+        scores[label] = score
+
+    missing = set(labels) - set(scores)
+    if missing:
+        raise ValueError(f"missing scores for {sorted(missing)}")
+    return scores
+
+# score many found items against one lost item, BATCH_SIZE per call, falling back to
+# get_match_score for any batch whose answer can't be parsed
+def get_match_scores_batch(
+    lost_description: str,
+    lost_image_path: Optional[str],
+    found_candidates: List[Tuple[Hashable, List[str]]]
+) -> Dict[Hashable, int]:
+
+    results = {}
+    pending = []
+    for key, found_image_paths in found_candidates:
+        if not found_image_paths or len(found_image_paths) != 2:
+            log_sampled(logger, logging.WARNING, "Found item must have exactly two images, got %d", len(found_image_paths or []))
+            results[key] = UNSCORABLE
+            continue
+        try:
+            pair_key = pair_cache_key(lost_description, lost_image_path, found_image_paths)
+        except Exception as e:
+            logger.warning("Failed to encode found images %s: %s", found_image_paths, e)
+            results[key] = UNSCORABLE
+            continue
+        cached = score_cache.get(pair_key)
+        if cached is not None:
+            results[key] = cached
+        else:
+            pending.append((key, found_image_paths, pair_key))
+
+    for start in range(0, len(pending), BATCH_SIZE):
+        chunk = pending[start:start + BATCH_SIZE]
+        labels = [f"C{i + 1}" for i in range(len(chunk))]
+        try:
+            messages = build_batch_messages(
+                lost_description,
+                lost_image_path,
+                [(label, paths) for label, (_, paths, _) in zip(labels, chunk)]
+            )
+            response = chat_completion(
+                purpose="match_batch",
+                model=MODEL,
+                messages=messages,
+                max_tokens=batch_max_tokens(len(chunk)),
+                response_format={"type": "json_object"}
+            )
+            scores = parse_batch_scores(response.choices[0].message.content, labels)
+        except Exception as e:
+            logger.warning("Batch scoring failed, falling back to per-pair scoring: %s", e)
+            for key, paths, _ in chunk:
+                results[key] = get_match_score(lost_description, lost_image_path, paths)
+            continue
+
+        for label, (key, _, pair_key) in zip(labels, chunk):
+            results[key] = scores[label]
+            score_cache.put(pair_key, scores[label], MODEL)
+
+    return results
@@ -0,0 +1,407 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import openai
+from match import (BATCH_SIZE, FAILED, MAX_TOKENS, MODEL, UNSCORABLE,
+                   batch_max_tokens, build_batch_messages,
+                   build_match_messages, pair_cache_key, parse_batch_scores,
+                   parse_score)
+from logs import get_logger, log_sampled
+from metrics import MATCH_PAIRS
+from openai_client import (CircuitOpenError, async_chat_completion,
+                           close_async_client, get_async_client)
+from score_cache import cache_key, score_cache
+
+logger = get_logger(__name__)
+
+# 並列数とレート制限（環境変数で調整可能）
+CONCURRENCY = int(os.getenv("MATCH_CONCURRENCY", "8"))
+REQUESTS_PER_MINUTE = float(os.getenv("OPENAI_RPM", "500"))
+TOKENS_PER_MINUTE = float(os.getenv("OPENAI_TPM", "30000"))
+MAX_RETRIES = int(os.getenv("MATCH_MAX_RETRIES", "5"))
+BACKOFF_BASE_SECONDS = float(os.getenv("MATCH_BACKOFF_BASE_SECONDS", "1"))
+BACKOFF_MAX_SECONDS = float(os.getenv("MATCH_BACKOFF_MAX_SECONDS", "60"))
+
+# rough gpt-4o input cost of one image at default detail
+IMAGE_TOKENS = 765
+
+
+class TokenBucket:
+    # thread-safe so a single bucket can be shared by every job's event loop
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _try_take(self, amount: float) -> float:
+        # take amount and return 0, or return how long to wait before retrying
+        with self._lock:
+            self._refill()
+            amount = min(amount, self.capacity)
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.rate
+
+    async def acquire(self, amount: float = 1.0):
+        while True:
+            wait = self._try_take(amount)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def adjust(self, delta: float):
+        # charge (positive) or refund (negative) once the real cost is known
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - delta)
+
+
+class RateLimiter:
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    async def acquire(self, estimated_tokens: int):
+        await self.requests.acquire(1)
+        await self.tokens.acquire(estimated_tokens)
+
+    def settle(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        if actual_tokens is not None:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+
+
+# shared by every job in this process so concurrent jobs stay under the account limits
+rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+
+@dataclass
+class JobProgress:
+    total: int = 0
+    done: int = 0
+    failed: int = 0
+    retries: int = 0
+    cached: int = 0
+    batch_fallbacks: int = 0
+    started_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    def as_dict(self) -> dict:
+        return {
+            "total": self.total,
+            "done": self.done,
+            "failed": self.failed,
+            "retries": self.retries,
+            "cached": self.cached,
+            "batch_fallbacks": self.batch_fallbacks,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+ProgressCallback = Callable[[JobProgress], None]
+# minimum seconds between on_progress calls (the final call always happens)
+PROGRESS_INTERVAL_SECONDS = 1.0
+
+
+def estimate_tokens(messages: list, max_tokens: int = MAX_TOKENS) -> int:
+    tokens = max_tokens
+    for message in messages:
+        content = message["content"]
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        for part in parts:
+            if part["type"] == "text":
+                tokens += len(part["text"]) // 4 + 1
+            else:
+                tokens += IMAGE_TOKENS
+    return tokens
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int) -> float:
+    # exponential backoff with full jitter
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+class _Reporter:
+    # counts finished comparisons and calls on_progress at most every PROGRESS_INTERVAL_SECONDS
+
+    def __init__(self, job_id: str, progress: JobProgress, on_progress: Optional[ProgressCallback]):
+        self.job_id = job_id
+        self.progress = progress
+        self.on_progress = on_progress
+        self.last_report = 0.0
+
+    def completed(self, scores):
+        for score in scores:
+            self.progress.done += 1
+            if score < 0:
+                self.progress.failed += 1
+        if self.on_progress and time.monotonic() - self.last_report >= PROGRESS_INTERVAL_SECONDS:
+            self.last_report = time.monotonic()
+            self.on_progress(self.progress)
+
+    def finish(self):
+        self.progress.finished_at = time.time()
+        logger.info("Scored %s: %d pairs, %d cached, %d failed", self.job_id, self.progress.done,
+                    self.progress.cached, self.progress.failed)
+        MATCH_PAIRS.labels("cache").inc(self.progress.cached)
+        MATCH_PAIRS.labels("failed").inc(self.progress.failed)
+        MATCH_PAIRS.labels("model").inc(max(0, self.progress.done - self.progress.cached - self.progress.failed))
+        if self.on_progress:
+            self.on_progress(self.progress)
+
+
+class MatchEngine:
+
+    def __init__(
+        self,
+        client: Optional[openai.AsyncOpenAI] = None,
+        concurrency: int = CONCURRENCY,
+        limiter: Optional[RateLimiter] = None,
+        max_retries: int = MAX_RETRIES,
+    ):
+        self._client = client
+        self.concurrency = concurrency
+        self.limiter = limiter or rate_limiter
+        self.max_retries = max_retries
+
+    @property
+    def client(self) -> openai.AsyncOpenAI:
+        if self._client is None:
+            # the shared pool, with SDK retries disabled so every retry goes through our limiter and backoff
+            self._client = get_async_client().with_options(max_retries=0)
+        return self._client
+
+    # one chat completion through the limiter with retries; None once retries are exhausted.
+    # CircuitOpenError propagates so the whole job fails fast instead of scoring every pair FAILED
+    async def _complete(self, progress: JobProgress, messages: list, max_tokens: int, purpose: str = "match", **extra):
+        estimated = estimate_tokens(messages, max_tokens)
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(estimated)
+            try:
+                response = await async_chat_completion(
+                    client=self.client,
+                    purpose=purpose,
+                    model=MODEL,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    **extra
+                )
+            except CircuitOpenError:
+                self.limiter.settle(estimated, 0)
+                raise
+            except Exception as e:
+                self.limiter.settle(estimated, 0)
+                if not _is_retryable(e) or attempt == self.max_retries:
+                    log_sampled(logger, logging.WARNING, "OpenAI API call failed: %s", e, rate=0.1)
+                    return None
+                progress.retries += 1
+                await asyncio.sleep(_retry_after(e) or backoff_delay(attempt))
+                continue
+
+            usage = getattr(response, "usage", None)
+            self.limiter.settle(estimated, usage.total_tokens if usage else None)
+            return response
+        return None
+
+    async def score(self, progress: JobProgress, **kwargs) -> int:
+        messages = await asyncio.to_thread(build_match_messages, **kwargs)
+        if messages is None:
+            return UNSCORABLE
+
+        key = cache_key(MODEL, messages, MAX_TOKENS)
+        cached = await asyncio.to_thread(score_cache.get, key)
+        if cached is not None:
+            progress.cached += 1
+            return cached
+
+        response = await self._complete(progress, messages, MAX_TOKENS)
+        if response is None:
+            return FAILED
+        try:
+            score = parse_score(response.choices[0].message.content)
+        except ValueError as e:
+            log_sampled(logger, logging.WARNING, "Unparseable match score: %s", e, rate=0.1)
+            return UNSCORABLE
+        await asyncio.to_thread(score_cache.put, key, score, MODEL)
+        return score
+
+    # score up to BATCH_SIZE found items in one call; falls back to per-pair calls if the
+    # answer doesn't validate. chunk is [(key, found_image_paths, pair cache key)]
+    async def score_batch(
+        self,
+        progress: JobProgress,
+        lost_description: str,
+        lost_image_path: Optional[str],
+        chunk: List[Tuple[Hashable, List[str], str]],
+    ) -> Dict[Hashable, int]:
+        labels = [f"C{i + 1}" for i in range(len(chunk))]
+        scores = None
+        try:
+            messages = await asyncio.to_thread(
+                build_batch_messages,
+                lost_description,
+                lost_image_path,
+                [(label, paths) for label, (_, paths, _) in zip(labels, chunk)],
+            )
+            response = await self._complete(
+                progress, messages, batch_max_tokens(len(chunk)),
+                purpose="match_batch",
+                response_format={"type": "json_object"},
+            )
+            if response is not None:
+                scores = parse_batch_scores(response.choices[0].message.content, labels)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            logger.warning("Batch scoring failed, falling back to per-pair scoring: %s", e)
+
+        if scores is None:
+            progress.batch_fallbacks += 1
+            results = await asyncio.gather(*(
+                self.score(progress, lost_description=lost_description,
+                           lost_image_path=lost_image_path, found_image_paths=paths)
+                for _, paths, _ in chunk
+            ))
+            return {key: score for (key, _, _), score in zip(chunk, results)}
+
+        for label, (_, _, pair_key) in zip(labels, chunk):
+            await asyncio.to_thread(score_cache.put, pair_key, scores[label], MODEL)
+        return {key: scores[label] for label, (key, _, _) in zip(labels, chunk)}
+
+    # score every (key, get_match_score kwargs) pair concurrently; returns {key: score}
+    async def score_pairs(
+        self,
+        job_id: str,
+        pairs: List[Tuple[Hashable, dict]],
+        on_progress: Optional[ProgressCallback] = None,
+    ) -> Dict[Hashable, int]:
+        progress = JobProgress(total=len(pairs))
+        reporter = _Reporter(job_id, progress, on_progress)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(key, kwargs):
+            async with semaphore:
+                score = await self.score(progress, **kwargs)
+            reporter.completed([score])
+            return key, score
+
+        try:
+            results = await asyncio.gather(*(run(key, kwargs) for key, kwargs in pairs))
+        finally:
+            reporter.finish()
+        return dict(results)
+
+    # batch strategy: rank found items against one lost item, BATCH_SIZE per call.
+    # candidates is [(key, found_image_paths)]; returns {key: score}
+    async def score_candidates(
+        self,
+        job_id: str,
+        lost_description: str,
+        lost_image_path: Optional[str],
+        candidates: List[Tuple[Hashable, List[str]]],
+        on_progress: Optional[ProgressCallback] = None,
+    ) -> Dict[Hashable, int]:
+        progress = JobProgress(total=len(candidates))
+        reporter = _Reporter(job_id, progress, on_progress)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = {}
+
+        async def lookup(key, paths):
+            if not paths or len(paths) != 2:
+                log_sampled(logger, logging.WARNING, "Found item must have exactly two images, got %d", len(paths or []))
+                return key, paths, None
+            try:
+                pair_key = await asyncio.to_thread(pair_cache_key, lost_description, lost_image_path, paths)
+            except Exception as e:
+                logger.warning("Failed to encode found images %s: %s", paths, e)
+                return key, paths, None
+            return key, paths, pair_key
+
+        async def run(chunk):
+            async with semaphore:
+                scores = await self.score_batch(progress, lost_description, lost_image_path, chunk)
+            results.update(scores)
+            reporter.completed(scores.values())
+
+        try:
+            pending = []
+            for key, paths, pair_key in await asyncio.gather(*(lookup(k, p) for k, p in candidates)):
+                if pair_key is None:
+                    results[key] = UNSCORABLE
+                    reporter.completed([UNSCORABLE])
+                    continue
+                cached = await asyncio.to_thread(score_cache.get, pair_key)
+                if cached is not None:
+                    results[key] = cached
+                    progress.cached += 1
+                    reporter.completed([cached])
+                else:
+                    pending.append((key, paths, pair_key))
+
+            chunks = [pending[i:i + BATCH_SIZE] for i in range(0, len(pending), BATCH_SIZE)]
+            await asyncio.gather(*(run(chunk) for chunk in chunks))
+        finally:
+            reporter.finish()
+        return results
+
+
+def _run_engine(method: str, *args) -> Dict[Hashable, int]:
+    async def run():
+        engine = MatchEngine()
+        try:
+            return await getattr(engine, method)(*args)
+        finally:
+            await close_async_client()
+
+    return asyncio.run(run())
+
+
+# blocking entry points for the sync matching code; each call gets its own loop (and so its own pool)
+def score_pairs_sync(
+    job_id: str,
+    pairs: List[Tuple[Hashable, dict]],
+    on_progress: Optional[ProgressCallback] = None,
+) -> Dict[Hashable, int]:
+    return _run_engine("score_pairs", job_id, pairs, on_progress)
+
+
+def score_candidates_sync(
+    job_id: str,
+    lost_description: str,
+    lost_image_path: Optional[str],
+    candidates: List[Tuple[Hashable, List[str]]],
+    on_progress: Optional[ProgressCallback] = None,
+) -> Dict[Hashable, int]:
+    return _run_engine("score_candidates", job_id, lost_description, lost_image_path, candidates, on_progress)
@@ -0,0 +1,259 @@
+import asyncio
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+from database import AsyncSessionLocal, writer_session
+from feeds import MATCH_SCORE_THRESHOLD
+from logs import get_logger
+from metrics import MATCH_EVENTS
+from models import MatchEvent
+from sqlalchemy import delete, func, select
+
+try:
+    import redis
+    import redis.asyncio as redis_async
+except ImportError:  # only needed for MATCH_EVENTS_BROKER=redis
+    redis = None
+
+logger = get_logger(__name__)
+
+# 新着マッチの通知
+# "db": the worker appends to match_events and every API process tails it, one query per interval
+#       for all of its subscribers and none while nobody is subscribed
+# "redis": Redis pub/sub, for API processes on several hosts
+# "local": matching and the subscribers share one process
+BROKER = os.getenv("MATCH_EVENTS_BROKER", "db")
+POLL_SECONDS = float(os.getenv("MATCH_EVENTS_POLL_SECONDS", "0.25"))
+RETENTION_SECONDS = float(os.getenv("MATCH_EVENTS_RETENTION_SECONDS", "3600"))
+REDIS_URL = os.getenv("MATCH_EVENTS_REDIS_URL", "redis://localhost:6379/0")
+REDIS_CHANNEL = os.getenv("MATCH_EVENTS_REDIS_CHANNEL", "kyojo:matches")
+KEEPALIVE_SECONDS = float(os.getenv("MATCH_EVENTS_KEEPALIVE_SECONDS", "15"))
+QUEUE_SIZE = 100  # undelivered events per subscriber before it is told to resync
+POLL_BATCH = 500
+PRUNE_EVERY = 100  # publishes between deletions of expired match_events rows
+
+
+class Subscription:
+    # one connected client of one lost item; events are handed over on the client's own loop
+
+    def __init__(self, lost_item_id: int, loop: asyncio.AbstractEventLoop):
+        self.lost_item_id = lost_item_id
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.lagged = False
+
+    def _deliver(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.lagged = True
+
+    # the events that arrived, [] after `timeout` without any, or None if some had to be dropped
+    async def next_events(self, timeout: float) -> Optional[List[dict]]:
+        try:
+            events = [await asyncio.wait_for(self.queue.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while not self.queue.empty():
+            events.append(self.queue.get_nowait())
+        if self.lagged:
+            self.lagged = False
+            return None
+        return events
+
+
+class LocalBroker:
+    # fans events out to the subscribers in this process; publish() is safe from any thread
+
+    def __init__(self):
+        self._subscriptions: Dict[int, Set[Subscription]] = {}
+        self._lock = threading.Lock()
+
+    async def subscribe(self, lost_item_id: int) -> Subscription:
+        subscription = Subscription(lost_item_id, asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions.setdefault(lost_item_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.lost_item_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.lost_item_id]
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    def dispatch(self, events: List[dict]):
+        with self._lock:
+            targets = [
+                (subscription, event)
+                for event in events
+                for subscription in self._subscriptions.get(event["lost_item_id"], ())
+            ]
+        for subscription, event in targets:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._deliver, event)
+            except RuntimeError:
+                pass  # its loop is closed, so the client is gone
+        MATCH_EVENTS.labels("delivered").inc(len(targets))
+
+    def publish(self, events: List[dict]):
+        self.dispatch(events)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "broker": type(self).__name__,
+                "lost_items": len(self._subscriptions),
+                "subscribers": sum(len(subscriptions) for subscriptions in self._subscriptions.values()),
+            }
+
+
+class _RemoteBroker(LocalBroker, ABC):
+    # events come from another process; a listener task feeds dispatch() while anyone is subscribed
+
+    def __init__(self):
+        super().__init__()
+        self._task: Optional[asyncio.Task] = None
+
+    async def subscribe(self, lost_item_id: int) -> Subscription:
+        subscription = await super().subscribe(lost_item_id)
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._listen())
+        return subscription
+
+    @abstractmethod
+    async def _listen(self):
+        ...
+
+
+class DatabaseBroker(_RemoteBroker):
+
+    def __init__(self):
+        super().__init__()
+        self._publishes = 0
+        self._start_ids: Dict[Subscription, int] = {}  # the newest event id when each one subscribed
+
+    # the newest event id is read before the caller takes its snapshot, so a listener started for
+    # this subscription replays anything saved in between
+    async def subscribe(self, lost_item_id: int) -> Subscription:
+        start_id = None
+        try:
+            async with AsyncSessionLocal() as db:
+                start_id = (await db.execute(select(func.max(MatchEvent.id)))).scalar() or 0
+        except Exception as e:
+            logger.warning("Reading the newest match event failed: %s", e)
+        subscription = await super().subscribe(lost_item_id)  # the listener task only starts at our next await
+        if start_id is not None:
+            with self._lock:
+                self._start_ids[subscription] = start_id
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._start_ids.pop(subscription, None)
+        super().unsubscribe(subscription)
+
+    def publish(self, events: List[dict]):
+        with writer_session() as writer:
+            writer.add_all(MatchEvent(**event) for event in events)
+            self._publishes += 1
+            if self._publishes % PRUNE_EVERY == 0:
+                cutoff = datetime.utcnow() - timedelta(seconds=RETENTION_SECONDS)
+                writer.execute(delete(MatchEvent).where(MatchEvent.created_at < cutoff))
+
+    async def _listen(self):
+        # from the oldest id a live subscription recorded; a match already in its snapshot may
+        # arrive again, which clients apply by id
+        with self._lock:
+            last_id = min(self._start_ids.values(), default=None)
+        while self.subscriber_count():
+            rows = []
+            try:
+                async with AsyncSessionLocal() as db:
+                    if last_id is None:  # no subscription could record one
+                        last_id = (await db.execute(select(func.max(MatchEvent.id)))).scalar() or 0
+                    rows = (await db.execute(
+                        select(MatchEvent).where(MatchEvent.id > last_id).order_by(MatchEvent.id).limit(POLL_BATCH)
+                    )).scalars().all()
+            except Exception as e:
+                logger.warning("Polling match_events failed: %s", e)
+            if rows:
+                last_id = rows[-1].id
+                self.dispatch([
+                    dict(lost_item_id=row.lost_item_id, found_item_id=row.found_item_id, score=row.score)
+                    for row in rows
+                ])
+            if len(rows) < POLL_BATCH:
+                await asyncio.sleep(POLL_SECONDS)
+
+
+class RedisBroker(_RemoteBroker):
+
+    def __init__(self, url: str = REDIS_URL, channel: str = REDIS_CHANNEL):
+        super().__init__()
+        self.url = url
+        self.channel = channel
+        self._client = redis.Redis.from_url(url)
+
+    def publish(self, events: List[dict]):
+        self._client.publish(self.channel, json.dumps(events))
+
+    async def _listen(self):
+        client = redis_async.Redis.from_url(self.url)
+        pubsub = client.pubsub()
+        try:
+            await pubsub.subscribe(self.channel)
+            while self.subscriber_count():
+                try:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                except redis.RedisError as e:
+                    logger.warning("Redis match events failed: %s", e)
+                    await asyncio.sleep(1.0)
+                    continue
+                if message is not None:
+                    self.dispatch(json.loads(message["data"]))
+        finally:
+            await pubsub.aclose()
+            await client.aclose()
+
+
+def create_broker(name: str = BROKER) -> LocalBroker:
+    if name == "redis":
+        if redis is not None:
+            return RedisBroker()
+        logger.warning("MATCH_EVENTS_BROKER=redis but the redis package is missing; using the database")
+        name = "db"
+    if name == "db":
+        return DatabaseBroker()
+    return LocalBroker()
+
+
+broker = create_broker()
+
+
+# after the scores are committed, so a subscriber that re-reads finds them
+def publish_matches(rows: List[dict]):
+    events = [
+        dict(lost_item_id=row["lost_item_id"], found_item_id=row["found_item_id"], score=row["score"])
+        for row in rows
+        if row["score"] > MATCH_SCORE_THRESHOLD
+    ]
+    if not events:
+        return
+    try:
+        broker.publish(events)
+    except Exception as e:
+        # the scores are saved; subscribers still get them in the snapshot when they reconnect
+        logger.warning("Publishing %d match events failed: %s", len(events), e)
+        return
+    MATCH_EVENTS.labels("published").inc(len(events))
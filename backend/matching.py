@@ -0,0 +1,306 @@
+import logging
+import os
+from datetime import datetime
+from typing import List, Optional, Set, Tuple
+
+from candidates import (found_candidate_pool, lost_candidate_pool,
+                        select_found_candidates, select_lost_candidates)
+from database import writer_session
+from embeddings import rank_found_candidates, rank_lost_candidates
+from feeds import is_open
+from item_images import image_paths_by_item
+from logs import get_logger, log_sampled
+from match import FAILED, STRATEGY, UNSCORABLE
+from match_events import publish_matches
+from match_engine import (JobProgress, ProgressCallback,
+                          score_candidates_sync, score_pairs_sync)
+from metrics import timed
+from models import (FoundItem, LostItem, MatchPairState, MatchScore,
+                    MatchWatermark)
+from sqlalchemy import and_, exists, func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from top_matches import update_top_matches
+
+logger = get_logger(__name__)
+
+# a pair whose calls failed this many times is settled as "failed" and no longer holds the watermark
+MAX_PAIR_FAILURES = int(os.getenv("MATCH_MAX_PAIR_FAILURES", "3"))
+
+
+def get_watermark(db: Session, item_type: str, item_id: int) -> int:
+    mark = db.get(MatchWatermark, (item_type, item_id))
+    return mark.matched_up_to if mark else 0
+
+def advance_watermark(db: Session, item_type: str, item_id: int, up_to: int):
+    mark = db.get(MatchWatermark, (item_type, item_id))
+    if mark is None:
+        db.add(MatchWatermark(item_type=item_type, item_id=item_id, matched_up_to=up_to))
+    elif up_to > mark.matched_up_to:
+        mark.matched_up_to = up_to
+
+# insert scores, overwriting any existing row for the same (lost, found) pair
+def save_match_scores(db: Session, rows: List[dict]):
+    if not rows:
+        return
+    dialect = db.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        insert = sqlite.insert if dialect == "sqlite" else postgresql.insert
+        stmt = insert(MatchScore).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["lost_item_id", "found_item_id"],
+            set_={"score": stmt.excluded.score, "created_at": stmt.excluded.created_at},
+        )
+        db.execute(stmt)
+    else:
+        for row in rows:
+            existing = db.query(MatchScore).filter_by(
+                lost_item_id=row["lost_item_id"], found_item_id=row["found_item_id"]
+            ).first()
+            if existing is None:
+                db.add(MatchScore(**row))
+            else:
+                existing.score = row["score"]
+        db.flush()
+    update_top_matches(db, rows)
+
+
+# pairs still worth sending: no score yet and not settled in match_pair_states. retry_failed also
+# lets through pairs given up after MAX_PAIR_FAILURES, e.g. for a full backfill after an outage
+def pair_unsettled(lost_item_id, found_item_id, retry_failed: bool = False):
+    settled = MatchPairState.settled != "failed" if retry_failed else MatchPairState.settled.isnot(None)
+    return and_(
+        ~exists().where(MatchScore.lost_item_id == lost_item_id, MatchScore.found_item_id == found_item_id),
+        ~exists().where(
+            MatchPairState.lost_item_id == lost_item_id,
+            MatchPairState.found_item_id == found_item_id,
+            settled,
+        ),
+    )
+
+
+# counts failed calls and settles unscorable pairs; returns the (lost, found) pairs to retry
+def record_failures(db: Session, failures: List[Tuple[int, int, int]]) -> Set[Tuple[int, int]]:
+    retry = set()
+    for lost_item_id, found_item_id, score in failures:
+        state = db.get(MatchPairState, (lost_item_id, found_item_id))
+        if state is None:
+            state = MatchPairState(lost_item_id=lost_item_id, found_item_id=found_item_id, failures=0)
+            db.add(state)
+        if score == UNSCORABLE:
+            state.settled = "unscorable"
+            continue
+        state.failures += 1
+        if state.failures >= MAX_PAIR_FAILURES:
+            state.settled = "failed"
+        else:
+            retry.add((lost_item_id, found_item_id))
+    return retry
+
+
+# marks (lost, found) pairs as compared for good, e.g. when retention prunes their low scores
+def settle_pairs(db: Session, pairs: List[Tuple[int, int]], settled: str):
+    if not pairs:
+        return
+    now = datetime.utcnow()
+    rows = [
+        dict(lost_item_id=lost_item_id, found_item_id=found_item_id, failures=0, settled=settled, updated_at=now)
+        for lost_item_id, found_item_id in pairs
+    ]
+    dialect = db.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        insert = sqlite.insert if dialect == "sqlite" else postgresql.insert
+        stmt = insert(MatchPairState).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["lost_item_id", "found_item_id"],
+            set_={"settled": stmt.excluded.settled, "updated_at": stmt.excluded.updated_at},
+        )
+        db.execute(stmt)
+    else:
+        for row in rows:
+            state = db.get(MatchPairState, (row["lost_item_id"], row["found_item_id"]))
+            if state is None:
+                db.add(MatchPairState(**row))
+            else:
+                state.settled = settled
+        db.flush()
+
+
+# end the read transaction first, then write in one short transaction on the writer session.
+# the watermark only moves once no pair is left to retry; returns those pairs
+def _save_results(db: Session, item_type: str, item_id: int, scores: dict, up_to: Optional[int]) -> Set[Tuple[int, int]]:
+    ids = {"lost_item_id": item_id} if item_type == "lost" else {"found_item_id": item_id}
+    rows = _score_rows(scores, **ids)
+    failures = _failed_pairs(scores, **ids)
+    db.commit()
+    with timed("match_save"), writer_session() as writer:
+        save_match_scores(writer, rows)
+        retry = record_failures(writer, failures)
+        if retry:
+            logger.warning("%d of %d pairs failed to score; keeping the %s %d watermark so they are retried",
+                           len(retry), len(scores), item_type, item_id)
+        elif up_to is not None:
+            advance_watermark(writer, item_type, item_id, up_to)
+    publish_matches(rows)  # push the good ones to subscribed clients
+    return retry
+
+
+# rows for save_match_scores; the scores are keyed by the id of the other side
+def _score_rows(scores: dict, lost_item_id: Optional[int] = None, found_item_id: Optional[int] = None) -> List[dict]:
+    now = datetime.utcnow()
+    return [
+        dict(lost_item_id=lost_item_id or key, found_item_id=found_item_id or key, score=float(score), created_at=now)
+        for key, score in scores.items()
+        if isinstance(score, int) and score >= 0  # FAILED / UNSCORABLE leave the pair unscored
+    ]
+
+
+# (lost id, found id, FAILED or UNSCORABLE) for record_failures
+def _failed_pairs(scores: dict, lost_item_id: Optional[int] = None, found_item_id: Optional[int] = None) -> List[tuple]:
+    return [
+        (lost_item_id or key, found_item_id or key, UNSCORABLE if score == UNSCORABLE else FAILED)
+        for key, score in scores.items()
+        if score < 0
+    ]
+
+
+# scores of one lost item against the pruned and ranked candidates among `unscored`, by found item id
+def _score_lost_item(lost_item: LostItem, db: Session, unscored, job_id: str,
+                     on_progress: Optional[ProgressCallback] = None) -> dict:
+    found_items, stats = select_found_candidates(
+        lost_item,
+        found_candidate_pool(db, lost_item, unscored),
+        rank=lambda items: rank_found_candidates(db, lost_item, items),
+    )
+    logger.info("Matching lost item %d: %s", lost_item.id, stats)
+    lost_image_paths = image_paths_by_item(db, "lost", [lost_item.id])[lost_item.id]
+    found_image_paths = image_paths_by_item(db, "found", [found.id for found in found_items])
+
+    # combine details and security info 
+    full_description = (lost_item.details or "") + "\n" + (lost_item.security_info or "")
+
+    lost_image_path = lost_image_paths[0] if lost_image_paths else None
+
+    if STRATEGY == "batch":
+        candidates = [(found.id, found_image_paths[found.id]) for found in found_items]
+        return score_candidates_sync(job_id, full_description, lost_image_path, candidates, on_progress)
+    pairs = [
+        (found.id, dict(
+            lost_description=full_description,
+            lost_image_path=lost_image_path,
+            found_image_paths=found_image_paths[found.id]
+        ))
+        for found in found_items
+    ]
+    return score_pairs_sync(job_id, pairs, on_progress)
+
+
+# when a new lost item is registered, calculate match scores against all found items
+def match_lost_item(lost_item: LostItem, db: Session, on_progress: Optional[ProgressCallback] = None, full: bool = False):
+    if lost_item.status != "open":
+        return  # claimed or expired while the job waited
+    # only found items added since the last run (all of them when full), and never a pair that already
+    # has a score or was settled without one (full retries those that failed too often)
+    watermark = 0 if full else get_watermark(db, "lost", lost_item.id)
+    up_to = db.query(func.max(FoundItem.id)).scalar() or 0
+    unscored = db.query(FoundItem).filter(
+        FoundItem.id > watermark,
+        FoundItem.id <= up_to,
+        is_open(FoundItem),
+        pair_unsettled(lost_item.id, FoundItem.id, retry_failed=full),
+    )
+    scores = _score_lost_item(lost_item, db, unscored, f"lost-{lost_item.id}", on_progress)
+    _save_results(db, "lost", lost_item.id, scores, up_to)
+
+
+# one consolidated pass for a bulk import: every lost item near any of the new found items is
+# scored once against all of its new candidates, instead of one match_found_item run per found item
+def match_import_batch(batch_id: int, db: Session, on_progress: Optional[ProgressCallback] = None):
+    found_ids = [
+        found_id
+        for (found_id,) in db.query(FoundItem.id).filter(FoundItem.import_batch_id == batch_id).order_by(FoundItem.id)
+    ]
+    up_to = db.query(func.max(LostItem.id)).scalar() or 0
+    lost_ids = set()
+    for found_item in db.query(FoundItem).filter(FoundItem.id.in_(found_ids)):
+        pool = lost_candidate_pool(db, found_item, db.query(LostItem).filter(LostItem.id <= up_to, is_open(LostItem)))
+        lost_ids.update(lost.id for lost in pool)
+    logger.info("Matching import batch %d: %d found items, %d nearby lost items", batch_id, len(found_ids), len(lost_ids))
+
+    # progress of the finished lost items plus the running one
+    finished = JobProgress()
+    unfinished = set()  # found items with a pair still to retry
+
+    def report(progress: JobProgress):
+        if on_progress is not None:
+            on_progress(JobProgress(
+                total=finished.total + progress.total,
+                done=finished.done + progress.done,
+                failed=finished.failed + progress.failed,
+            ))
+
+    for lost_id in sorted(lost_ids):
+        lost_item = db.get(LostItem, lost_id)
+        unscored = db.query(FoundItem).filter(
+            FoundItem.import_batch_id == batch_id,
+            is_open(FoundItem),
+            pair_unsettled(lost_id, FoundItem.id),
+        )
+        scores = _score_lost_item(lost_item, db, unscored, f"import-{batch_id}-lost-{lost_id}", report)
+        finished.total += len(scores)
+        finished.done += len(scores)
+        finished.failed += sum(1 for score in scores.values() if score < 0)
+        # the lost item's own watermark stays put: it has only seen this batch, not every found item below it
+        retry = _save_results(db, "lost", lost_id, scores, None)
+        unfinished.update(found_id for _, found_id in retry)
+        db.expunge_all()
+
+    # each new found item has now been considered against every lost item up to up_to,
+    # except those with a pair to retry, which their own next run picks up
+    if unfinished:
+        logger.warning("Import batch %d: %d found items have pairs to retry", batch_id, len(unfinished))
+    db.commit()
+    with writer_session() as writer:
+        for found_id in found_ids:
+            if found_id not in unfinished:
+                advance_watermark(writer, "found", found_id, up_to)
+    report(JobProgress())
+
+# when a new found item is registered, calculate match scores against all lost items
+def match_found_item(found_item: FoundItem, db: Session, on_progress: Optional[ProgressCallback] = None, full: bool = False):
+    if found_item.status != "open":
+        return
+    watermark = 0 if full else get_watermark(db, "found", found_item.id)
+    up_to = db.query(func.max(LostItem.id)).scalar() or 0
+    unscored = db.query(LostItem).filter(
+        LostItem.id > watermark,
+        LostItem.id <= up_to,
+        is_open(LostItem),
+        pair_unsettled(LostItem.id, found_item.id, retry_failed=full),
+    )
+    lost_items, stats = select_lost_candidates(
+        found_item,
+        lost_candidate_pool(db, found_item, unscored),
+        rank=lambda items: rank_lost_candidates(db, found_item, items),
+    )
+    logger.info("Matching found item %d: %s", found_item.id, stats)
+    found_image_paths = image_paths_by_item(db, "found", [found_item.id])[found_item.id]
+    lost_image_paths_by_id = image_paths_by_item(db, "lost", [lost.id for lost in lost_items])
+
+    pairs = []
+    for lost in lost_items:
+        lost_image_paths = lost_image_paths_by_id[lost.id]
+
+        full_description = (lost.details or "") + "\n" + (lost.security_info or "")
+
+        pairs.append((lost.id, dict(
+            lost_description=full_description,
+            lost_image_path=lost_image_paths[0] if lost_image_paths else None,
+            found_image_paths=found_image_paths
+        )))
+    scores = score_pairs_sync(f"found-{found_item.id}", pairs, on_progress)
+
+    for lost_id, score in scores.items():
+        log_sampled(logger, logging.INFO, "Match score for lost item %s and found item %d: %s", lost_id, found_item.id, score)
+
+    _save_results(db, "found", found_item.id, scores, up_to)
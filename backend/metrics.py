@@ -0,0 +1,92 @@
+import time
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+from logs import get_logger
+
+try:
+    from prometheus_client import (CONTENT_TYPE_LATEST, Counter, Histogram,
+                                   generate_latest, start_http_server)
+except ImportError:  # prometheus_client がない場合は計測しない
+    Counter = Histogram = None
+
+logger = get_logger(__name__)
+
+# seconds; from a fast cache hit up to a long matching job
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class _NoopMetric:
+    # stands in for every metric when prometheus_client isn't installed
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value: float):
+        pass
+
+    def inc(self, amount: float = 1):
+        pass
+
+
+def _histogram(name: str, documentation: str, labelnames: Tuple[str, ...]):
+    if Histogram is None:
+        return _NoopMetric()
+    return Histogram(name, documentation, labelnames, buckets=STAGE_BUCKETS)
+
+
+def _counter(name: str, documentation: str, labelnames: Tuple[str, ...]):
+    if Counter is None:
+        return _NoopMetric()
+    return Counter(name, documentation, labelnames)
+
+
+# stage: upload_save, image_prepare, db_commit, embed, encode_image, match_save, match_job
+STAGE_SECONDS = _histogram("kyojo_stage_seconds", "Time spent in each stage of upload and matching", ("stage",))
+# purpose: match, match_batch, questions
+OPENAI_SECONDS = _histogram("kyojo_openai_request_seconds", "OpenAI chat completion latency", ("purpose",))
+OPENAI_REQUESTS = _counter("kyojo_openai_requests", "OpenAI chat completions by outcome", ("purpose", "outcome"))
+OPENAI_TOKENS = _counter("kyojo_openai_tokens", "Tokens reported by the OpenAI API", ("purpose", "kind"))
+MATCH_JOBS = _counter("kyojo_match_jobs", "Finished match jobs by outcome", ("outcome",))
+# source: model, cache, failed
+MATCH_PAIRS = _counter("kyojo_match_pairs", "Scored lost/found pairs by where the score came from", ("source",))
+# outcome: kind, date, distance, top_k (pruned by that rule) or selected (sent to the model)
+MATCH_CANDIDATES = _counter("kyojo_match_candidates", "Considered lost/found pairs by pruning outcome", ("outcome",))
+# outcome: hit, miss, evicted
+SCORE_CACHE = _counter("kyojo_score_cache", "Match score cache lookups and evictions", ("outcome",))
+# stage: published (by matching), delivered (to a subscriber of this process)
+MATCH_EVENTS = _counter("kyojo_match_events", "Match notifications by stage", ("stage",))
+
+
+# with timed("db_commit"): ...  or  @timed("encode_image")
+@contextmanager
+def timed(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+def record_usage(purpose: str, response):
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    OPENAI_TOKENS.labels(purpose, "prompt").inc(usage.prompt_tokens or 0)
+    OPENAI_TOKENS.labels(purpose, "completion").inc(usage.completion_tokens or 0)
+
+
+# body and content type for GET /metrics, or None without prometheus_client
+def render_metrics() -> Optional[Tuple[bytes, str]]:
+    if Counter is None:
+        return None
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+# the worker has no web app of its own, so it can serve /metrics on a side port
+def start_metrics_server(port: int) -> bool:
+    if Counter is None:
+        logger.warning("prometheus_client is not installed; metrics server not started")
+        return False
+    start_http_server(port)
+    return True
@@ -1,12 +1,18 @@
 from datetime import datetime
 
 from database import Base
-from sqlalchemy import Column, DateTime, Float, ForeignKey, Integer, String
+from geo import geocell
+from sqlalchemy import (Column, DateTime, Float, ForeignKey, Index, Integer,
+                        LargeBinary, String, event)
 from sqlalchemy.orm import relationship
 
 
 class LostItem(Base):
     __tablename__ = "lost_items"
+    __table_args__ = (
+        # open items newest first: the list endpoints and the matching pools
+        Index("ix_lost_items_status", "status", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     details = Column(String)
@@ -16,6 +22,8 @@ class LostItem(Base):
     location_notes = Column(String)  # 場所の詳細説明
     image_urls = Column(String)  # カンマ区切りで保存
     security_info = Column(String)
+    status = Column(String, default="open")  # open / claimed / expired, see retention.py
+    status_changed_at = Column(DateTime)
     created_at = Column(DateTime, default=datetime.utcnow)
 
     locations = relationship("LostItemLocation", back_populates="item", cascade="all, delete")
@@ -25,9 +33,10 @@ class LostItemLocation(Base):
     __tablename__ = "lost_item_locations"
 
     id = Column(Integer, primary_key=True, index=True)
-    item_id = Column(Integer, ForeignKey("lost_items.id"))
+    item_id = Column(Integer, ForeignKey("lost_items.id"), index=True)
     latitude = Column(Float)
     longitude = Column(Float)
+    geocell = Column(String, index=True)  # 空間インデックス用グリッドセル
 
     item = relationship("LostItem", back_populates="locations")
 
@@ -42,21 +51,156 @@ class LostItemLocation(Base):
 
 class FoundItem(Base):
     __tablename__ = "found_items"
+    __table_args__ = (Index("ix_found_items_status", "status", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     kind = Column(String)
     date_found = Column(DateTime)
     latitude = Column(Float)
     longitude = Column(Float)
+    geocell = Column(String, index=True)  # 空間インデックス用グリッドセル
     location_notes = Column(String)
     image_urls = Column(String)
+    import_batch_id = Column(Integer, index=True)  # set for items from a bulk import
+    status = Column(String, default="open")  # open / claimed / expired, see retention.py
+    status_changed_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ImportBatch(Base):
+    __tablename__ = "import_batches"
+
+    # one bulk import of found items (manifest + image archive), matched in a single job
+    id = Column(Integer, primary_key=True, index=True)
+    source = Column(String)  # manifest file name or the --source given to the CLI
+    imported = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.utcnow)
 
 class MatchScore(Base):
     __tablename__ = "match_scores"
+    __table_args__ = (
+        Index("ux_match_scores_pair", "lost_item_id", "found_item_id", unique=True),
+        # serves /api/matched-found-items as one range scan in response order
+        Index("ix_match_scores_lost_score", "lost_item_id", "score", "found_item_id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     lost_item_id = Column(Integer, ForeignKey("lost_items.id"))
-    found_item_id = Column(Integer, ForeignKey("found_items.id"))
+    found_item_id = Column(Integer, ForeignKey("found_items.id"), index=True)
     score = Column(Float)
-    created_at = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class MatchWatermark(Base):
+    __tablename__ = "match_watermarks"
+
+    # every opposite-side item with id <= matched_up_to has been considered for this item
+    item_type = Column(String, primary_key=True)  # "lost" or "found"
+    item_id = Column(Integer, primary_key=True)
+    matched_up_to = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class MatchPairState(Base):
+    __tablename__ = "match_pair_states"
+
+    # pairs that have no score: failed calls counted until matching.MAX_PAIR_FAILURES, then the pair
+    # is settled and never sent again, as is one that can't be scored at all or whose low score
+    # retention pruned
+    lost_item_id = Column(Integer, primary_key=True)
+    found_item_id = Column(Integer, primary_key=True, index=True)
+    failures = Column(Integer, default=0)
+    settled = Column(String)  # None while it is retried; "unscorable" / "failed" / "low_score"
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class MatchJob(Base):
+    __tablename__ = "match_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    item_type = Column(String)  # "lost" or "found"
+    item_id = Column(Integer)
+    status = Column(String, default="queued", index=True)  # queued / running / done / failed
+    attempts = Column(Integer, default=0)
+    lease_owner = Column(String)
+    lease_expires_at = Column(DateTime)
+    total = Column(Integer, default=0)
+    done = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    error = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class TopMatch(Base):
+    __tablename__ = "top_matches"
+    __table_args__ = (
+        # one index range read per item, already in display order
+        Index("ix_top_matches_rank", "side", "item_id", "score", "other_id"),
+    )
+
+    # the best TOP_MATCHES_K scores above the threshold per lost item and per found item, kept in step
+    # with match_scores by top_matches.update_top_matches
+    side = Column(String, primary_key=True)  # "lost": item_id is a lost item, other_id a found item; "found": reversed
+    item_id = Column(Integer, primary_key=True)
+    other_id = Column(Integer, primary_key=True)
+    score = Column(Float)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class MatchEvent(Base):
+    __tablename__ = "match_events"
+
+    # new matches above the threshold, tailed by the API to notify subscribers (see match_events.py)
+    id = Column(Integer, primary_key=True, index=True)
+    lost_item_id = Column(Integer)
+    found_item_id = Column(Integer)
+    score = Column(Float)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class ScoreCacheEntry(Base):
+    __tablename__ = "score_cache"
+
+    key = Column(String, primary_key=True)  # sha256 of model + prompt text + images
+    score = Column(Integer)
+    model = Column(String)
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class ItemEmbedding(Base):
+    __tablename__ = "item_embeddings"
+    __table_args__ = (Index("ix_item_embeddings_item", "item_type", "item_id"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    item_type = Column(String)  # "lost" or "found"
+    item_id = Column(Integer)
+    backend = Column(String)  # embedder name, so switching backends never mixes vector spaces
+    dim = Column(Integer)
+    vector = Column(LargeBinary)  # float32, L2-normalized
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ItemImage(Base):
+    __tablename__ = "item_images"
+    __table_args__ = (
+        # ordinal 0 is the primary image, found with one index seek
+        Index("ux_item_images_item", "item_type", "item_id", "ordinal", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    item_type = Column(String)  # "lost" or "found"
+    item_id = Column(Integer)
+    ordinal = Column(Integer)  # position in the upload
+    path = Column(String)  # original upload
+    content_hash = Column(String, index=True)  # sha256 of the original
+    byte_size = Column(Integer)
+    width = Column(Integer)
+    height = Column(Integer)
+    derived_path = Column(String)  # vision-sized JPEG
+    thumbnail_path = Column(String)  # list/map size, see images.VARIANTS
+    medium_path = Column(String)  # detail view size
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+# keep geocell in sync with latitude/longitude on every insert/update
+@event.listens_for(LostItemLocation, "before_insert")
+@event.listens_for(LostItemLocation, "before_update")
+@event.listens_for(FoundItem, "before_insert")
+@event.listens_for(FoundItem, "before_update")
+def _set_geocell(mapper, connection, target):
+    target.geocell = geocell(target.latitude, target.longitude)
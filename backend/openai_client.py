@@ -0,0 +1,241 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+from typing import Optional
+
+import httpx
+import openai
+from dotenv import load_dotenv
+from logs import get_logger
+from metrics import OPENAI_REQUESTS, OPENAI_SECONDS, record_usage
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+# 共有 OpenAI クライアントの設定
+TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "30"))
+CONNECT_TIMEOUT_SECONDS = float(os.getenv("OPENAI_CONNECT_TIMEOUT_SECONDS", "5"))
+MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY_SECONDS", "30"))
+HTTP2 = os.getenv("OPENAI_HTTP2", "0") == "1"  # needs the h2 package
+# open the circuit after this many consecutive upstream failures, probe again after the cooldown
+BREAKER_FAILURES = int(os.getenv("OPENAI_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("OPENAI_BREAKER_COOLDOWN_SECONDS", "30"))
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_upstream_failure(error: Exception) -> bool:
+    # the service is degraded, as opposed to this request being wrong (4xx) or throttled (429)
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class CircuitBreaker:
+    # closed -> open after `failures` upstream failures in a row; once the cooldown has passed,
+    # one probe call is let through (half-open) and its outcome closes or re-opens the circuit
+
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown_seconds: float = BREAKER_COOLDOWN_SECONDS):
+        self.failures = failures
+        self.cooldown_seconds = cooldown_seconds
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.probing else "open"
+
+    def retry_in(self) -> float:
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.opened_at + self.cooldown_seconds - time.monotonic())
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if not self.probing and time.monotonic() - self.opened_at >= self.cooldown_seconds:
+                self.probing = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError("OpenAI circuit is open; upstream is failing")
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self, error: Exception):
+        with self._lock:
+            if not is_upstream_failure(error):
+                # the service answered, so it is reachable
+                self.consecutive_failures = 0
+                self.opened_at = None
+                self.probing = False
+                return
+            self.consecutive_failures += 1
+            if self.probing or self.consecutive_failures >= self.failures:
+                if self.opened_at is None:
+                    logger.warning("OpenAI circuit opened failures=%d error=%s", self.consecutive_failures, error)
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+    # the call was cancelled before it said anything about the service
+    def record_cancelled(self):
+        with self._lock:
+            self.probing = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.consecutive_failures, "rejected": self.rejected}
+
+
+breaker = CircuitBreaker()
+
+# transports are swappable so tests can point every client at a local fake
+_base_url: Optional[str] = None
+_transport: Optional[httpx.BaseTransport] = None
+_async_transport: Optional[httpx.AsyncBaseTransport] = None
+_sync_client: Optional[openai.OpenAI] = None
+# httpx async pools are bound to the loop that opened them, so keep one client per loop
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, openai.AsyncOpenAI]" = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(TIMEOUT_SECONDS, connect=CONNECT_TIMEOUT_SECONDS)
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+    )
+
+
+def _http2() -> bool:
+    if not HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("OPENAI_HTTP2=1 but the h2 package is missing; using HTTP/1.1")
+        return False
+    return True
+
+
+def configure(
+    base_url: Optional[str] = None,
+    transport: Optional[httpx.BaseTransport] = None,
+    async_transport: Optional[httpx.AsyncBaseTransport] = None,
+):
+    # e.g. configure(base_url="http://127.0.0.1:8001/v1") or an httpx.MockTransport
+    global _base_url, _transport, _async_transport, _sync_client
+    with _lock:
+        _base_url, _transport, _async_transport = base_url, transport, async_transport
+        if _sync_client is not None:
+            _sync_client.close()
+        _sync_client = None
+        _async_clients.clear()
+
+
+def get_sync_client() -> openai.OpenAI:
+    global _sync_client
+    with _lock:
+        if _sync_client is None:
+            http_client = httpx.Client(
+                timeout=_timeout(), limits=_limits(), http2=_http2(), transport=_transport
+            )
+            _sync_client = openai.OpenAI(base_url=_base_url, http_client=http_client)
+        return _sync_client
+
+
+def get_async_client() -> openai.AsyncOpenAI:
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _async_clients.get(loop)
+        if client is None:
+            http_client = httpx.AsyncClient(
+                timeout=_timeout(), limits=_limits(), http2=_http2(), transport=_async_transport
+            )
+            client = _async_clients[loop] = openai.AsyncOpenAI(base_url=_base_url, http_client=http_client)
+        return client
+
+
+# for loops that end with the call (asyncio.run); long-lived loops keep their client
+async def close_async_client():
+    with _lock:
+        client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+def _outcome(error: Exception) -> str:
+    if isinstance(error, CircuitOpenError):
+        return "circuit_open"
+    if isinstance(error, openai.APIStatusError):
+        return str(error.status_code)
+    return type(error).__name__
+
+
+def chat_completion(client: Optional[openai.OpenAI] = None, timeout: Optional[float] = None,
+                    purpose: str = "other", **kwargs):
+    started = time.perf_counter()
+    try:
+        breaker.before_call()
+        client = client or get_sync_client()
+        try:
+            response = client.chat.completions.create(timeout=timeout or TIMEOUT_SECONDS, **kwargs)
+        except Exception as e:
+            breaker.record_failure(e)
+            raise
+        except BaseException:
+            breaker.record_cancelled()
+            raise
+    except Exception as e:
+        OPENAI_REQUESTS.labels(purpose, _outcome(e)).inc()
+        raise
+    breaker.record_success()
+    OPENAI_SECONDS.labels(purpose).observe(time.perf_counter() - started)
+    OPENAI_REQUESTS.labels(purpose, "ok").inc()
+    record_usage(purpose, response)
+    return response
+
+
+async def async_chat_completion(client: Optional[openai.AsyncOpenAI] = None, timeout: Optional[float] = None,
+                                purpose: str = "other", **kwargs):
+    started = time.perf_counter()
+    try:
+        breaker.before_call()
+        client = client or get_async_client()
+        try:
+            response = await client.chat.completions.create(timeout=timeout or TIMEOUT_SECONDS, **kwargs)
+        except Exception as e:
+            breaker.record_failure(e)
+            raise
+        except BaseException:
+            breaker.record_cancelled()
+            raise
+    except Exception as e:
+        OPENAI_REQUESTS.labels(purpose, _outcome(e)).inc()
+        raise
+    breaker.record_success()
+    OPENAI_SECONDS.labels(purpose).observe(time.perf_counter() - started)
+    OPENAI_REQUESTS.labels(purpose, "ok").inc()
+    record_usage(purpose, response)
+    return response
@@ -0,0 +1,196 @@
+import asyncio
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from logs import get_logger
+from openai_client import async_chat_completion
+from security_questions import SECURITY_QUESTIONS, filter_questions_locally
+
+logger = get_logger(__name__)
+
+# セキュリティ質問フィルタのキャッシュ設定
+MODEL = "gpt-4o"
+CACHE_MAX_ENTRIES = int(os.getenv("QUESTIONS_CACHE_MAX_ENTRIES", "5000"))
+CACHE_TTL_SECONDS = float(os.getenv("QUESTIONS_CACHE_TTL_SECONDS", "3600"))
+# past this the rule-filtered (or static) list is returned; the model call keeps running and fills the cache
+LATENCY_BUDGET_SECONDS = float(os.getenv("QUESTIONS_LATENCY_BUDGET_SECONDS", "2.5"))
+LATENCY_SAMPLES = 1000
+# answer from the keyword rules when they settle every question, and only ask the model otherwise
+LOCAL_FILTER = os.getenv("QUESTIONS_LOCAL_FILTER", "1") == "1"
+
+
+def candidate_questions(category: str) -> List[str]:
+    return SECURITY_QUESTIONS.get(category, SECURITY_QUESTIONS["others"])
+
+
+# requests differing only in case or whitespace share an entry
+def question_key(category: str, description: str) -> Tuple[str, str]:
+    return category.strip().lower(), re.sub(r"\s+", " ", description).strip().lower()
+
+
+def build_prompt(category: str, description: str, questions: List[str]) -> str:
+    return f"""
+A user submitted this description of a lost item:
+\"{description}\"
+
+Below is a list of possible security questions related to the item category: '{category}'.
+Your task is to filter out any questions that are already answered or clearly implied by the description.
+Only return questions that are still relevant and unanswered.
+
+⚠ Do not create new questions. Only use the list provided.
+Return the remaining questions as a clean bullet list. No extra commentary.
+
+Candidate questions:
+{chr(10).join(['- ' + q for q in questions])}
+"""
+
+
+def parse_questions(content: str) -> List[str]:
+    return [line.strip("•- ").strip() for line in content.split("\n") if line.strip()]
+
+
+class QuestionCache:
+    # in-memory TTL + LRU of filtered question lists
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl_seconds: float = CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[tuple, Tuple[float, List[str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[List[str]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, questions = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return questions
+
+    def put(self, key: tuple, questions: List[str]):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), questions)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class QuestionFilter:
+    # local rules first, then the cache, then coalesce identical in-flight requests onto one
+    # model call, then enforce the latency budget
+
+    def __init__(self, client=None, budget_seconds: float = LATENCY_BUDGET_SECONDS):
+        self._client = client
+        self.budget_seconds = budget_seconds
+        self.cache = QuestionCache()
+        self._inflight: Dict[tuple, asyncio.Task] = {}
+        self.local = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.errors = 0
+        self._latencies: List[float] = []  # seconds, most recent LATENCY_SAMPLES responses
+
+    async def _ask_model(self, key: tuple, category: str, description: str, questions: List[str]) -> List[str]:
+        try:
+            response = await async_chat_completion(
+                client=self._client,
+                purpose="questions",
+                model=MODEL,
+                messages=[{"role": "user", "content": build_prompt(category, description, questions)}],
+                temperature=0.2
+            )
+            filtered = parse_questions(response.choices[0].message.content or "")
+            self.cache.put(key, filtered)
+            return filtered
+        finally:
+            self._inflight.pop(key, None)
+
+    def _record_latency(self, started: float):
+        self._latencies.append(time.perf_counter() - started)
+        if len(self._latencies) > LATENCY_SAMPLES:
+            del self._latencies[:len(self._latencies) - LATENCY_SAMPLES]
+
+    async def filter(self, category: str, description: str) -> List[str]:
+        started = time.perf_counter()
+        questions = candidate_questions(category)
+        if LOCAL_FILTER:
+            local = filter_questions_locally(category, description)
+            if not local.ambiguous:
+                self.local += 1
+                self._record_latency(started)
+                return local.questions
+            questions = local.questions  # the model only sees what the rules couldn't rule out
+        key = question_key(category, description)
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.hits += 1
+            self._record_latency(started)
+            return cached
+        self.misses += 1
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._ask_model(key, category, description, questions))
+            task.add_done_callback(_consume_exception)
+            self._inflight[key] = task
+        else:
+            self.coalesced += 1
+
+        try:
+            # shield: a timed-out caller must not cancel the call other callers (and the cache) wait on
+            return await asyncio.wait_for(asyncio.shield(task), self.budget_seconds)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return questions
+        except Exception as e:
+            self.errors += 1
+            logger.warning("OpenAI error: %s", e)
+            return questions  # fallback
+        finally:
+            self._record_latency(started)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1)
+
+        return {
+            "local": self.local,
+            "entries": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "coalesced": self.coalesced,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "inflight": len(self._inflight),
+            "latency_ms_p50": percentile(0.50),
+            "latency_ms_p95": percentile(0.95),
+            "latency_ms_p99": percentile(0.99),
+        }
+
+
+def _consume_exception(task: asyncio.Task):
+    # the error is reported to the callers; don't also log "exception was never retrieved"
+    if not task.cancelled():
+        task.exception()
+
+
+question_filter = QuestionFilter()
@@ -0,0 +1,310 @@
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional, Tuple
+
+from database import SessionLocal, writer_session
+from feeds import MATCH_SCORE_THRESHOLD
+from logs import get_logger
+from matching import settle_pairs
+from metrics import timed
+from models import (FoundItem, ImportBatch, ItemEmbedding, ItemImage,
+                    LostItem, LostItemLocation, MatchEvent, MatchJob,
+                    MatchPairState, MatchScore, MatchWatermark)
+from sqlalchemy import delete, exists, func, or_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from storage import UPLOAD_DIR
+from top_matches import remove_top_matches
+
+logger = get_logger(__name__)
+
+# 保管期限と整理
+# items are open until returned to the owner (claimed) or left unclaimed for OPEN_DAYS (expired);
+# only open items are listed and matched. compact() moves claimed and expired items, with their
+# images, to ARCHIVE_DIR, prunes low scores and trims finished match jobs and import batches, so the
+# hot tables and uploads/ hold about the last OPEN_DAYS of items however long the service has been running
+STATUSES = ("open", "claimed", "expired")
+OPEN_DAYS = float(os.getenv("RETENTION_OPEN_DAYS", "90"))  # since registration or the last reopen
+ARCHIVE_AFTER_DAYS = float(os.getenv("RETENTION_ARCHIVE_AFTER_DAYS", "7"))  # closed items can be reopened until then
+LOW_SCORE_DAYS = float(os.getenv("RETENTION_LOW_SCORE_DAYS", "7"))  # scores at or below MATCH_SCORE_THRESHOLD
+JOB_DAYS = float(os.getenv("RETENTION_JOB_DAYS", "7"))  # finished match jobs and spent import batches
+FILE_GRACE_SECONDS = float(os.getenv("RETENTION_FILE_GRACE_SECONDS", "86400"))  # uploads touched since then stay
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "200"))  # items per write transaction
+PRUNE_BATCH = 5000  # match_scores / match_jobs rows per write transaction
+
+MODELS = {"lost": LostItem, "found": FoundItem}
+
+
+class CompactionResult(NamedTuple):
+    expired: int
+    archived_lost: int
+    archived_found: int
+    pruned_scores: int
+    archived_files: int  # written to ARCHIVE_DIR/uploads
+    removed_files: int  # gone from uploads/ (moved originals and their display variants)
+    trimmed_jobs: int  # done or failed match jobs
+    archived_batches: int  # import batches with no found item left
+
+
+# the API side: the previous status, or None if there is no such item
+async def set_item_status(db: AsyncSession, item_type: str, item_id: int, status: str) -> Optional[str]:
+    item = await db.get(MODELS[item_type], item_id)
+    if item is None:
+        return None
+    previous = item.status
+    if status != previous:
+        item.status = status
+        item.status_changed_at = datetime.utcnow()
+        if status == "open":
+            # reconsider every opposite item on the next match job, including those that arrived
+            # while this one was closed (pairs already scored or settled are still skipped)
+            await db.execute(delete(MatchWatermark).where(
+                MatchWatermark.item_type == item_type, MatchWatermark.item_id == item_id
+            ))
+    await db.commit()
+    return previous
+
+
+def _last_change(model):
+    return func.coalesce(model.status_changed_at, model.created_at)
+
+
+def expire_items(now: datetime) -> int:
+    cutoff = now - timedelta(days=OPEN_DAYS)
+    expired = 0
+    with writer_session() as writer:
+        for model in MODELS.values():
+            result = writer.execute(
+                update(model)
+                .where(model.status == "open", _last_change(model) < cutoff)
+                .values(status="expired", status_changed_at=now)
+            )
+            expired += result.rowcount
+    return expired
+
+
+def _columns(row) -> dict:
+    return {column.name: getattr(row, column.name) for column in row.__table__.columns}
+
+
+# one JSON object per item: its row, locations, images and the matches worth keeping
+def _archive_records(db: Session, item_type: str, items: list, images: List[ItemImage], now: datetime) -> List[dict]:
+    ids = [item.id for item in items]
+    item_column, other_column = (
+        (MatchScore.lost_item_id, MatchScore.found_item_id) if item_type == "lost"
+        else (MatchScore.found_item_id, MatchScore.lost_item_id)
+    )
+    records = {
+        item.id: {"item_type": item_type, "archived_at": now, "item": _columns(item),
+                  "locations": [], "images": [], "matches": []}
+        for item in items
+    }
+    for image in images:
+        records[image.item_id]["images"].append(_columns(image))
+    if item_type == "lost":
+        for location in db.query(LostItemLocation).filter(LostItemLocation.item_id.in_(ids)).order_by(LostItemLocation.id):
+            records[location.item_id]["locations"].append(_columns(location))
+    matches = db.query(item_column, other_column, MatchScore.score).filter(
+        item_column.in_(ids), MatchScore.score > MATCH_SCORE_THRESHOLD
+    )
+    for item_id, other_id, score in matches:
+        records[item_id]["matches"].append({"other_id": other_id, "score": score})
+    return list(records.values())
+
+
+def _write_records(name: str, records: List[dict], now: datetime):
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(ARCHIVE_DIR, f"{name}-{now:%Y-%m}.jsonl")
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, default=str, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())  # on disk before the rows are deleted
+
+
+def _delete_items(db: Session, item_type: str, ids: List[int]):
+    model = MODELS[item_type]
+    score_column, event_column, state_column = (
+        (MatchScore.lost_item_id, MatchEvent.lost_item_id, MatchPairState.lost_item_id) if item_type == "lost"
+        else (MatchScore.found_item_id, MatchEvent.found_item_id, MatchPairState.found_item_id)
+    )
+    db.execute(delete(MatchScore).where(score_column.in_(ids)))
+    db.execute(delete(MatchEvent).where(event_column.in_(ids)))
+    db.execute(delete(MatchPairState).where(state_column.in_(ids)))
+    for table in (ItemEmbedding, ItemImage):
+        db.execute(delete(table).where(table.item_type == item_type, table.item_id.in_(ids)))
+    db.execute(delete(MatchWatermark).where(MatchWatermark.item_type == item_type, MatchWatermark.item_id.in_(ids)))
+    if item_type == "lost":
+        db.execute(delete(LostItemLocation).where(LostItemLocation.item_id.in_(ids)))
+    db.execute(delete(model).where(model.id.in_(ids)))
+    remove_top_matches(db, ids if item_type == "lost" else [], ids if item_type == "found" else [])
+
+
+# archives up to BATCH_SIZE closed items; returns how many, and (path, content_hash, variants) of their images
+def _archive_batch(item_type: str, now: datetime) -> Tuple[int, List[tuple]]:
+    model = MODELS[item_type]
+    cutoff = now - timedelta(days=ARCHIVE_AFTER_DAYS)
+    with timed("compaction_batch"), writer_session() as writer:
+        # chosen under the write lock, so an item reopened a moment ago stays
+        items = (
+            writer.query(model)
+            .filter(model.status.in_(("claimed", "expired")), _last_change(model) < cutoff)
+            .order_by(model.id)
+            .limit(BATCH_SIZE)
+            .all()
+        )
+        if not items:
+            return 0, []
+        ids = [item.id for item in items]
+        images = (
+            writer.query(ItemImage)
+            .filter(ItemImage.item_type == item_type, ItemImage.item_id.in_(ids))
+            .order_by(ItemImage.item_id, ItemImage.ordinal)
+            .all()
+        )
+        _write_records(f"{item_type}_items", _archive_records(writer, item_type, items, images, now), now)
+        files = [
+            (image.path, image.content_hash, [image.derived_path, image.thumbnail_path, image.medium_path])
+            for image in images
+        ]
+        _delete_items(writer, item_type, ids)
+    return len(ids), files
+
+
+def _in_uploads(path: str) -> bool:
+    return os.path.normpath(path).startswith(os.path.normpath(UPLOAD_DIR) + os.sep)
+
+
+# uploads are content-addressed and shared by every item with the same photo, so an original is
+# only moved out when no remaining item refers to it and nobody re-uploaded it lately; otherwise
+# the archive gets a copy. display variants of a hash nobody uses any more are deleted
+def _archive_files(files: List[tuple]) -> Tuple[int, int]:
+    archive_uploads = os.path.join(ARCHIVE_DIR, "uploads")
+    os.makedirs(archive_uploads, exist_ok=True)
+    archived = removed = 0
+    db = SessionLocal()
+    try:
+        for path, content_hash, variants in files:
+            if not path or not _in_uploads(path) or not os.path.exists(path):
+                continue
+            dest = os.path.join(archive_uploads, os.path.basename(path))
+            used = ItemImage.path == path
+            if content_hash is not None:
+                used = or_(used, ItemImage.content_hash == content_hash)
+            in_use = db.query(ItemImage.id).filter(used).first() is not None
+            if in_use or time.time() - os.path.getmtime(path) < FILE_GRACE_SECONDS:
+                if not os.path.exists(dest):
+                    shutil.copy2(path, dest)
+                    archived += 1
+                continue
+            if os.path.exists(dest):
+                os.remove(path)
+            else:
+                shutil.move(path, dest)
+                archived += 1
+            removed += 1
+            for variant in variants:
+                if variant and variant != path and os.path.exists(variant):
+                    os.remove(variant)
+                    removed += 1
+    finally:
+        db.close()
+    return archived, removed
+
+
+# scores at or below the threshold are never shown; once LOW_SCORE_DAYS old they only mark the pair
+# as compared. watermarks can't be relied on for that (reopening an item drops its watermark), so
+# each pruned pair is settled in match_pair_states, which is smaller than its match_scores row
+def prune_low_scores(now: datetime) -> int:
+    cutoff = now - timedelta(days=LOW_SCORE_DAYS)
+    pruned = 0
+    last_id = 0
+    while True:
+        with writer_session() as writer:
+            rows = (
+                writer.query(MatchScore.id, MatchScore.lost_item_id, MatchScore.found_item_id)
+                .filter(MatchScore.id > last_id, MatchScore.score <= MATCH_SCORE_THRESHOLD, MatchScore.created_at < cutoff)
+                .order_by(MatchScore.id)
+                .limit(PRUNE_BATCH)
+                .all()
+            )
+            if not rows:
+                return pruned
+            settle_pairs(writer, [(lost_item_id, found_item_id) for _, lost_item_id, found_item_id in rows], "low_score")
+            writer.execute(delete(MatchScore).where(MatchScore.id.in_([score_id for score_id, _, _ in rows])))
+        pruned += len(rows)
+        last_id = rows[-1][0]
+
+
+# match jobs that finished JOB_DAYS ago; /api/match-jobs/{job_id} answers 404 for them afterwards
+def trim_match_jobs(now: datetime) -> int:
+    cutoff = now - timedelta(days=JOB_DAYS)
+    trimmed = 0
+    while True:
+        with writer_session() as writer:
+            ids = [
+                job_id
+                for (job_id,) in writer.query(MatchJob.id)
+                .filter(MatchJob.status.in_(("done", "failed")), MatchJob.updated_at < cutoff)
+                .order_by(MatchJob.id)
+                .limit(PRUNE_BATCH)
+            ]
+            if not ids:
+                return trimmed
+            writer.execute(delete(MatchJob).where(MatchJob.id.in_(ids)))
+        trimmed += len(ids)
+
+
+# import batches older than JOB_DAYS whose found items are all archived and whose match job is not
+# waiting; their rows go to ARCHIVE_DIR like the items
+def archive_import_batches(now: datetime) -> int:
+    cutoff = now - timedelta(days=JOB_DAYS)
+    with writer_session() as writer:
+        batches = (
+            writer.query(ImportBatch)
+            .filter(
+                ImportBatch.created_at < cutoff,
+                ~exists().where(FoundItem.import_batch_id == ImportBatch.id),
+                ~exists().where(
+                    MatchJob.item_type == "import",
+                    MatchJob.item_id == ImportBatch.id,
+                    MatchJob.status.in_(("queued", "running")),
+                ),
+            )
+            .order_by(ImportBatch.id)
+            .all()
+        )
+        if not batches:
+            return 0
+        _write_records("import_batches", [{"archived_at": now, "batch": _columns(batch)} for batch in batches], now)
+        writer.execute(delete(ImportBatch).where(ImportBatch.id.in_([batch.id for batch in batches])))
+    return len(batches)
+
+
+def compact(now: Optional[datetime] = None) -> CompactionResult:
+    now = now or datetime.utcnow()
+    archived = {"lost": 0, "found": 0}
+    archived_files = removed_files = 0
+    with timed("compaction"):
+        expired = expire_items(now)
+        for item_type in MODELS:
+            while True:
+                count, files = _archive_batch(item_type, now)
+                if not count:
+                    break
+                archived[item_type] += count
+                # after the commit: a crash in between leaves the files in uploads/, never loses them
+                copied, removed = _archive_files(files)
+                archived_files += copied
+                removed_files += removed
+        pruned = prune_low_scores(now)
+        trimmed_jobs = trim_match_jobs(now)
+        archived_batches = archive_import_batches(now)
+    result = CompactionResult(expired, archived["lost"], archived["found"], pruned, archived_files, removed_files,
+                              trimmed_jobs, archived_batches)
+    logger.info("Compaction: %s", result._asdict())
+    return result
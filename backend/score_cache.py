@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+from database import SessionLocal
+from metrics import SCORE_CACHE
+from models import ScoreCacheEntry
+from sqlalchemy import bindparam, func, update
+
+# マッチスコアのキャッシュ設定
+MAX_ENTRIES = int(os.getenv("SCORE_CACHE_MAX_ENTRIES", "100000"))
+MAX_AGE_DAYS = float(os.getenv("SCORE_CACHE_MAX_AGE_DAYS", "30"))
+# run eviction after this many inserts
+EVICT_EVERY = 500
+# hits are counted in memory and written with the eviction pass, or after this many distinct keys
+TOUCH_FLUSH_EVERY = 500
+
+
+def cache_key(model: str, messages: list, max_tokens: int) -> str:
+    # messages already hold the prompt text and the base64 image bytes
+    payload = json.dumps(
+        {"model": model, "max_tokens": max_tokens, "messages": messages},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ScoreCache:
+
+    def __init__(self, session_factory=SessionLocal, max_entries: int = MAX_ENTRIES, max_age_days: float = MAX_AGE_DAYS):
+        self.session_factory = session_factory
+        self.max_entries = max_entries
+        self.max_age = timedelta(days=max_age_days)
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._puts = 0
+        self._touched: Dict[str, Tuple[int, datetime]] = {}  # key -> (hits, last used) not yet written
+        self._lock = threading.Lock()
+
+    # a read only: a write per hit would queue every cached pair behind the database's one writer
+    def get(self, key: str) -> Optional[int]:
+        db = self.session_factory()
+        try:
+            entry = db.get(ScoreCacheEntry, key)
+            now = datetime.utcnow()
+            if entry is None or entry.created_at < now - self.max_age:  # expired ones go in the next evict()
+                with self._lock:
+                    self.misses += 1
+                SCORE_CACHE.labels("miss").inc()
+                return None
+            score = entry.score
+        finally:
+            db.close()
+        with self._lock:
+            self.hits += 1
+            hits, _ = self._touched.get(key, (0, now))
+            self._touched[key] = (hits + 1, now)
+            due = len(self._touched) >= TOUCH_FLUSH_EVERY
+        SCORE_CACHE.labels("hit").inc()
+        if due:
+            self.flush_touches()
+        return score
+
+    # hits and last_used_at of the entries read since the last flush, in one transaction
+    def flush_touches(self):
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if not touched:
+            return
+        table = ScoreCacheEntry.__table__
+        stmt = (
+            update(table)
+            .where(table.c.key == bindparam("b_key"))
+            .values(hits=func.coalesce(table.c.hits, 0) + bindparam("b_hits"), last_used_at=bindparam("b_used"))
+        )
+        db = self.session_factory()
+        try:
+            db.execute(stmt, [dict(b_key=key, b_hits=hits, b_used=used) for key, (hits, used) in touched.items()])
+            db.commit()
+        finally:
+            db.close()
+
+    def put(self, key: str, score: int, model: str):
+        db = self.session_factory()
+        try:
+            db.merge(ScoreCacheEntry(key=key, score=score, model=model, hits=0,
+                                     created_at=datetime.utcnow(), last_used_at=datetime.utcnow()))
+            db.commit()
+        finally:
+            db.close()
+        with self._lock:
+            self._puts += 1
+            due = self._puts % EVICT_EVERY == 0
+        if due:
+            self.evict()
+
+    def evict(self) -> int:
+        self.flush_touches()  # so the LRU order below sees recent hits
+        db = self.session_factory()
+        try:
+            removed = (
+                db.query(ScoreCacheEntry)
+                .filter(ScoreCacheEntry.created_at < datetime.utcnow() - self.max_age)
+                .delete(synchronize_session=False)
+            )
+            overflow = db.query(ScoreCacheEntry).count() - self.max_entries
+            if overflow > 0:
+                # least recently used first
+                stale_keys = (
+                    db.query(ScoreCacheEntry.key)
+                    .order_by(ScoreCacheEntry.last_used_at)
+                    .limit(overflow)
+                    .subquery()
+                )
+                removed += (
+                    db.query(ScoreCacheEntry)
+                    .filter(ScoreCacheEntry.key.in_(stale_keys.select()))
+                    .delete(synchronize_session=False)
+                )
+            db.commit()
+        finally:
+            db.close()
+        with self._lock:
+            self.evicted += removed
+        SCORE_CACHE.labels("evicted").inc(removed)
+        return removed
+
+    def stats(self) -> dict:
+        db = self.session_factory()
+        try:
+            entries = db.query(ScoreCacheEntry).count()
+        finally:
+            db.close()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evicted": self.evicted,
+            }
+
+
+score_cache = ScoreCache()
@@ -0,0 +1,37 @@
+import argparse
+
+from database import SessionLocal
+from matching import match_found_item, match_lost_item
+from models import *  # Make sure this imports all models
+
+
+# score every (lost, found) pair that is still missing. each item's watermark is
+# committed as soon as it finishes, so an interrupted run picks up where it stopped
+def backfill_matches(side: str = "lost", start_id: int = 0, full: bool = False):
+    model, match = (LostItem, match_lost_item) if side == "lost" else (FoundItem, match_found_item)
+    db = SessionLocal()
+    try:
+        item_ids = [
+            item_id
+            for (item_id,) in db.query(model.id).filter(model.id > start_id).order_by(model.id)
+        ]
+        print(f"Backfilling matches for {len(item_ids)} {side} items...")
+        for item_id in item_ids:
+            item = db.get(model, item_id)
+            if item is not None:
+                match(item, db, full=full)
+            db.expunge_all()
+    finally:
+        db.close()
+
+# Optional direct run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score missing lost/found pairs")
+    parser.add_argument("--side", choices=["lost", "found"], default="lost",
+                        help="iterate over lost items (default) or found items")
+    parser.add_argument("--start-id", type=int, default=0, help="skip items with id <= this")
+    parser.add_argument("--full", action="store_true",
+                        help="ignore watermarks and reconsider every opposite item, retrying pairs that failed "
+                             "too often (scored and unscorable pairs are still skipped)")
+    args = parser.parse_args()
+    backfill_matches(args.side, args.start_id, args.full)
@@ -0,0 +1,20 @@
+from retention import (ARCHIVE_AFTER_DAYS, ARCHIVE_DIR, JOB_DAYS,
+                       LOW_SCORE_DAYS, OPEN_DAYS, compact)
+from scripts.migrate_db import migrate_database
+
+
+# expire, archive and prune once, e.g. from cron when the worker's own schedule is off
+# (RETENTION_COMPACT_INTERVAL_SECONDS=0)
+def run():
+    print(f"Expiring open items after {OPEN_DAYS:g} days, archiving closed items to '{ARCHIVE_DIR}' "
+          f"after {ARCHIVE_AFTER_DAYS:g} days, pruning low scores after {LOW_SCORE_DAYS:g} days, "
+          f"trimming finished jobs after {JOB_DAYS:g} days")
+    result = compact()
+    for name, value in result._asdict().items():
+        print(f"{name}: {value}")
+    return result
+
+# Optional direct run
+if __name__ == "__main__":
+    migrate_database()
+    run()
@@ -0,0 +1,28 @@
+from database import SessionLocal
+from embeddings import embed_item, get_embedder
+from models import *  # Make sure this imports all models
+
+
+# compute vectors for items uploaded before embeddings were enabled
+def embed_missing_items():
+    embedder = get_embedder()
+    if embedder is None:
+        print("EMBEDDING_BACKEND is 'none'; nothing to do.")
+        return
+    db = SessionLocal()
+    try:
+        for item_type, model in (("lost", LostItem), ("found", FoundItem)):
+            embedded = {
+                item_id
+                for (item_id,) in db.query(ItemEmbedding.item_id).filter_by(item_type=item_type, backend=embedder.name)
+            }
+            missing = [item for item in db.query(model).all() if item.id not in embedded]
+            for item in missing:
+                embed_item(db, item_type, item)
+            print(f"Embedded {len(missing)} {item_type} items")
+    finally:
+        db.close()
+
+# Optional direct run
+if __name__ == "__main__":
+    embed_missing_items()
@@ -0,0 +1,54 @@
+import argparse
+import os
+import socket
+
+from bulk_import import ManifestError, import_found_items
+from database import SessionLocal
+from jobs import claim_job
+from scripts.migrate_db import migrate_database
+from worker import process_job
+
+
+# bulk import from the command line, e.g.
+#   python -m scripts.import_found_items manifest.csv photos.zip --source "Kyoto Station"
+def import_files(manifest_path: str, archive_path: str, source: str = None, match_now: bool = False):
+    with open(manifest_path, "rb") as manifest, open(archive_path, "rb") as archive:
+        result = import_found_items(manifest, os.path.basename(manifest_path), archive, source)
+
+    for error in result.errors:
+        print(f"row {error['row']}: {error['error']}" if error["row"] is not None else error["error"])
+    print(f"Imported {result.imported} found items (batch {result.batch_id}, {len(result.errors)} errors)")
+    if result.job_id is None:
+        return result
+
+    if not match_now:
+        print(f"Matching is queued as job {result.job_id}; the worker will pick it up")
+        return result
+    db = SessionLocal()
+    try:
+        # claimed like a worker would, so a running worker.py doesn't pick it up as well
+        job = claim_job(db, result.job_id, f"{socket.gethostname()}:{os.getpid()}:import")
+    finally:
+        db.close()
+    if job is None:
+        print(f"Match job {result.job_id} was already picked up by a worker")
+        return result
+    print(f"Running match job {result.job_id}...")
+    process_job(job)
+    return result
+
+
+# Optional direct run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import found items from a manifest and an image archive")
+    parser.add_argument("manifest", help="CSV or JSON Lines: kind, date_found, latitude, longitude, location_notes, "
+                             "images (two names, ';'-separated in CSV)")
+    parser.add_argument("archive", help="zip or tar (.tar, .tar.gz, ...) with the images the manifest names")
+    parser.add_argument("--source", help="where the items came from (default: the manifest file name)")
+    parser.add_argument("--match-now", action="store_true", help="run the matching job here instead of in the worker")
+    args = parser.parse_args()
+    migrate_database()
+    try:
+        import_files(args.manifest, args.archive, args.source, args.match_now)
+    except ManifestError as e:
+        parser.exit(1, f"error: {e}\n")
@@ -0,0 +1,118 @@
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from database import Base, create_db_engine
+from feeds import found_item_feed, keyset_page
+from matching import save_match_scores
+from models import FoundItem, LostItem, MatchScore
+from sqlalchemy.orm import sessionmaker
+
+
+# concurrent read/write throughput against a scratch SQLite file,
+# with the default settings and with WAL + pragmas + a dedicated writer connection
+def seed(session_factory, found_count: int, lost_count: int):
+    db = session_factory()
+    try:
+        db.add_all(
+            FoundItem(latitude=35.0 + random.random() / 10, longitude=139.0 + random.random() / 10,
+                      image_urls="", location_notes=f"found {i}")
+            for i in range(found_count)
+        )
+        db.add_all(LostItem(details=f"lost {i}", security_info="", image_urls="") for i in range(lost_count))
+        db.commit()
+    finally:
+        db.close()
+
+
+def run(tuned: bool, threads_read: int, threads_write: int, seconds: float, found_count: int, lost_count: int) -> dict:
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    url = f"sqlite:///{path}"
+    engine = create_db_engine(url, tuned=tuned)
+    writer_engine = create_db_engine(url, writer=True, tuned=tuned) if tuned else engine
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine, autoflush=False)
+    WriterSession = sessionmaker(bind=writer_engine, autoflush=False)
+    seed(Session, found_count, lost_count)
+
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def bump(key):
+        with lock:
+            counts[key] += 1
+
+    def reader():
+        while time.monotonic() < deadline:
+            db = Session()
+            try:
+                cursor = random.randint(1, found_count)
+                keyset_page(found_item_feed(db), FoundItem.id, cursor, 20)
+                db.query(MatchScore).filter(MatchScore.lost_item_id == random.randint(1, lost_count)).all()
+                bump("reads")
+            except Exception:
+                bump("errors")
+            finally:
+                db.close()
+
+    def writer():
+        while time.monotonic() < deadline:
+            db = WriterSession()
+            try:
+                lost_id = random.randint(1, lost_count)
+                now = datetime.utcnow()
+                save_match_scores(db, [
+                    dict(lost_item_id=lost_id, found_item_id=random.randint(1, found_count),
+                         score=float(random.randint(1, 5)), created_at=now)
+                    for _ in range(10)
+                ])
+                db.commit()
+                bump("writes")
+            except Exception:
+                db.rollback()
+                bump("errors")
+            finally:
+                db.close()
+
+    workers = [threading.Thread(target=reader) for _ in range(threads_read)]
+    workers += [threading.Thread(target=writer) for _ in range(threads_write)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    engine.dispose()
+    writer_engine.dispose()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    return {
+        "reads_per_s": counts["reads"] / seconds,
+        "writes_per_s": counts["writes"] / seconds,
+        "errors": counts["errors"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare SQLite read/write throughput with and without tuning")
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--found", type=int, default=5000)
+    parser.add_argument("--lost", type=int, default=500)
+    args = parser.parse_args()
+
+    for label, tuned in (("default", False), ("tuned", True)):
+        result = run(tuned, args.readers, args.writers, args.seconds, args.found, args.lost)
+        print(f"{label:8s} reads/s={result['reads_per_s']:.1f} writes/s={result['writes_per_s']:.1f} "
+              f"errors={result['errors']}")
+
+# Optional direct run
+if __name__ == "__main__":
+    main()
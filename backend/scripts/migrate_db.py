@@ -0,0 +1,114 @@
+from database import Base, SessionLocal, engine
+from geo import geocell
+from item_images import backfill_item_images, backfill_variant_paths
+from logs import get_logger
+from models import *  # Make sure this imports all models
+from sqlalchemy import inspect, text, update
+from top_matches import rebuild_top_matches, top_matches_empty
+
+logger = get_logger("migrate_db")
+
+
+def add_missing_columns():
+    # create_all() never alters existing tables, so add new nullable columns by hand
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                col_type = column.type.compile(dialect=engine.dialect)
+                logger.info("Adding column %s.%s", table.name, column.name)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"))
+
+
+def dedupe_match_scores():
+    # keep the newest score per (lost, found) pair so the unique index can be built
+    inspector = inspect(engine)
+    if not inspector.has_table("match_scores"):
+        return
+    if "ux_match_scores_pair" in {i["name"] for i in inspector.get_indexes("match_scores")}:
+        return
+    with engine.begin() as conn:
+        result = conn.execute(text(
+            "DELETE FROM match_scores WHERE id NOT IN "
+            "(SELECT MAX(id) FROM match_scores GROUP BY lost_item_id, found_item_id)"
+        ))
+        if result.rowcount:
+            logger.info("Removed %d duplicate match_scores rows", result.rowcount)
+
+
+def delete_failed_scores():
+    # -1 rows from before failed pairs were left unscored; without them backfill_matches retries the pairs
+    with engine.begin() as conn:
+        result = conn.execute(text("DELETE FROM match_scores WHERE score < 0"))
+        if result.rowcount:
+            logger.info("Removed %d failed match_scores rows", result.rowcount)
+
+
+def create_missing_indexes():
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+def backfill_geocells():
+    db = SessionLocal()
+    try:
+        for model in (FoundItem, LostItemLocation):
+            rows = db.query(model).filter(model.geocell.is_(None), model.latitude.isnot(None)).all()
+            for row in rows:
+                row.geocell = geocell(row.latitude, row.longitude)
+            if rows:
+                logger.info("Backfilled geocell for %d %s rows", len(rows), model.__tablename__)
+        db.commit()
+    finally:
+        db.close()
+
+
+def backfill_images():
+    db = SessionLocal()
+    try:
+        backfill_item_images(db)
+        backfill_variant_paths(db)
+    finally:
+        db.close()
+
+
+# items from before the status lifecycle are open
+def backfill_item_status():
+    with engine.begin() as conn:
+        for model in (LostItem, FoundItem):
+            result = conn.execute(update(model).where(model.status.is_(None)).values(status="open"))
+            if result.rowcount:
+                logger.info("Marked %d %s rows open", result.rowcount, model.__tablename__)
+
+
+# fill top_matches the first time; afterwards every score write keeps it up to date
+def backfill_top_matches():
+    db = SessionLocal()
+    try:
+        if top_matches_empty(db) and db.query(MatchScore.id).first() is not None:
+            rebuild_top_matches(db)
+            logger.info("Built top_matches from match_scores")
+    finally:
+        db.close()
+
+
+def migrate_database():
+    Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+    dedupe_match_scores()
+    delete_failed_scores()
+    create_missing_indexes()
+    backfill_geocells()
+    backfill_images()
+    backfill_item_status()
+    backfill_top_matches()
+
+# Optional direct run
+if __name__ == "__main__":
+    migrate_database()
@@ -0,0 +1,17 @@
+from database import SessionLocal
+from top_matches import TOP_K, rebuild_top_matches
+
+
+# top_matches only keeps scores above MATCH_SCORE_THRESHOLD and TOP_MATCHES_K per item;
+# run this after changing either
+def rebuild():
+    db = SessionLocal()
+    try:
+        rebuild_top_matches(db)
+        print(f"Rebuilt top_matches (K={TOP_K})")
+    finally:
+        db.close()
+
+# Optional direct run
+if __name__ == "__main__":
+    rebuild()
@@ -1,3 +1,6 @@
+import re
+from typing import Callable, Dict, List, NamedTuple, Optional
+
 SECURITY_QUESTIONS = {
     "phone": [
         "Describe your lockscreen wallpaper.",
@@ -52,3 +55,192 @@ SECURITY_QUESTIONS = {
         "Please be as specific as possible in your description of the item.",
     ]
 }
+
+
+# ローカルフィルタ: each question is tagged with the attribute it asks about, and an extractor
+# per tag reads the description and answers True (already given), False (not given) or
+# None (mentioned, but we can't tell whether it answers the question -> ask the model)
+QUESTION_TAGS = {
+    "Describe your lockscreen wallpaper.": "wallpaper",
+    "What model is your phone (e.g. iPhone 13)?": "model",
+    "What is the phone's colour?": "colour",
+    "Do you have a phone case? If yes, what colour/design?": "case",
+    "Is there any visible damage or cracks? Where?": "damage",
+    "What colour is the laptop?": "colour",
+    "Does it have any stickers or decals? If so, describe them.": "stickers",
+    "What model is the laptop (e.g. MacBook Pro 2020)?": "model",
+    "Is there any visible damage or scratches? Where?": "damage",
+    "What username shows on the login screen?": "username",
+    "Does it have a case or sleeve? If yes, describe it.": "case",
+    "What brand/model is it?": "model",
+    "What colour is the case or the earbuds?": "colour",
+    "Do they have any specific markings or logos?": "markings",
+    "Are they wired or wireless?": "wireless",
+    "Do they have a charging case? If yes, describe it.": "case",
+    "What is its bluetooth name (if applicable)?": "bluetooth_name",
+    "What colour or material is the wallet?": "colour_material",
+    "What items were inside the wallet?": "contents",
+    "Any specific markings or brand on the wallet?": "markings",
+    "Roughly how mmuch cash was inside?": "cash",
+    "Any specific marks or features? (e.g. zipper, stickers, buttons)": "features",
+    "What brand is the bag?": "brand",
+    "What items were inside?": "contents",
+    "Describe the bag's colour and material.": "colour_material",
+    "Does it have any specific features (e.g. pockets, straps)?": "features",
+    "What there anything attached? (e.g. keychain, charm, tag)": "attachments",
+    "How many keys were on the keychain or keyring?": "count",
+    "Was there a keychain accessory? If so, describe it.": "attachments",
+    "What colour are the keys?": "colour",
+    "What type of ID card is it (e.g. driver's license, student ID, credit card)?": "card_type",
+    "What is the name on the ID card?": "card_name",
+    "What colour is the ID card?": "colour",
+    "Does it have any specific markings or features?": "markings",
+    "What is the ID card's number or unique identifier?": "card_number",
+}
+
+
+# word edges for latin text: \b would need a non-word character next to the match, and kana and
+# kanji are word characters, so "黒いiPhone 13です" would match nothing
+START = r"(?<![A-Za-z0-9])"
+END = r"(?![A-Za-z0-9])"
+
+
+def _words(*words: str) -> re.Pattern:
+    # whole words for latin text; Japanese has no word boundaries, so match it anywhere
+    latin = [re.escape(w) for w in words if w.isascii()]
+    other = [re.escape(w) for w in words if not w.isascii()]
+    parts = [rf"{START}(?:{'|'.join(latin)}){END}"] if latin else []
+    if other:
+        parts.append("|".join(other))
+    return re.compile("|".join(parts), re.IGNORECASE)
+
+
+COLOURS = _words(
+    "black", "white", "red", "blue", "green", "yellow", "pink", "purple", "orange", "grey", "gray",
+    "silver", "gold", "golden", "brown", "beige", "navy", "cream", "teal", "turquoise", "violet",
+    "transparent", "clear", "rose gold", "space grey", "space gray", "midnight", "starlight",
+    "黒", "白", "赤", "青", "緑", "黄", "ピンク", "紫", "オレンジ", "灰", "グレー", "銀", "シルバー",
+    "金", "ゴールド", "茶", "ベージュ", "紺", "ネイビー", "透明",
+)
+MATERIALS = _words(
+    "leather", "canvas", "nylon", "plastic", "metal", "fabric", "cotton", "denim", "suede",
+    "polyester", "rubber", "silicone", "aluminium", "aluminum", "wool",
+    "革", "レザー", "ナイロン", "布", "プラスチック", "金属", "シリコン",
+)
+BRANDS = _words(
+    "apple", "iphone", "ipad", "macbook", "airpods", "samsung", "galaxy", "google", "pixel", "sony",
+    "xperia", "sharp", "aquos", "huawei", "xiaomi", "oppo", "motorola", "nokia", "dell", "hp",
+    "lenovo", "thinkpad", "asus", "acer", "microsoft", "surface", "fujitsu", "panasonic", "nec",
+    "toshiba", "dynabook", "bose", "beats", "jabra", "sennheiser", "anker", "audio-technica",
+    "louis vuitton", "gucci", "prada", "coach", "chanel", "hermes", "nike", "adidas", "puma",
+    "north face", "patagonia", "porter", "muji", "uniqlo", "herschel", "fjallraven", "kanken",
+    "アップル", "ソニー", "シャープ", "無印", "ユニクロ", "ポーター",
+)
+# a brand or product line followed by a model number or tier, e.g. "iPhone 13", "MacBook Pro"
+MODEL_NAMES = re.compile(
+    START + r"(?:iphone|ipad|galaxy|pixel|xperia|aquos|macbook|thinkpad|surface|airpods|wf|wh|qc)"
+    r"(?:\s*(?:air|pro|max|mini|plus|ultra|se))*\s*[a-z]?\d{1,4}[a-z]*" + END
+    + r"|" + START + r"(?:macbook|airpods)\s+(?:air|pro|max)" + END,
+    re.IGNORECASE,
+)
+NUMBER_WORDS = r"(?:\d+|a|one|two|three|four|five|six|seven|eight|nine|ten|a few|several|一|二|三|四|五)"
+KEY_COUNT = re.compile(rf"{START}{NUMBER_WORDS}\s+keys?{END}|[0-9一二三四五]+\s*(?:本|個)の?(?:鍵|カギ)", re.IGNORECASE)
+CASH_AMOUNT = re.compile(r"[¥$€£]\s?\d|\d[\d,]*\s*(?:yen|dollars?|円)|" + START + r"no cash" + END + r"|現金なし", re.IGNORECASE)
+CASE = _words("case", "cover", "sleeve", "pouch", "ケース", "カバー")
+DAMAGE = _words("crack", "cracked", "cracks", "scratch", "scratched", "scratches", "dent", "dented",
+                "broken", "damage", "damaged", "chipped", "傷", "ひび", "割れ", "へこみ")
+STICKERS = _words("sticker", "stickers", "decal", "decals", "ステッカー", "シール")
+WIRELESS = _words("wireless", "wired", "bluetooth", "cable", "cord", "truly wireless", "ワイヤレス", "有線", "無線")
+MARKINGS = _words("logo", "logos", "marking", "markings", "engraved", "engraving", "initials",
+                  "monogram", "ロゴ", "刻印", "イニシャル")
+FEATURES = _words("zip", "zipper", "pocket", "pockets", "strap", "straps", "button", "buttons",
+                  "buckle", "clasp", "handle", "ファスナー", "ジッパー", "ポケット", "ストラップ", "ボタン")
+ATTACHMENTS = _words("keychain", "keyring", "key ring", "charm", "tag", "pendant", "キーホルダー", "チャーム", "タグ")
+CARD_TYPES = _words("license", "licence", "student id", "student card", "credit card", "debit card",
+                    "residence card", "my number", "insurance card", "passport", "suica", "pasmo",
+                    "免許", "学生証", "クレジットカード", "在留カード", "マイナンバー", "保険証", "定期券")
+CONTENTS = re.compile(START + r"(?:inside|contain(?:s|ed|ing)?|with (?:my|a|an|some))" + END + r"|入って", re.IGNORECASE)
+NAMED = re.compile(START + r"(?:name(?:d)?|called|username|user name)" + END + r"|名前", re.IGNORECASE)
+# shown on the device only to the owner; a vague mention could be a hint or a guess
+SECRET_HINTS = {
+    "wallpaper": _words("wallpaper", "lockscreen", "lock screen", "background", "壁紙", "待ち受け"),
+    "username": NAMED,
+    "bluetooth_name": NAMED,
+    "card_name": NAMED,
+    "card_number": _words("number", "id number", "番号"),
+}
+
+
+def _found(pattern: re.Pattern) -> Callable[[str], Optional[bool]]:
+    return lambda text: bool(pattern.search(text))
+
+
+def _model(text: str) -> Optional[bool]:
+    if MODEL_NAMES.search(text):
+        return True
+    return None if BRANDS.search(text) else False  # a brand alone may or may not settle the model
+
+
+def _colour_material(text: str) -> Optional[bool]:
+    colour, material = bool(COLOURS.search(text)), bool(MATERIALS.search(text))
+    if colour and material:
+        return True
+    return None if colour or material else False
+
+
+def _cash(text: str) -> Optional[bool]:
+    if CASH_AMOUNT.search(text):
+        return True
+    return None if re.search(START + r"(?:cash|money)" + END + r"|現金|お金", text, re.IGNORECASE) else False
+
+
+def _count(text: str) -> Optional[bool]:
+    return True if KEY_COUNT.search(text) else False
+
+
+def _secret(tag: str) -> Callable[[str], Optional[bool]]:
+    hint = SECRET_HINTS[tag]
+    return lambda text: None if hint.search(text) else False
+
+
+def _maybe(pattern: re.Pattern) -> Callable[[str], Optional[bool]]:
+    return lambda text: None if pattern.search(text) else False
+
+
+EXTRACTORS: Dict[str, Callable[[str], Optional[bool]]] = {
+    "colour": _found(COLOURS),
+    "colour_material": _colour_material,
+    "brand": _found(BRANDS),
+    "model": _model,
+    "case": _found(CASE),
+    "damage": _found(DAMAGE),
+    "stickers": _found(STICKERS),
+    "wireless": _found(WIRELESS),
+    "markings": _found(MARKINGS),
+    "features": _found(FEATURES),
+    "attachments": _found(ATTACHMENTS),
+    "card_type": _found(CARD_TYPES),
+    "count": _count,
+    "cash": _cash,
+    "contents": _maybe(CONTENTS),  # can't tell whether a list of contents is complete
+    **{tag: _secret(tag) for tag in SECRET_HINTS},
+}
+
+
+class LocalFilterResult(NamedTuple):
+    questions: List[str]  # still unanswered, ambiguous ones included
+    ambiguous: List[str]  # the model should decide these
+
+
+# keyword pass over the candidate questions; untagged questions are always kept
+def filter_questions_locally(category: str, description: str) -> LocalFilterResult:
+    candidates = SECURITY_QUESTIONS.get(category, SECURITY_QUESTIONS["others"])
+    remaining, ambiguous = [], []
+    for question in candidates:
+        tag = QUESTION_TAGS.get(question)
+        answered = EXTRACTORS[tag](description) if tag else False
+        if answered is None:
+            ambiguous.append(question)
+        if not answered:
+            remaining.append(question)
+    return LocalFilterResult(remaining, ambiguous)
@@ -0,0 +1,92 @@
+from typing import List, Optional, Tuple
+
+from geo import bounding_box, cell_count, cells_within, haversine_km
+from models import FoundItem, LostItem, LostItemLocation
+from sqlalchemy.orm import Query, Session
+
+# beyond this many grid cells an IN (...) lookup costs more than a lat/lon range scan
+MAX_CELLS = 400
+
+
+def _filter_near(query: Query, model, latitude: float, longitude: float, radius_km: float) -> Query:
+    # counted first: the list grows with radius² and a large radius would never finish building it
+    if cell_count(latitude, longitude, radius_km) <= MAX_CELLS:
+        return query.filter(model.geocell.in_(cells_within(latitude, longitude, radius_km)))
+    min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_km)
+    return query.filter(
+        model.latitude.between(min_lat, max_lat),
+        model.longitude.between(min_lon, max_lon),
+    )
+
+
+# found items within radius_km of the point, nearest first, with their distance
+def found_items_within(
+    db: Session,
+    latitude: float,
+    longitude: float,
+    radius_km: float,
+    query: Optional[Query] = None,
+) -> List[Tuple[FoundItem, float]]:
+    if query is None:
+        query = db.query(FoundItem)
+    results = []
+    for item in _filter_near(query, FoundItem, latitude, longitude, radius_km):
+        distance = haversine_km(latitude, longitude, item.latitude, item.longitude)
+        if distance <= radius_km:
+            results.append((item, distance))
+    results.sort(key=lambda r: r[1])
+    return results
+
+
+# the k nearest found items, searching outward in growing rings up to max_radius_km
+def nearest_found_items(
+    db: Session,
+    latitude: float,
+    longitude: float,
+    k: int,
+    max_radius_km: float = 50.0,
+    query: Optional[Query] = None,
+) -> List[Tuple[FoundItem, float]]:
+    radius_km = min(1.0, max_radius_km)
+    while True:
+        results = found_items_within(db, latitude, longitude, radius_km, query)
+        if len(results) >= k or radius_km >= max_radius_km:
+            return results[:k]
+        radius_km = min(radius_km * 4, max_radius_km)
+
+
+# found items within radius_km of at least one of the points
+def found_items_near_any(
+    db: Session,
+    points: List[Tuple[float, float]],
+    radius_km: float,
+    query: Optional[Query] = None,
+) -> List[FoundItem]:
+    items = {}
+    for latitude, longitude in points:
+        for item, _ in found_items_within(db, latitude, longitude, radius_km, query):
+            items[item.id] = item
+    return list(items.values())
+
+
+# lost items with at least one LostItemLocation within radius_km of the point
+def lost_items_near(
+    db: Session,
+    latitude: float,
+    longitude: float,
+    radius_km: float,
+    query: Optional[Query] = None,
+) -> List[LostItem]:
+    locations = _filter_near(
+        db.query(LostItemLocation), LostItemLocation, latitude, longitude, radius_km
+    )
+    item_ids = {
+        loc.item_id
+        for loc in locations
+        if haversine_km(latitude, longitude, loc.latitude, loc.longitude) <= radius_km
+    }
+    if not item_ids:
+        return []
+    if query is None:
+        query = db.query(LostItem)
+    return query.filter(LostItem.id.in_(item_ids)).all()
@@ -0,0 +1,211 @@
+import hashlib
+import logging
+import os
+import re
+import uuid
+from typing import Dict, List, Optional
+
+from database import SessionLocal
+from fastapi import HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.staticfiles import StaticFiles
+from images import content_etag, make_variant, parse_variant_name
+from item_images import original_path_for_hash
+from logs import get_logger, log_sampled
+from metrics import timed
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse
+
+logger = get_logger(__name__)
+
+# アップロードの上限とチャンクサイズ
+UPLOAD_DIR = "uploads"
+MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(15 * 1024 * 1024)))
+MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(40 * 1024 * 1024)))
+# bulk imports carry a whole office's photos in one archive
+MAX_BULK_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_BULK_REQUEST_BYTES", str(2 * 1024 * 1024 * 1024)))
+CHUNK_BYTES = 1024 * 1024
+
+# content-addressed files never change, so browsers and CDNs may keep them for a year
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MUTABLE_CACHE_CONTROL = "public, max-age=3600"
+
+
+def _extension(filename: str) -> str:
+    ext = os.path.splitext(filename or "")[1].lower()
+    return ext if re.fullmatch(r"\.[a-z0-9]{1,5}", ext) else ".jpg"
+
+
+def _write_chunk(f, digest, chunk: bytes):
+    digest.update(chunk)
+    f.write(chunk)
+
+
+def _finalize(tmp_path: str, final_path: str):
+    # identical content is already stored under the same name, so keep one copy; touching it
+    # tells compaction (retention.py) that a new item is about to reference it
+    try:
+        os.utime(final_path)
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        os.replace(tmp_path, final_path)
+
+
+# stream one upload to uploads/<sha256><ext>, enforcing the per-file cap as it goes
+async def save_upload(img: UploadFile, max_bytes: int = MAX_FILE_BYTES) -> str:
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    tmp_path = os.path.join(UPLOAD_DIR, f".{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    size = 0
+    f = await run_in_threadpool(open, tmp_path, "wb")
+    try:
+        while True:
+            chunk = await img.read(CHUNK_BYTES)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=f"{img.filename} exceeds {max_bytes} bytes")
+            await run_in_threadpool(_write_chunk, f, digest, chunk)
+    except BaseException:
+        await run_in_threadpool(f.close)
+        await run_in_threadpool(os.remove, tmp_path)
+        raise
+    await run_in_threadpool(f.close)
+
+    final_path = f"{UPLOAD_DIR}/{digest.hexdigest()}{_extension(img.filename)}"
+    await run_in_threadpool(_finalize, tmp_path, final_path)
+    return final_path
+
+
+# the same for a file that is already on this side (a bulk import archive member), without the event loop
+def store_file(src, filename: str, max_bytes: int = MAX_FILE_BYTES) -> str:
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    tmp_path = os.path.join(UPLOAD_DIR, f".{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            while True:
+                chunk = src.read(CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError(f"{filename} exceeds {max_bytes} bytes")
+                _write_chunk(f, digest, chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    final_path = f"{UPLOAD_DIR}/{digest.hexdigest()}{_extension(filename)}"
+    _finalize(tmp_path, final_path)
+    return final_path
+
+
+async def save_uploads(images: List[UploadFile]) -> List[str]:
+    with timed("upload_save"):
+        return [await save_upload(img) for img in images]
+
+
+class UploadLimitMiddleware:
+    # rejects request bodies over max_bytes with 413, from Content-Length when the
+    # client sends it and otherwise by counting bytes while the body streams in
+
+    def __init__(self, app, max_bytes: int = MAX_REQUEST_BYTES, path_limits: Optional[Dict[str, int]] = None):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.path_limits = path_limits or {}  # exact path -> its own cap
+
+    async def _reject(self, send):
+        body = b'{"detail":"request body too large"}'
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "PUT"):
+            await self.app(scope, receive, send)
+            return
+
+        max_bytes = self.path_limits.get(scope["path"], self.max_bytes)
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > max_bytes:
+            await self._reject(send)
+            return
+
+        received = 0
+        exceeded = False
+        started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            if exceeded:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    exceeded = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            nonlocal started
+            if exceeded:
+                # the app saw a disconnect; answer with 413 instead of whatever it produced
+                if message["type"] == "http.response.start" and not started:
+                    started = True
+                    await self._reject(send)
+                return
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not exceeded:
+                raise
+            if not started:
+                await self._reject(send)
+
+
+class UploadStaticFiles(StaticFiles):
+    # /uploads with strong content-hash ETags and immutable caching for hashed names;
+    # thumbnail/medium variants that don't exist yet are rendered on first request
+
+    def _render_variant(self, content_hash: str, variant: str):
+        db = SessionLocal()
+        try:
+            original = original_path_for_hash(db, content_hash)
+        finally:
+            db.close()
+        if original is None or not os.path.exists(original):
+            return
+        try:
+            make_variant(original, content_hash, variant)
+        except Exception as e:
+            log_sampled(logger, logging.WARNING, "Failed to render %s for '%s': %s", variant, original, e)
+
+    async def get_response(self, path: str, scope):
+        parsed = parse_variant_name(os.path.basename(path))
+        if parsed is not None and not os.path.exists(os.path.join(self.directory, path)):
+            await run_in_threadpool(self._render_variant, *parsed)
+        return await super().get_response(path, scope)
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        etag = content_etag(str(full_path))
+        if etag is not None:
+            response.headers["etag"] = etag
+            response.headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            response.headers["cache-control"] = MUTABLE_CACHE_CONTROL
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -0,0 +1,180 @@
+import os
+from datetime import datetime
+from typing import List, Optional, Set, Tuple
+
+from feeds import (MATCH_SCORE_THRESHOLD, found_match_columns, is_open,
+                   lost_match_columns, matched_found_page, matched_lost_page,
+                   score_page)
+from models import FoundItem, LostItem, MatchScore, TopMatch
+from sqlalchemy import and_, delete, func, insert, literal, or_, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+# 上位マッチの実体化: per item, only the best K scores above the threshold are kept, so the
+# matched-item endpoints read at most K index entries however many pairs have been scored
+TOP_K = int(os.getenv("TOP_MATCHES_K", "50"))
+
+# (side, item column, other column) of match_scores for each direction
+SIDES = (
+    ("lost", MatchScore.lost_item_id, MatchScore.found_item_id),
+    ("found", MatchScore.found_item_id, MatchScore.lost_item_id),
+)
+
+
+def _upsert(db: Session, entries: List[dict]):
+    if not entries:
+        return
+    dialect = db.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        insert_ = sqlite.insert if dialect == "sqlite" else postgresql.insert
+        stmt = insert_(TopMatch).values(entries)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["side", "item_id", "other_id"],
+            set_={"score": stmt.excluded.score, "updated_at": stmt.excluded.updated_at},
+        )
+        db.execute(stmt)
+        return
+    for entry in entries:
+        db.merge(TopMatch(**entry))
+
+
+# drop everything below the K best of one item
+def _trim(db: Session, side: str, item_id: int, k: int):
+    kept = (
+        select(TopMatch.other_id)
+        .where(TopMatch.side == side, TopMatch.item_id == item_id)
+        .order_by(TopMatch.score.desc(), TopMatch.other_id.desc())
+        .limit(k)
+    )
+    db.execute(delete(TopMatch).where(
+        TopMatch.side == side, TopMatch.item_id == item_id, TopMatch.other_id.not_in(kept)
+    ))
+
+
+# reload one item from match_scores, after one of its kept scores fell under the threshold
+def _refill(db: Session, side: str, item_id: int, k: int):
+    _, item_column, other_column = next(s for s in SIDES if s[0] == side)
+    rows = (
+        db.query(other_column, MatchScore.score)
+        .filter(item_column == item_id, MatchScore.score > MATCH_SCORE_THRESHOLD)
+        .order_by(MatchScore.score.desc(), other_column.desc())
+        .limit(k)
+        .all()
+    )
+    now = datetime.utcnow()
+    _upsert(db, [dict(side=side, item_id=item_id, other_id=other_id, score=score, updated_at=now)
+                 for other_id, score in rows])
+
+
+# called with every batch of rows written to match_scores, in the same transaction
+def update_top_matches(db: Session, rows: List[dict], k: int = TOP_K):
+    now = datetime.utcnow()
+    kept, below = [], []
+    for row in rows:
+        for side, item_id, other_id in (("lost", row["lost_item_id"], row["found_item_id"]),
+                                        ("found", row["found_item_id"], row["lost_item_id"])):
+            entry = dict(side=side, item_id=item_id, other_id=other_id, score=row["score"], updated_at=now)
+            (kept if row["score"] > MATCH_SCORE_THRESHOLD else below).append(entry)
+
+    _upsert(db, kept)
+    touched: Set[Tuple[str, int]] = {(entry["side"], entry["item_id"]) for entry in kept}
+
+    # a re-scored pair that dropped under the threshold leaves its items' lists
+    if below:
+        keys = [(entry["side"], entry["item_id"], entry["other_id"]) for entry in below]
+        demoted = db.query(TopMatch.side, TopMatch.item_id, TopMatch.other_id).filter(
+            tuple_(TopMatch.side, TopMatch.item_id, TopMatch.other_id).in_(keys)
+        ).all()
+        if demoted:
+            db.execute(delete(TopMatch).where(
+                tuple_(TopMatch.side, TopMatch.item_id, TopMatch.other_id).in_([tuple(key) for key in demoted])
+            ))
+            for side, item_id in {(side, item_id) for side, item_id, _ in demoted}:
+                _refill(db, side, item_id, k)
+                touched.add((side, item_id))
+
+    for side, item_id in touched:
+        _trim(db, side, item_id, k)
+
+
+# rebuild both directions from match_scores (first migration, or after changing the threshold or K)
+def rebuild_top_matches(db: Session, k: int = TOP_K):
+    db.execute(delete(TopMatch))
+    now = datetime.utcnow()
+    for side, item_column, other_column in SIDES:
+        rank = func.row_number().over(
+            partition_by=item_column, order_by=(MatchScore.score.desc(), other_column.desc())
+        ).label("rank")
+        ranked = (
+            select(item_column.label("item_id"), other_column.label("other_id"), MatchScore.score, rank)
+            .where(MatchScore.score > MATCH_SCORE_THRESHOLD)
+            .subquery()
+        )
+        db.execute(insert(TopMatch).from_select(
+            ["side", "item_id", "other_id", "score", "updated_at"],
+            select(literal(side), ranked.c.item_id, ranked.c.other_id, ranked.c.score, literal(now))
+            .where(ranked.c.rank <= k),
+        ))
+    db.commit()
+
+
+# drop archived items from both directions, after their match_scores rows are gone; the items
+# that lose an entry are refilled from match_scores
+def remove_top_matches(db: Session, lost_ids: List[int], found_ids: List[int], k: int = TOP_K):
+    as_other = or_(
+        and_(TopMatch.side == "lost", TopMatch.other_id.in_(found_ids)),
+        and_(TopMatch.side == "found", TopMatch.other_id.in_(lost_ids)),
+    )
+    affected = db.query(TopMatch.side, TopMatch.item_id).filter(as_other).distinct().all()
+    db.execute(delete(TopMatch).where(or_(
+        as_other,
+        and_(TopMatch.side == "lost", TopMatch.item_id.in_(lost_ids)),
+        and_(TopMatch.side == "found", TopMatch.item_id.in_(found_ids)),
+    )))
+    archived = {("lost", item_id) for item_id in lost_ids} | {("found", item_id) for item_id in found_ids}
+    for side, item_id in set(affected) - archived:
+        _refill(db, side, item_id, k)
+        _trim(db, side, item_id, k)
+
+
+def top_matches_empty(db: Session) -> bool:
+    return db.query(TopMatch.item_id).first() is None
+
+
+# a page from the view, or None when it can't answer: a threshold below the one it keeps, or a
+# page that runs past the K rows of an item that has more
+def _top_page(db: Session, side: str, item_id: int, columns: list, other_model, threshold: float,
+              cursor: Optional[Tuple[float, int]], limit: int, k: int = TOP_K):
+    if threshold < MATCH_SCORE_THRESHOLD:
+        return None
+    query = (
+        db.query(*columns, TopMatch.score)
+        .select_from(TopMatch)
+        .join(other_model, other_model.id == TopMatch.other_id)
+        .filter(TopMatch.side == side, TopMatch.item_id == item_id, TopMatch.score > threshold,
+                is_open(other_model))
+    )
+    rows, next_cursor = score_page(query, TopMatch.score, TopMatch.other_id, cursor, limit)
+    if next_cursor is None:
+        kept = db.query(func.count()).select_from(TopMatch).filter(
+            TopMatch.side == side, TopMatch.item_id == item_id
+        ).scalar()
+        if kept >= k:
+            return None
+    return rows, next_cursor
+
+
+def matched_found_items(db: Session, lost_item_id: int, threshold: float,
+                        cursor: Optional[Tuple[float, int]], limit: int) -> Tuple[list, Optional[str]]:
+    page = _top_page(db, "lost", lost_item_id, found_match_columns(), FoundItem, threshold, cursor, limit)
+    if page is None:
+        page = matched_found_page(db, lost_item_id, threshold, cursor, limit)
+    return page
+
+
+def matched_lost_items(db: Session, found_item_id: int, threshold: float,
+                       cursor: Optional[Tuple[float, int]], limit: int) -> Tuple[list, Optional[str]]:
+    page = _top_page(db, "found", found_item_id, lost_match_columns(), LostItem, threshold, cursor, limit)
+    if page is None:
+        page = matched_lost_page(db, found_item_id, threshold, cursor, limit)
+    return page
@@ -0,0 +1,157 @@
+# マッチングワーカー
+# match_jobs テーブルからジョブを取り出してマッチングを実行する
+#
+#   cd backend && python worker.py          # run forever
+#   cd backend && python worker.py --once   # drain the queue and exit
+import argparse
+import os
+import socket
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from database import SessionLocal
+from jobs import (claim_jobs, complete_job, fail_job, record_progress,
+                  release_job, renew_lease)
+from logs import get_logger
+from matching import match_found_item, match_import_batch, match_lost_item
+from metrics import MATCH_JOBS, STAGE_SECONDS, start_metrics_server
+from models import FoundItem, ImportBatch, LostItem, MatchJob
+from openai_client import CircuitOpenError, breaker
+from retention import compact
+from score_cache import score_cache
+from scripts.migrate_db import migrate_database
+
+BATCH_SIZE = int(os.getenv("MATCH_WORKER_BATCH_SIZE", "10"))
+POLL_INTERVAL_SECONDS = float(os.getenv("MATCH_WORKER_POLL_SECONDS", "2"))
+# serve this worker's Prometheus metrics on this port (0 = off)
+METRICS_PORT = int(os.getenv("MATCH_WORKER_METRICS_PORT", "0"))
+# expire, archive and prune this often (0 = off, e.g. when cron runs scripts/compact.py instead)
+COMPACT_INTERVAL_SECONDS = float(os.getenv("RETENTION_COMPACT_INTERVAL_SECONDS", "3600"))
+
+logger = get_logger("worker")
+
+
+# False if OpenAI is failing and the job was handed back untouched
+def process_job(job: MatchJob) -> bool:
+    db = SessionLocal()
+    progress_db = SessionLocal()
+    outcome = "done"
+    started = time.perf_counter()
+    try:
+        tracked = progress_db.get(MatchJob, job.id)
+
+        def on_progress(progress):
+            record_progress(progress_db, tracked, progress)
+
+        if job.item_type == "lost":
+            item = db.get(LostItem, job.item_id)
+            if item is not None:
+                match_lost_item(item, db, on_progress)
+        elif job.item_type == "found":
+            item = db.get(FoundItem, job.item_id)
+            if item is not None:
+                match_found_item(item, db, on_progress)
+        elif job.item_type == "import":
+            item = db.get(ImportBatch, job.item_id)
+            if item is not None:
+                match_import_batch(item.id, db, on_progress)
+        else:
+            raise ValueError(f"unknown item type {job.item_type!r}")
+
+        if item is None:
+            logger.info("Match job %d: %s item %d no longer exists", job.id, job.item_type, job.item_id)
+        complete_job(progress_db, tracked)
+    except CircuitOpenError as e:
+        db.rollback()
+        outcome = "postponed"
+        logger.warning("Match job %d postponed: %s", job.id, e)
+        release_job(progress_db, progress_db.get(MatchJob, job.id), str(e))
+        return False
+    except Exception as e:
+        db.rollback()
+        outcome = "failed"
+        logger.exception("Match job %d failed: %s", job.id, e)
+        fail_job(progress_db, progress_db.get(MatchJob, job.id), str(e))
+    finally:
+        db.close()
+        progress_db.close()
+        elapsed = time.perf_counter() - started
+        MATCH_JOBS.labels(outcome).inc()
+        STAGE_SECONDS.labels("match_job").observe(elapsed)
+        logger.info("Match job %d %s in %.2fs", job.id, outcome, elapsed)
+    return True
+
+
+def release_jobs(jobs, worker_id: str, error: str):
+    db = SessionLocal()
+    try:
+        for job in jobs:
+            tracked = db.get(MatchJob, job.id)
+            if tracked.status == "running" and tracked.lease_owner == worker_id:  # not one another worker took over
+                release_job(db, tracked, error)
+    finally:
+        db.close()
+
+
+def run_once(worker_id: str, batch_size: int = BATCH_SIZE) -> int:
+    db = SessionLocal()
+    try:
+        jobs = claim_jobs(db, worker_id, batch_size)
+    finally:
+        db.close()
+    for i, job in enumerate(jobs):
+        db = SessionLocal()
+        try:
+            still_ours = renew_lease(db, job.id, worker_id)
+        finally:
+            db.close()
+        if not still_ours:
+            logger.warning("Match job %d: lease lost before it started; skipping", job.id)
+            continue
+        logger.info("Processing match job %d (%s item %d)", job.id, job.item_type, job.item_id)
+        if not process_job(job):
+            # the rest of the batch would fail the same way; wait out the circuit breaker
+            release_jobs(jobs[i + 1:], worker_id, "OpenAI circuit open")
+            time.sleep(breaker.retry_in())
+            break
+    if jobs:
+        logger.info("Score cache: %s", score_cache.stats())
+    return len(jobs)
+
+
+def run_compaction():
+    try:
+        compact()
+    except Exception as e:
+        logger.exception("Compaction failed: %s", e)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the match job worker")
+    parser.add_argument("--once", action="store_true", help="exit when the queue is empty")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL_SECONDS)
+    args = parser.parse_args()
+
+    migrate_database()
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    logger.info("Match worker %s started", worker_id)
+    next_compaction = time.monotonic()
+    while True:
+        if COMPACT_INTERVAL_SECONDS and time.monotonic() >= next_compaction:
+            run_compaction()
+            next_compaction = time.monotonic() + COMPACT_INTERVAL_SECONDS
+        claimed = run_once(worker_id, args.batch_size)
+        if claimed == 0:
+            if args.once:
+                break
+            time.sleep(args.poll_interval)
+
+
+if __name__ == "__main__":
+    main()